@@ -1,26 +1,40 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, status
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from pydantic import TypeAdapter
 import shutil
 import os
 import tempfile
 import json
 from typing import List
-from datetime import timedelta
+from datetime import datetime, timedelta
 
 from app.db.database import get_db
-from app.db import crud
-from app.services import dify_service, component_service, guide_service, security_service
+from app.db import crud, sharding, write_queue
+from app.api import http_cache, streams
+from app.services import dify_service, component_service, security_service, search_service, circuit_breaker, llm_router, guide_cache, pricing_service, render_service, export_service, prompt_encoding
 from app.models import schemas
 from app.core.config import ACCESS_TOKEN_EXPIRE_MINUTES
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse
+from app.core import profiling
 import asyncio
+import io
+import pandas as pd
 
 class AnalysisRequestBody(schemas.BaseModel):
     analysis_message_id: int
 
+class GuideRequestBody(AnalysisRequestBody):
+    regenerate: bool = False
+
+class CodeRefinementRequestBody(AnalysisRequestBody):
+    instruction: str
+
 api_router = APIRouter()
 
+_conversation_list_adapter = TypeAdapter(List[schemas.Conversation])
+_message_list_adapter = TypeAdapter(List[schemas.MessageResponse])
+
 # --- Authentication Endpoints ---
 
 @api_router.post("/token", response_model=schemas.Token, tags=["Authentication"])
@@ -45,28 +59,38 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         raise HTTPException(status_code=400, detail="Username already registered")
     return crud.create_user(db=db, user=user)
 
-# --- Conversation Endpoints ---
+# --- Health Endpoints ---
 
-async def stream_initial_analysis(db: Session, user: schemas.User, image_id: str | None, text_input: str | None):
-    final_outputs = {}
-    async for chunk in dify_service.run_initial_analysis_workflow_stream(user.username, image_id, text_input):
-        yield f"data: {chunk}\n\n"
-        try:
-            data = json.loads(chunk)
-            if data.get("event") == "workflow_finished":
-                final_outputs = data.get("data", {}).get("outputs", {})
-        except json.JSONDecodeError:
-            continue
-    if not final_outputs:
-        error_event = {"event": "error", "message": "Workflow failed to produce final output."}
-        yield f"data: {json.dumps(error_event)}\n\n"
-        return
-    conversation_title = text_input[:50] if text_input else "Image Analysis"
-    conversation = crud.create_conversation(db, user_id=user.id, title=conversation_title)
-    message_content = {"type": "initial_analysis", "data": final_outputs}
-    new_message = crud.create_message(db, conversation_id=conversation.id, role="assistant", content=message_content)
-    final_event = {"event": "conversation_created", "conversation_id": conversation.id, "message_content": message_content, "message_id": new_message.id}
-    yield f"data: {json.dumps(final_event)}\n\n"
+@api_router.get("/upstreams/status", tags=["Health"])
+async def get_upstream_status(current_user: schemas.User = Depends(security_service.get_current_user)):
+    return {
+        "breakers": circuit_breaker.snapshot_all(),
+        "llm_backends": llm_router.get_router().snapshot(),
+        "guide_cache": guide_cache.cache.stats(),
+        "schematic_renderer": render_service.renderer.stats(),
+        "storage_shards": sharding.shards.stats(),
+        "message_write_queue": write_queue.message_queue.stats(),
+        "prompt_encoding": prompt_encoding.stats(),
+    }
+
+@api_router.get("/profiles/{profile_id}", tags=["Health"])
+async def get_request_profile(
+    profile_id: str,
+    format: str = Query("speedscope", pattern="^(speedscope|folded)$"),
+    current_user: schemas.User = Depends(security_service.get_current_admin_user)
+):
+    if not profile_id.isalnum() or len(profile_id) != 32:
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    path = profiling.profile_path(profile_id)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found.")
+    with open(path, encoding="utf-8") as f:
+        speedscope = json.load(f)
+    if format == "folded":
+        return PlainTextResponse(profiling.to_folded(speedscope))
+    return speedscope
+
+# --- Conversation Endpoints ---
 
 @api_router.post("/conversations/stream", tags=["Conversations"])
 async def stream_create_conversation_and_analyze(
@@ -84,7 +108,7 @@ async def stream_create_conversation_and_analyze(
         temp_file_path = os.path.join(temp_dir.name, image.filename)
         with open(temp_file_path, "wb") as buffer:
             shutil.copyfileobj(image.file, buffer)
-        image_id = dify_service.upload_file_to_dify(temp_file_path, current_user.username)
+        image_id = await asyncio.to_thread(dify_service.upload_file_to_dify, temp_file_path, current_user.username)
         if not image_id:
             temp_dir.cleanup()
             raise HTTPException(status_code=500, detail="Failed to upload image to Dify.")
@@ -93,7 +117,7 @@ async def stream_create_conversation_and_analyze(
     
     async def generator_wrapper():
         try:
-            async for chunk in stream_initial_analysis(db, current_user, image_id, prompt):
+            async for chunk in streams.sse(streams.initial_analysis_events(db, current_user, image_id, prompt)):
                 yield chunk
         finally:
             temp_dir.cleanup()
@@ -102,10 +126,83 @@ async def stream_create_conversation_and_analyze(
 
 @api_router.get("/conversations", response_model=List[schemas.Conversation], tags=["Conversations"])
 async def get_conversation_history(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    version, last_modified = crud.get_user_version(db, user_id=current_user.id)
+    last_modified = http_cache.settled_last_modified(last_modified)
+    etag = http_cache.make_etag("history", current_user.id, version)
+    if http_cache.is_not_modified(request, etag, last_modified):
+        return http_cache.not_modified_response(etag, last_modified)
+
+    conversations = crud.get_conversations_by_user(db, user_id=current_user.id)
+    body = _conversation_list_adapter.dump_json(_conversation_list_adapter.validate_python(conversations, from_attributes=True))
+    return http_cache.json_response(request, body, etag, last_modified)
+
+@api_router.get("/conversations/{conversation_id}/messages", response_model=List[schemas.MessageResponse], tags=["Conversations"])
+async def get_conversation_messages(
+    conversation_id: int,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    conversation = crud.get_conversation(db, conversation_id=conversation_id, user_id=current_user.id)
+    if not conversation or conversation.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+
+    version, last_modified = crud.get_user_version(db, user_id=current_user.id)
+    last_modified = http_cache.settled_last_modified(last_modified)
+    etag = http_cache.make_etag("messages", conversation_id, version)
+    if http_cache.is_not_modified(request, etag, last_modified):
+        return http_cache.not_modified_response(etag, last_modified)
+
+    messages = crud.get_messages_by_conversation(db, conversation_id=conversation_id, user_id=current_user.id)
+    body = _message_list_adapter.dump_json(_message_list_adapter.validate_python([m.to_dict() for m in messages]))
+    return http_cache.json_response(request, body, etag, last_modified)
+
+@api_router.get("/conversations/search", response_model=schemas.SearchResults, tags=["Conversations"])
+async def search_conversations(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    if not search_service.is_enabled():
+        raise HTTPException(status_code=501, detail="Full-text search is not available on this database.")
+    hits, has_more = crud.search_conversations(db, user_id=current_user.id, query=q, limit=limit, offset=offset)
+    return {"query": q, "limit": limit, "offset": offset, "has_more": has_more, "hits": hits}
+
+@api_router.get("/conversations/export", tags=["Conversations"])
+async def export_conversations(
+    format: str = Query("ndjson", pattern="^(ndjson|zip)$"),
+    since: datetime | None = Query(None, description="Only messages created at or after this time"),
+    until: datetime | None = Query(None, description="Only messages created before this time"),
+    conversation_id: List[int] | None = Query(None, description="Only these conversations (repeatable)"),
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    return crud.get_conversations_by_user(db, user_id=current_user.id)
+    """
+    Streams the user's full history: NDJSON (a conversation record followed by
+    its messages) or a zip archive with one NDJSON file per conversation.
+    """
+    media_type, extension = export_service.EXPORT_FORMATS[format]
+    filename = f"pcbtool-export-{current_user.id}-{datetime.utcnow():%Y%m%d-%H%M%S}.{extension}"
+    chunks = export_service.export(db, current_user.id, format, since, until, conversation_id)
+    # A sync iterator: Starlette pulls it in a worker thread, off the event loop.
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@api_router.post("/conversations/bulk-delete", response_model=schemas.ConversationBulkDeleteResult, tags=["Conversations"])
+async def bulk_delete_conversations(
+    body: schemas.ConversationBulkDelete,
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    requested = list(dict.fromkeys(body.conversation_ids))
+    deleted = crud.delete_conversations(db, requested, user_id=current_user.id)
+    deleted_set = set(deleted)
+    return {"deleted": deleted, "not_found": [cid for cid in requested if cid not in deleted_set]}
 
 @api_router.delete("/conversations/{conversation_id}", status_code=204, tags=["Conversations"])
 async def delete_conversation(
@@ -113,8 +210,7 @@ async def delete_conversation(
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    db_conversation = crud.delete_conversation(db, conversation_id=conversation_id, user_id=current_user.id)
-    if not db_conversation:
+    if not crud.delete_conversation(db, conversation_id=conversation_id, user_id=current_user.id):
         raise HTTPException(status_code=404, detail="Conversation not found.")
     return None
 
@@ -125,7 +221,7 @@ async def analyze_components(
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    source_message = crud.get_message(db, message_id=body.analysis_message_id)
+    source_message = crud.get_message(db, message_id=body.analysis_message_id, user_id=current_user.id)
     if not source_message or source_message.conversation.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Source message not found.")
     
@@ -151,55 +247,88 @@ async def analyze_components(
         }
     }
     
-    new_message = crud.create_message(db, conversation_id=conversation_id, role="assistant", content=new_message_content)
+    new_message = await write_queue.save_message(db, conversation_id=conversation_id, role="assistant", content=new_message_content, user_id=current_user.id)
     return new_message.to_dict()
-    
-@api_router.options("/conversations/{conversation_id}/generate-code/stream", tags=["Conversations"])
-async def options_generate_code(conversation_id: int):
-    return Response(status_code=200)
 
-@api_router.post("/conversations/{conversation_id}/generate-code/stream", tags=["Conversations"])
-async def stream_generate_code(
+@api_router.post("/conversations/{conversation_id}/optimize-purchase", response_model=schemas.MessageResponse, tags=["Conversations"])
+async def optimize_purchase(
     conversation_id: int,
     body: AnalysisRequestBody,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    source_message = crud.get_message(db, message_id=body.analysis_message_id)
+    source_message = crud.get_message(db, message_id=body.analysis_message_id, user_id=current_user.id)
     if not source_message or source_message.conversation.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Source message not found.")
 
     try:
         content = json.loads(source_message.content)
-        data = content.get("data", {})
-        req_doc = data.get("需求文档")
-        bom_text = data.get("BOM文件")
-        if not req_doc or not bom_text:
-            raise HTTPException(status_code=400, detail="ReqDoc or BOM not found in message.")
+        bom_text = content.get("data", {}).get("BOM文件")
+        if not bom_text:
+            raise HTTPException(status_code=400, detail="BOM text not found in the source message.")
     except (json.JSONDecodeError, KeyError):
-        raise HTTPException(status_code=400, detail="Invalid message format.")
+        raise HTTPException(status_code=400, detail="Invalid source message format.")
 
     bom_csv = component_service.extract_csv_from_text(bom_text)
     if not bom_csv:
         raise HTTPException(status_code=400, detail="Could not extract CSV from BOM text.")
+    try:
+        bom = pd.read_csv(io.StringIO(bom_csv))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to parse CSV data: {str(e)}")
+    if '元器件型号' not in bom.columns or '数量' not in bom.columns:
+        raise HTTPException(status_code=400, detail="CSV must contain '元器件型号' and '数量' columns.")
 
-    async def generator():
-        full_response = ""
-        async for chunk in dify_service.run_code_generation_stream(current_user.username, req_doc, bom_csv):
-            yield f"data: {chunk}\n\n"
-            try:
-                event_data = json.loads(chunk)
-                if event_data.get('event') in ['message', 'agent_message']:
-                    full_response += event_data.get('answer', '')
-            except:
-                continue
-        
-        message_content = {"type": "generated_code", "data": {"language": "python", "code": full_response}}
-        crud.create_message(db, conversation_id=conversation_id, role="assistant", content=message_content)
-        final_event = {"event": "final_message", "content": message_content}
-        yield f"data: {json.dumps(final_event)}\n\n"
-
-    return StreamingResponse(generator(), media_type="text/event-stream")
+    book = pricing_service.get_price_book()
+    if book is None:
+        raise HTTPException(status_code=503, detail="No store price tables are configured.")
+
+    plan = pricing_service.optimize_purchase(book, bom)
+    new_message_content = {"type": "purchase_plan", "data": plan}
+    new_message = await write_queue.save_message(db, conversation_id=conversation_id, role="assistant", content=new_message_content, user_id=current_user.id)
+    return new_message.to_dict()
+    
+@api_router.options("/conversations/{conversation_id}/generate-code/stream", tags=["Conversations"])
+async def options_generate_code(conversation_id: int):
+    return Response(status_code=200)
+
+@api_router.post("/conversations/{conversation_id}/generate-code/stream", tags=["Conversations"])
+async def stream_generate_code(
+    conversation_id: int,
+    body: AnalysisRequestBody,
+    coalesce: float = Depends(streams.coalesce_interval),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    req_doc, bom_text = streams.load_source_documents(db, current_user, body.analysis_message_id)
+    bom_csv = streams.extract_bom_csv(bom_text)
+    events = streams.code_generation_events(db, current_user, conversation_id, req_doc, bom_csv)
+    return StreamingResponse(streams.sse(events, coalesce), media_type="text/event-stream")
+
+@api_router.options("/conversations/{conversation_id}/refine-code/stream", tags=["Conversations"])
+async def options_refine_code(conversation_id: int):
+    return Response(status_code=200)
+
+@api_router.post("/conversations/{conversation_id}/refine-code/stream", tags=["Conversations"])
+async def stream_refine_code(
+    conversation_id: int,
+    body: CodeRefinementRequestBody,
+    coalesce: float = Depends(streams.coalesce_interval),
+    db: Session = Depends(get_db),
+    current_user: schemas.User = Depends(security_service.get_current_user)
+):
+    """
+    Streams the code agent's answer to a follow-up instruction. Only the
+    instruction is sent when the upstream conversation is still available;
+    the analysis is needed in case it has to be sent again.
+    """
+    if not body.instruction.strip():
+        raise HTTPException(status_code=400, detail="instruction must not be empty.")
+    dify_conversation_id = streams.upstream_conversation_id(db, current_user, conversation_id)
+    req_doc, bom_text = streams.load_source_documents(db, current_user, body.analysis_message_id)
+    bom_csv = streams.extract_bom_csv(bom_text)
+    events = streams.code_refinement_events(db, current_user, conversation_id, dify_conversation_id, req_doc, bom_csv, body.instruction)
+    return StreamingResponse(streams.sse(events, coalesce), media_type="text/event-stream")
 
 @api_router.options("/conversations/{conversation_id}/generate-deployment-guide/stream", tags=["Conversations"])
 async def options_generate_deployment_guide(conversation_id: int):
@@ -208,55 +337,13 @@ async def options_generate_deployment_guide(conversation_id: int):
 @api_router.post("/conversations/{conversation_id}/generate-deployment-guide/stream", tags=["Conversations"])
 async def stream_generate_deployment_guide(
     conversation_id: int,
-    body: AnalysisRequestBody,
+    body: GuideRequestBody,
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    source_message = crud.get_message(db, message_id=body.analysis_message_id)
-    if not source_message or source_message.conversation.user_id != current_user.id:
-        raise HTTPException(status_code=404, detail="Source message not found.")
-
-    try:
-        content = json.loads(source_message.content)
-        data = content.get("data", {})
-        req_doc = data.get("需求文档")
-        bom_text = data.get("BOM文件")
-        if not req_doc or not bom_text:
-            raise HTTPException(status_code=400, detail="ReqDoc or BOM not found in message.")
-    except (json.JSONDecodeError, KeyError):
-        raise HTTPException(status_code=400, detail="Invalid message format.")
-
-    async def generator():
-        # First, generate and stream the text
-        yield f"data: {json.dumps({'event': 'node_started', 'data': {'title': 'Generating deployment guide...'}})}\n\n"
-        
-        guide_text = guide_service.generate_guide_text(req_doc, bom_text)
-        
-        # Stream the text first without audio
-        message_content = {"type": "deployment_guide", "data": {"text": guide_text, "audio_url": None}}
-        crud.create_message(db, conversation_id=conversation_id, role="assistant", content=message_content)
-        
-        yield f"data: {json.dumps({'event': 'final_message', 'content': message_content})}\n\n"
-        
-        # Generate audio asynchronously after text is sent
-        yield f"data: {json.dumps({'event': 'node_started', 'data': {'title': 'Generating audio...'}})}\n\n"
-        
-        try:
-            audio_path = guide_service.convert_text_to_speech(guide_text)
-            audio_url = "/" + audio_path.replace("\\", "/") if audio_path else None
-            
-            # Update the message with audio URL
-            if audio_url:
-                message_content["data"]["audio_url"] = audio_url
-                # Note: In production, you might want to update the database message here
-                yield f"data: {json.dumps({'event': 'audio_ready', 'audio_url': audio_url})}\n\n"
-        except Exception as e:
-            print(f"Audio generation failed: {e}")
-            # Continue without audio
-        
-        yield f"data: {json.dumps({'event': 'node_finished', 'data': {'title': 'Deployment guide completed'}})}\n\n"
-
-    return StreamingResponse(generator(), media_type="text/event-stream")
+    req_doc, bom_text = streams.load_source_documents(db, current_user, body.analysis_message_id)
+    events = streams.deployment_guide_events(db, current_user, conversation_id, req_doc, bom_text, regenerate=body.regenerate)
+    return StreamingResponse(streams.sse(events), media_type="text/event-stream")
 
 @api_router.options("/conversations/{conversation_id}/generate-schematic/stream", tags=["Conversations"])
 async def options_generate_schematic(conversation_id: int):
@@ -269,35 +356,6 @@ async def stream_generate_schematic(
     db: Session = Depends(get_db),
     current_user: schemas.User = Depends(security_service.get_current_user)
 ):
-    source_message = crud.get_message(db, message_id=body.analysis_message_id)
-    if not source_message or source_message.conversation.user_id != current_user.id:
-        raise HTTPException(status_code=404, detail="Source message not found.")
-
-    try:
-        content = json.loads(source_message.content)
-        data = content.get("data", {})
-        req_doc = data.get("需求文档")
-        bom_text = data.get("BOM文件")
-        if not req_doc or not bom_text:
-            raise HTTPException(status_code=400, detail="ReqDoc or BOM not found in message.")
-    except (json.JSONDecodeError, KeyError):
-        raise HTTPException(status_code=400, detail="Invalid message format.")
-
-    async def generator():
-        final_outputs = {}
-        async for chunk in dify_service.run_schematic_generation_stream(current_user.username, req_doc, bom_text):
-            yield f"data: {chunk}\n\n"
-            try:
-                data = json.loads(chunk)
-                if data.get("event") == "workflow_finished":
-                    final_outputs = data.get("data", {}).get("outputs", {})
-            except:
-                continue
-        
-        schematic_code = final_outputs.get("picpic", "Schematic generation failed.")
-        message_content = {"type": "schematic_code", "data": {"language": "python", "code": schematic_code}}
-        crud.create_message(db, conversation_id=conversation_id, role="assistant", content=message_content)
-        final_event = {"event": "final_message", "content": message_content}
-        yield f"data: {json.dumps(final_event)}\n\n"
-
-    return StreamingResponse(generator(), media_type="text/event-stream")
\ No newline at end of file
+    req_doc, bom_text = streams.load_source_documents(db, current_user, body.analysis_message_id)
+    events = streams.schematic_events(db, current_user, conversation_id, req_doc, bom_text)
+    return StreamingResponse(streams.sse(events), media_type="text/event-stream")
@@ -0,0 +1,121 @@
+import gzip
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import Response
+
+from app.core.config import RESPONSE_COMPRESSION_MIN_SIZE
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+
+def make_etag(*parts) -> str:
+    """
+    Builds a weak ETag from version components. Weak, because the same version
+    may be sent with different content encodings.
+    """
+    return 'W/"' + "-".join(str(p) for p in parts) + '"'
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def settled_last_modified(last_modified: datetime | None) -> datetime | None:
+    """
+    Returns `last_modified` if it can serve as a validator, else None.
+    Last-Modified has one-second precision: while its second is not over,
+    another write may still get the same timestamp, so a client revalidating
+    with If-Modified-Since would get a stale 304. Until then only the
+    version-based ETag is used. Call it right after reading the version.
+    """
+    if last_modified is None:
+        return None
+    if _as_utc(last_modified).replace(microsecond=0) >= datetime.now(timezone.utc).replace(microsecond=0):
+        return None
+    return last_modified
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    """
+    Evaluates If-None-Match, falling back to If-Modified-Since when the client
+    sent no entity tags.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        opaque = etag.removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return _as_utc(last_modified).replace(microsecond=0) <= _as_utc(since)
+    return False
+
+
+def _cache_headers(etag: str, last_modified: datetime | None) -> dict:
+    headers = {
+        "ETag": etag,
+        # Private, per-user data: always revalidate, never share between users.
+        "Cache-Control": "private, no-cache",
+        "Vary": "Authorization, Accept-Encoding",
+    }
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(_as_utc(last_modified), usegmt=True)
+    return headers
+
+
+def _accepted_encodings(request: Request) -> dict:
+    accepted = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    return accepted
+
+
+def compress_body(request: Request, body: bytes) -> tuple[bytes, str | None]:
+    """
+    Compresses a response body with the best encoding the client accepts.
+    Returns the (possibly unchanged) body and the Content-Encoding to send.
+    """
+    if len(body) < RESPONSE_COMPRESSION_MIN_SIZE:
+        return body, None
+    accepted = _accepted_encodings(request)
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return brotli.compress(body, quality=5), "br"
+    if accepted.get("gzip", 0) > 0:
+        return gzip.compress(body, compresslevel=6), "gzip"
+    return body, None
+
+
+def not_modified_response(etag: str, last_modified: datetime | None) -> Response:
+    return Response(status_code=304, headers=_cache_headers(etag, last_modified))
+
+
+def json_response(request: Request, body: bytes, etag: str, last_modified: datetime | None) -> Response:
+    """
+    Builds a JSON response carrying validators and a negotiated content encoding.
+    """
+    headers = _cache_headers(etag, last_modified)
+    body, encoding = compress_body(request, body)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
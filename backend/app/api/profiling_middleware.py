@@ -0,0 +1,72 @@
+import uuid
+from urllib.parse import parse_qs
+
+from app.core import profiling
+from app.core.config import PROFILE_DEFAULT_HZ, PROFILE_MAX_HZ
+from app.services import security_service
+
+_TRUE_VALUES = {"1", "true", "yes", "on"}
+
+
+def _requested_hz(headers: dict, query: dict) -> float | None:
+    """
+    Returns the sampling rate asked for by the request, or None if it did not
+    ask to be profiled.
+    """
+    flag = headers.get("x-profile") or (query.get("profile") or [None])[0]
+    if not flag or flag.lower() not in _TRUE_VALUES:
+        return None
+    raw_hz = headers.get("x-profile-hz") or (query.get("profile_hz") or [None])[0]
+    try:
+        hz = float(raw_hz) if raw_hz else PROFILE_DEFAULT_HZ
+    except ValueError:
+        hz = PROFILE_DEFAULT_HZ
+    return min(max(hz, 1.0), PROFILE_MAX_HZ)
+
+
+def _is_admin_request(headers: dict) -> bool:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    return security_service.is_admin(security_service.get_username_from_token(token))
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests from admins that opt in with `X-Profile: 1` or `?profile=1`.
+
+    The profile covers the whole ASGI call, which for a StreamingResponse lasts
+    until its SSE generator is exhausted. The profile id is returned in the
+    `X-Profile-Id` response header and the result can be fetched from
+    `GET /api/v1/profiles/{profile_id}`. Everything else passes straight through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        hz = _requested_hz(headers, query)
+        if hz is None or not _is_admin_request(headers):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = uuid.uuid4().hex
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", request_id.encode())]
+            await send(message)
+
+        profile, token = profiling.start_profile(request_id, f"{scope['method']} {scope['path']}", hz)
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            path = profiling.finish_profile(profile, token)
+            print(f"📈 Profile for {scope['method']} {scope['path']} written to {path}")
@@ -0,0 +1,338 @@
+"""
+The generation streams shared by the SSE endpoints and the multiplexed
+WebSocket. Each stream is an async generator of JSON event payloads (Dify
+events passed through, plus our own); `sse` frames them for the HTTP path,
+optionally merging token deltas with `coalesce`.
+"""
+import asyncio
+import contextlib
+import json
+from typing import AsyncIterator, List, Tuple
+
+from fastapi import HTTPException, Query
+from sqlalchemy.orm import Session
+
+from app.core.config import SSE_COALESCE_DEFAULT, SSE_COALESCE_INTERVAL_MS, SSE_COALESCE_MAX_BYTES
+from app.db import crud, write_queue
+from app.models import schemas
+from app.services import dify_service, component_service, guide_service, render_service
+
+
+def load_source_documents(db: Session, user: schemas.User, analysis_message_id: int) -> Tuple[str, str]:
+    """
+    Returns the requirement document and BOM text of an analysis message
+    owned by `user`.
+    """
+    source_message = crud.get_message(db, message_id=analysis_message_id, user_id=user.id)
+    if not source_message or source_message.conversation.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Source message not found.")
+
+    try:
+        content = json.loads(source_message.content)
+        data = content.get("data", {})
+        req_doc = data.get("需求文档")
+        bom_text = data.get("BOM文件")
+        if not req_doc or not bom_text:
+            raise HTTPException(status_code=400, detail="ReqDoc or BOM not found in message.")
+    except (json.JSONDecodeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid message format.")
+    return req_doc, bom_text
+
+
+def extract_bom_csv(bom_text: str) -> str:
+    bom_csv = component_service.extract_csv_from_text(bom_text)
+    if not bom_csv:
+        raise HTTPException(status_code=400, detail="Could not extract CSV from BOM text.")
+    return bom_csv
+
+
+DELTA_EVENTS = {"message", "agent_message"}
+_FLUSH = object()
+_END = object()
+
+
+def coalesce_interval(
+    coalesce: str | None = Query(None, description="off, on, or a flush interval in milliseconds for merging token events"),
+) -> float:
+    """
+    Reads the per-request coalescing mode; returns the flush interval in
+    seconds, 0 for one frame per event.
+    """
+    mode = (coalesce or SSE_COALESCE_DEFAULT).strip().lower()
+    if mode in ("off", "false", "no", "0"):
+        return 0.0
+    if mode in ("on", "true", "yes"):
+        return SSE_COALESCE_INTERVAL_MS / 1000
+    try:
+        interval_ms = float(mode)
+    except ValueError:
+        interval_ms = -1
+    if not 0 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="coalesce must be off, on, or an interval of up to 1000 ms.")
+    return interval_ms / 1000
+
+
+async def sse(events: AsyncIterator[str], coalesce_seconds: float = 0.0) -> AsyncIterator[str]:
+    if coalesce_seconds > 0:
+        events = coalesce(events, coalesce_seconds)
+    async for event in events:
+        yield f"data: {event}\n\n"
+
+
+async def coalesce(events: AsyncIterator[str], interval: float, max_bytes: int = SSE_COALESCE_MAX_BYTES) -> AsyncIterator[str]:
+    """
+    Merges consecutive `message`/`agent_message` deltas of the same message
+    into one event carrying the concatenated `answer`. A delta arriving after
+    a quiet `interval` is passed on at once; those following it are held
+    until the interval has passed or `max_bytes` of answer text are waiting.
+    Any other event flushes what is held and is passed on immediately.
+    """
+    loop = asyncio.get_running_loop()
+    # A reader task feeds the queue; the flush timer drops a marker into it.
+    queue: asyncio.Queue = asyncio.Queue()
+    held: List[Tuple[str, dict]] = []
+    held_bytes = 0
+    last_flush = float("-inf")
+    timer: asyncio.TimerHandle | None = None
+
+    async def read() -> None:
+        try:
+            async for raw in events:
+                queue.put_nowait(raw)
+            queue.put_nowait(_END)
+        except Exception as e:
+            queue.put_nowait(e)
+
+    def flush() -> str:
+        nonlocal held_bytes, last_flush, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        raw = held[0][0] if len(held) == 1 else json.dumps(
+            {**held[0][1], "answer": "".join(event.get("answer", "") for _, event in held)}, ensure_ascii=False
+        )
+        held.clear()
+        held_bytes = 0
+        last_flush = loop.time()
+        return raw
+
+    reader = asyncio.ensure_future(read())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item is _FLUSH:
+                timer = None
+                if held:
+                    yield flush()
+                continue
+
+            event = _parse_delta(item)
+            if event is None:
+                if held:
+                    yield flush()
+                yield item
+                continue
+            if held and (held[0][1].get("event"), held[0][1].get("message_id")) != (event.get("event"), event.get("message_id")):
+                yield flush()
+            if not held and loop.time() - last_flush >= interval:
+                last_flush = loop.time()
+                yield item
+                continue
+            held.append((item, event))
+            held_bytes += len(event.get("answer", "").encode())
+            if held_bytes >= max_bytes:
+                yield flush()
+            elif timer is None:
+                timer = loop.call_at(last_flush + interval, queue.put_nowait, _FLUSH)
+        if held:
+            yield flush()
+    finally:
+        if timer is not None:
+            timer.cancel()
+        # Stops the upstream stream too when the client has gone away.
+        reader.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await reader
+
+
+def _parse_delta(raw: str) -> dict | None:
+    try:
+        event = json.loads(raw)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(event, dict) and event.get("event") in DELTA_EVENTS and isinstance(event.get("answer", ""), str):
+        return event
+    return None
+
+
+async def initial_analysis_events(db: Session, user: schemas.User, image_id: str | None, text_input: str | None) -> AsyncIterator[str]:
+    final_outputs = {}
+    async for chunk in dify_service.run_initial_analysis_workflow_stream(user.username, image_id, text_input):
+        yield chunk
+        try:
+            data = json.loads(chunk)
+            if data.get("event") == "workflow_finished":
+                final_outputs = data.get("data", {}).get("outputs", {})
+        except json.JSONDecodeError:
+            continue
+    if not final_outputs:
+        yield json.dumps({"event": "error", "message": "Workflow failed to produce final output."})
+        return
+    conversation_title = text_input[:50] if text_input else "Image Analysis"
+    conversation = crud.create_conversation(db, user_id=user.id, title=conversation_title)
+    message_content = {"type": "initial_analysis", "data": final_outputs}
+    new_message = await write_queue.save_message(db, conversation_id=conversation.id, role="assistant", content=message_content, user_id=user.id)
+    yield json.dumps({"event": "conversation_created", "conversation_id": conversation.id, "message_content": message_content, "message_id": new_message.id})
+
+
+async def code_generation_events(db: Session, user: schemas.User, conversation_id: int, req_doc: str, bom_csv: str) -> AsyncIterator[str]:
+    upstream = dify_service.run_code_generation_stream(user.username, req_doc, bom_csv)
+    async for chunk in _code_events(db, user, conversation_id, upstream):
+        yield chunk
+
+
+def upstream_conversation_id(db: Session, user: schemas.User, conversation_id: int) -> str | None:
+    """
+    Returns the Dify conversation recorded for one of `user`'s conversations.
+    """
+    conversation = crud.get_conversation(db, conversation_id=conversation_id, user_id=user.id)
+    if not conversation or conversation.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+    return conversation.dify_conversation_id
+
+
+async def code_refinement_events(db: Session, user: schemas.User, conversation_id: int, dify_conversation_id: str | None,
+                                 req_doc: str, bom_csv: str, instruction: str) -> AsyncIterator[str]:
+    """
+    Sends only `instruction` to the Dify conversation that generated the
+    code. When there is none, or Dify no longer has it, the requirement
+    document, BOM and latest code are sent again with the instruction.
+    """
+    upstream = None
+    if dify_conversation_id:
+        upstream = dify_service.run_code_refinement_stream(user.username, dify_conversation_id, instruction)
+        first = await anext(upstream, None)
+        try:
+            missing = first is not None and dify_service.is_conversation_missing(json.loads(first))
+        except json.JSONDecodeError:
+            missing = False
+        if missing:
+            await upstream.aclose()
+            upstream = None
+            print(f"⚠️ Dify conversation {dify_conversation_id} has expired, resending the full context")
+            crud.set_dify_conversation_id(db, conversation_id, None, user_id=user.id)
+        else:
+            upstream = _prepend(first, upstream)
+    if upstream is None:
+        yield json.dumps({"event": "upstream_context_resent"})
+        query = _full_refinement_query(db, user, conversation_id, instruction)
+        upstream = dify_service.run_code_generation_stream(user.username, req_doc, bom_csv, query=query)
+    async for chunk in _code_events(db, user, conversation_id, upstream):
+        yield chunk
+
+
+async def _prepend(first: str | None, rest: AsyncIterator[str]) -> AsyncIterator[str]:
+    try:
+        if first is not None:
+            yield first
+        async for chunk in rest:
+            yield chunk
+    finally:
+        await rest.aclose()
+
+
+def _full_refinement_query(db: Session, user: schemas.User, conversation_id: int, instruction: str) -> str:
+    for message in reversed(crud.get_messages_by_conversation(db, conversation_id=conversation_id, user_id=user.id)):
+        content = json.loads(message.content)
+        if content.get("type") == "generated_code" and content.get("data", {}).get("code"):
+            return (f"{dify_service.CODE_GENERATION_QUERY}\n\nThe current code is:\n```python\n"
+                    f"{content['data']['code']}\n```\n\nApply this change to it: {instruction}")
+    return f"{dify_service.CODE_GENERATION_QUERY}\n\n{instruction}"
+
+
+async def _code_events(db: Session, user: schemas.User, conversation_id: int, upstream: AsyncIterator[str]) -> AsyncIterator[str]:
+    full_response = ""
+    dify_conversation_id = None
+    async for chunk in upstream:
+        yield chunk
+        try:
+            event_data = json.loads(chunk)
+            if event_data.get('event') in ['message', 'agent_message']:
+                full_response += event_data.get('answer', '')
+                dify_conversation_id = dify_conversation_id or event_data.get('conversation_id')
+        except:
+            continue
+
+    if dify_conversation_id:
+        crud.set_dify_conversation_id(db, conversation_id, dify_conversation_id, user_id=user.id)
+    message_content = {"type": "generated_code", "data": {"language": "python", "code": full_response}}
+    await write_queue.save_message(db, conversation_id=conversation_id, role="assistant", content=message_content, user_id=user.id)
+    yield json.dumps({"event": "final_message", "content": message_content})
+
+
+async def deployment_guide_events(db: Session, user: schemas.User, conversation_id: int, req_doc: str, bom_text: str, regenerate: bool = False) -> AsyncIterator[str]:
+    # First, generate and stream the text
+    yield json.dumps({'event': 'node_started', 'data': {'title': 'Generating deployment guide...'}})
+
+    guide_text = await guide_service.generate_guide_text(req_doc, bom_text, regenerate=regenerate)
+
+    # Stream the text first without audio
+    message_content = {"type": "deployment_guide", "data": {"text": guide_text, "audio_url": None}}
+    await write_queue.save_message(db, conversation_id=conversation_id, role="assistant", content=message_content, user_id=user.id)
+
+    yield json.dumps({'event': 'final_message', 'content': message_content})
+
+    # Generate audio asynchronously after text is sent
+    yield json.dumps({'event': 'node_started', 'data': {'title': 'Generating audio...'}})
+
+    try:
+        audio_path = guide_service.convert_text_to_speech(guide_text)
+        audio_url = "/" + audio_path.replace("\\", "/") if audio_path else None
+
+        # Update the message with audio URL
+        if audio_url:
+            message_content["data"]["audio_url"] = audio_url
+            # Note: In production, you might want to update the database message here
+            yield json.dumps({'event': 'audio_ready', 'audio_url': audio_url})
+    except Exception as e:
+        print(f"Audio generation failed: {e}")
+        # Continue without audio
+
+    yield json.dumps({'event': 'node_finished', 'data': {'title': 'Deployment guide completed'}})
+
+
+async def schematic_events(db: Session, user: schemas.User, conversation_id: int, req_doc: str, bom_text: str) -> AsyncIterator[str]:
+    final_outputs = {}
+    async for chunk in dify_service.run_schematic_generation_stream(user.username, req_doc, bom_text):
+        yield chunk
+        try:
+            data = json.loads(chunk)
+            if data.get("event") == "workflow_finished":
+                final_outputs = data.get("data", {}).get("outputs", {})
+        except:
+            continue
+
+    schematic_code = final_outputs.get("picpic")
+    message_content = {"type": "schematic_code", "data": {"language": "python", "code": schematic_code or "Schematic generation failed."}}
+    db_message = await write_queue.save_message(db, conversation_id=conversation_id, role="assistant", content=message_content, user_id=user.id)
+    yield json.dumps({"event": "final_message", "content": message_content})
+
+    if not schematic_code:
+        return
+
+    # Render the code in the sandboxed worker pool and attach the images to the message.
+    yield json.dumps({'event': 'node_started', 'data': {'title': 'Rendering schematic...'}})
+    try:
+        rendered = await render_service.renderer.render(schematic_code)
+    except render_service.RenderError as e:
+        print(f"Schematic rendering failed: {e}")
+        yield json.dumps({'event': 'schematic_render_failed', 'message_id': db_message.id, 'error': str(e)})
+        return
+
+    message_content["data"]["image"] = {"svg_url": rendered["svg_url"], "png_url": rendered["png_url"]}
+    crud.update_message_content(db, db_message.id, message_content, user_id=user.id)
+    yield json.dumps({'event': 'schematic_rendered', 'message_id': db_message.id, **rendered})
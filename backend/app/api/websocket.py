@@ -0,0 +1,273 @@
+"""
+Multiplexed generation streams over a single WebSocket.
+
+A client authenticates once per connection, then runs any number of
+generation streams concurrently, each tagged with a client-chosen stream id.
+All frames are JSON text messages; a binary frame is answered with an error
+frame (or, in place of the auth message, a 1003 close).
+
+Client -> server:
+    {"type": "auth", "token": "..."}                 (unless ?token= was given)
+    {"type": "start", "stream_id": "s1", "kind": "generate_code",
+     "conversation_id": 1, "analysis_message_id": 2}
+    {"type": "credit", "stream_id": "s1", "n": 32}
+    {"type": "cancel", "stream_id": "s1"}
+    {"type": "ping"}
+
+Server -> client:
+    {"type": "ready", "max_streams": 8, "window": 64}
+    {"type": "event", "stream_id": "s1", "seq": 0, "data": {...}}
+    {"type": "end", "stream_id": "s1", "status": "completed" | "cancelled" | "error", "detail": ...}
+    {"type": "error", "stream_id": ..., "detail": "..."}
+    {"type": "pong"}
+
+`data` is exactly what the SSE endpoints send after `data: `. A stream may
+have `window` events unacknowledged; it then pauses (and with it the upstream
+read) until the client grants more credit. Cancelling a stream, or closing
+the socket, aborts its upstream Dify request immediately.
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+
+from app.api import streams
+from app.core.config import WS_MAX_STREAMS, WS_STREAM_WINDOW, WS_AUTH_TIMEOUT
+from app.db import crud
+from app.db.database import SessionLocal
+from app.models import schemas
+from app.services import security_service
+
+ws_router = APIRouter()
+
+# Close code for failed authentication (4000-4999 are application defined).
+WS_CLOSE_UNAUTHORIZED = 4401
+# Close code for a binary frame where a JSON text frame was expected.
+WS_CLOSE_UNSUPPORTED_DATA = 1003
+
+STREAM_KINDS = {"analyze", "generate_code", "refine_code", "generate_deployment_guide", "generate_schematic"}
+
+
+class _Stream:
+    """
+    A running stream and its flow-control window.
+    """
+
+    def __init__(self, stream_id: str, window: int):
+        self.stream_id = stream_id
+        self.credit = window
+        self.task: asyncio.Task | None = None
+        self._credit_available = asyncio.Event()
+        self._credit_available.set()
+
+    def grant(self, n: int) -> None:
+        self.credit += n
+        if self.credit > 0:
+            self._credit_available.set()
+
+    async def acquire(self) -> None:
+        while self.credit <= 0:
+            self._credit_available.clear()
+            await self._credit_available.wait()
+        self.credit -= 1
+
+
+class StreamSession:
+    """
+    The streams of one WebSocket connection. Frames from concurrent streams are
+    serialized through a single send lock.
+    """
+
+    def __init__(self, websocket: WebSocket, user: schemas.User):
+        self.websocket = websocket
+        self.user = user
+        self.streams: Dict[str, _Stream] = {}
+        self._send_lock = asyncio.Lock()
+
+    async def send_text(self, text: str) -> None:
+        async with self._send_lock:
+            await self.websocket.send_text(text)
+
+    async def send_json(self, message: Dict[str, Any]) -> None:
+        await self.send_text(json.dumps(message))
+
+    async def handle(self, message: Dict[str, Any]) -> None:
+        kind = message.get("type")
+        stream_id = message.get("stream_id")
+        if kind == "ping":
+            await self.send_json({"type": "pong"})
+        elif kind == "start":
+            await self.start(message)
+        elif kind == "credit":
+            stream = self.streams.get(stream_id)
+            n = message.get("n")
+            if stream is not None and isinstance(n, int) and n > 0:
+                stream.grant(n)
+        elif kind == "cancel":
+            stream = self.streams.get(stream_id)
+            if stream is not None and stream.task is not None:
+                stream.task.cancel()
+        else:
+            await self.send_json({"type": "error", "stream_id": stream_id, "detail": f"Unknown message type: {kind!r}"})
+
+    async def start(self, message: Dict[str, Any]) -> None:
+        stream_id = message.get("stream_id")
+        if not isinstance(stream_id, str) or not stream_id:
+            await self.send_json({"type": "error", "stream_id": stream_id, "detail": "stream_id must be a non-empty string."})
+        elif stream_id in self.streams:
+            await self.send_json({"type": "error", "stream_id": stream_id, "detail": "stream_id is already in use."})
+        elif message.get("kind") not in STREAM_KINDS:
+            await self.send_json({"type": "error", "stream_id": stream_id, "detail": f"kind must be one of {sorted(STREAM_KINDS)}."})
+        elif len(self.streams) >= WS_MAX_STREAMS:
+            await self.send_json({"type": "error", "stream_id": stream_id, "detail": f"At most {WS_MAX_STREAMS} concurrent streams."})
+        else:
+            stream = _Stream(stream_id, WS_STREAM_WINDOW)
+            self.streams[stream_id] = stream
+            stream.task = asyncio.create_task(self._run(stream, message), name=f"ws-stream-{stream_id}")
+
+    async def _run(self, stream: _Stream, message: Dict[str, Any]) -> None:
+        db = SessionLocal()
+        end: Dict[str, Any] = {"type": "end", "stream_id": stream.stream_id, "status": "completed"}
+        # The id is client supplied: encode it once, the event frames are built as
+        # text around the upstream JSON rather than parsed and re-serialized.
+        prefix = '{"type":"event","stream_id":' + json.dumps(stream.stream_id) + ',"seq":'
+        seq = 0
+        events = None
+        try:
+            events = _open_stream(db, self.user, message)
+            async for event in events:
+                await stream.acquire()
+                if not event.startswith("{"):
+                    event = json.dumps(event)
+                await self.send_text(f'{prefix}{seq},"data":{event}}}')
+                seq += 1
+        except asyncio.CancelledError:
+            end["status"] = "cancelled"
+        except HTTPException as e:
+            end.update(status="error", detail=e.detail, status_code=e.status_code)
+        except Exception as e:
+            print(f"❌ WebSocket stream {stream.stream_id} failed: {e}")
+            end.update(status="error", detail="Internal error.")
+        finally:
+            # A stream paused for credit is suspended at a yield: close it so the
+            # upstream request is released now rather than at garbage collection.
+            if events is not None:
+                await events.aclose()
+            db.close()
+            self.streams.pop(stream.stream_id, None)
+        try:
+            await self.send_json(end)
+        except Exception:
+            # The socket is gone; nobody is left to tell.
+            pass
+
+    async def close(self) -> None:
+        tasks = [stream.task for stream in self.streams.values() if stream.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _open_stream(db, user: schemas.User, message: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Returns the event stream a `start` message asks for; the same generators
+    back the SSE endpoints.
+    """
+    kind = message["kind"]
+    if kind == "analyze":
+        # Image uploads stay on POST /conversations/stream.
+        text_input = message.get("text_input")
+        if not text_input:
+            raise HTTPException(status_code=400, detail="text_input is required.")
+        return streams.initial_analysis_events(db, user, None, text_input)
+
+    conversation_id = message.get("conversation_id")
+    analysis_message_id = message.get("analysis_message_id")
+    if not isinstance(conversation_id, int) or not isinstance(analysis_message_id, int):
+        raise HTTPException(status_code=400, detail="conversation_id and analysis_message_id are required.")
+    req_doc, bom_text = streams.load_source_documents(db, user, analysis_message_id)
+    if kind == "generate_code":
+        return streams.code_generation_events(db, user, conversation_id, req_doc, streams.extract_bom_csv(bom_text))
+    if kind == "refine_code":
+        instruction = message.get("instruction")
+        if not isinstance(instruction, str) or not instruction.strip():
+            raise HTTPException(status_code=400, detail="instruction is required.")
+        dify_conversation_id = streams.upstream_conversation_id(db, user, conversation_id)
+        return streams.code_refinement_events(db, user, conversation_id, dify_conversation_id, req_doc, streams.extract_bom_csv(bom_text), instruction)
+    if kind == "generate_deployment_guide":
+        return streams.deployment_guide_events(db, user, conversation_id, req_doc, bom_text, regenerate=bool(message.get("regenerate")))
+    return streams.schematic_events(db, user, conversation_id, req_doc, bom_text)
+
+
+async def _receive_text(websocket: WebSocket) -> str | None:
+    """
+    Returns the next text frame, or None for a binary frame.
+
+    `WebSocket.receive_text` fails with a KeyError on binary frames, which would
+    end the connection and every stream multiplexed on it.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    return message.get("text")
+
+
+async def _authenticate(websocket: WebSocket) -> schemas.User | None:
+    token = websocket.query_params.get("token")
+    if not token:
+        try:
+            text = await asyncio.wait_for(_receive_text(websocket), WS_AUTH_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        if text is None:
+            await websocket.close(code=WS_CLOSE_UNSUPPORTED_DATA, reason="Messages must be JSON text frames.")
+            raise WebSocketDisconnect(WS_CLOSE_UNSUPPORTED_DATA)
+        try:
+            message = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(message, dict) and message.get("type") == "auth":
+            token = message.get("token")
+    username = security_service.get_username_from_token(token) if isinstance(token, str) else None
+    if username is None:
+        return None
+    db = SessionLocal()
+    try:
+        return crud.get_user_by_username(db, username=username)
+    finally:
+        db.close()
+
+
+@ws_router.websocket("/ws")
+async def multiplexed_streams(websocket: WebSocket):
+    await websocket.accept()
+    try:
+        user = await _authenticate(websocket)
+    except WebSocketDisconnect:
+        return
+    if user is None:
+        await websocket.close(code=WS_CLOSE_UNAUTHORIZED, reason="Could not validate credentials")
+        return
+
+    session = StreamSession(websocket, user)
+    await session.send_json({"type": "ready", "max_streams": WS_MAX_STREAMS, "window": WS_STREAM_WINDOW})
+    try:
+        while True:
+            text = await _receive_text(websocket)
+            if text is None:
+                await session.send_json({"type": "error", "detail": "Messages must be JSON text frames."})
+                continue
+            try:
+                message = json.loads(text)
+            except json.JSONDecodeError:
+                await session.send_json({"type": "error", "detail": "Messages must be JSON."})
+                continue
+            if not isinstance(message, dict):
+                await session.send_json({"type": "error", "detail": "Messages must be JSON objects."})
+                continue
+            await session.handle(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await session.close()
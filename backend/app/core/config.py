@@ -13,20 +13,169 @@ DIFY_API_KEY_WORKFLOW = os.getenv("DIFY_API_KEY_WORKFLOW", "app-sYYYxIHMgLR68pRe
 DIFY_API_KEY_AGENT = os.getenv("DIFY_API_KEY_AGENT", "app-EvqSJJJldKdMwVtzja9C4Gc2")
 DIFY_API_KEY_SCHEMATIC = os.getenv("DIFY_API_KEY_SCHEMATIC", "app-deBVvv9f3gQAPWMrS0IZDNTS")
 
+# Timeouts (seconds). Connecting and waiting for the first streamed byte are
+# bounded separately from the idle gap allowed between events of a running stream.
+DIFY_CONNECT_TIMEOUT = float(os.getenv("DIFY_CONNECT_TIMEOUT", "5"))
+DIFY_FIRST_BYTE_TIMEOUT = float(os.getenv("DIFY_FIRST_BYTE_TIMEOUT", "30"))
+DIFY_STREAM_IDLE_TIMEOUT = float(os.getenv("DIFY_STREAM_IDLE_TIMEOUT", "60"))
+
+# Only idempotent requests (file upload) are retried, with exponential backoff.
+DIFY_UPLOAD_RETRIES = int(os.getenv("DIFY_UPLOAD_RETRIES", "3"))
+DIFY_RETRY_BACKOFF = float(os.getenv("DIFY_RETRY_BACKOFF", "0.5"))
+
+# Circuit breaker per Dify endpoint and API key.
+DIFY_BREAKER_WINDOW_SECONDS = float(os.getenv("DIFY_BREAKER_WINDOW_SECONDS", "60"))
+DIFY_BREAKER_MIN_REQUESTS = int(os.getenv("DIFY_BREAKER_MIN_REQUESTS", "5"))
+DIFY_BREAKER_ERROR_RATE = float(os.getenv("DIFY_BREAKER_ERROR_RATE", "0.5"))
+DIFY_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("DIFY_BREAKER_SLOW_CALL_SECONDS", "20"))
+DIFY_BREAKER_OPEN_SECONDS = float(os.getenv("DIFY_BREAKER_OPEN_SECONDS", "30"))
+DIFY_BREAKER_HALF_OPEN_PROBES = int(os.getenv("DIFY_BREAKER_HALF_OPEN_PROBES", "1"))
+
 
 # --- OpenAI-Compatible API Configuration (for Deployment Guide) ---
 OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "sk-dd280b67097548a8ab1b1ccd9b767569")
-OPENAI_MODEL_NAME = "deepseek-r1"
+OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "deepseek-r1")
+
+# Optional pool of OpenAI-compatible backends as a JSON list, e.g.
+# [{"name": "qwen", "base_url": "...", "api_key": "...", "model": "qwen-plus", "max_concurrency": 8}]
+# Requests are routed by observed time-to-first-token and throughput. When
+# unset, the single backend above is used.
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+# Smoothing factor of the latency/throughput moving averages (0 < alpha <= 1).
+LLM_EWMA_ALPHA = float(os.getenv("LLM_EWMA_ALPHA", "0.3"))
+# Start a backup request on another backend when the first one has produced
+# nothing after this many seconds. 0 disables hedging.
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "300"))
+
+# --- Deployment Guide Cache ---
+# Guides are cached by a canonical form of the BOM and requirement document.
+# Set GUIDE_CACHE_MAX_ENTRIES to 0 to disable the cache, and GUIDE_CACHE_PATH
+# to an SQLite file to keep entries across restarts.
+GUIDE_CACHE_TTL_SECONDS = float(os.getenv("GUIDE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+GUIDE_CACHE_MAX_ENTRIES = int(os.getenv("GUIDE_CACHE_MAX_ENTRIES", "1000"))
+GUIDE_CACHE_PATH = os.getenv("GUIDE_CACHE_PATH", "")
+
+# --- Prompt Encoding ---
+# The requirement document and BOM are sent to the code agent, the schematic
+# workflow and the guide LLM in a compact form: markdown chrome and blank lines
+# removed, the BOM reduced to one CSV row per part without price columns.
+# PROMPT_TOKEN_BUDGETS caps the estimated tokens per target as JSON, e.g.
+# {"code": 6000, "schematic": 6000, "guide": 4000}; over it, BOM descriptions
+# and then the end of the requirement document are dropped.
+PROMPT_ENCODING = os.getenv("PROMPT_ENCODING", "1").lower() in ("1", "true", "yes", "on")
+PROMPT_TOKEN_BUDGETS = os.getenv("PROMPT_TOKEN_BUDGETS", '{"code": 6000, "schematic": 6000, "guide": 4000}')
+
+# --- Purchase Optimization ---
+# Directory of per-store price tables (<store>.csv with columns part, break_qty,
+# unit_price, moq, stock) and an optional stores.json with shipping charges.
+PRICE_TABLE_DIR = os.getenv("PRICE_TABLE_DIR", "")
+# Store assignment is solved exactly up to this many stores, heuristically beyond.
+PRICING_EXACT_MAX_STORES = int(os.getenv("PRICING_EXACT_MAX_STORES", "12"))
+
+# --- Schematic Rendering ---
+# Generated schematic code is executed in sandboxed worker processes, one per render.
+# Each render gets its own CPU-time and memory budget; the wall-clock timeout
+# catches code that blocks without using CPU. Renders beyond the workers plus
+# RENDER_QUEUE_SIZE are rejected instead of queued.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "2"))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "8"))
+RENDER_CPU_SECONDS = int(os.getenv("RENDER_CPU_SECONDS", "10"))
+RENDER_MEMORY_MB = int(os.getenv("RENDER_MEMORY_MB", "512"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "20"))
+SCHEMATIC_DIR = os.getenv("SCHEMATIC_DIR", "static/schematics")
+# URL under which SCHEMATIC_DIR is served; the default matches the /static
+# mount of static/schematics. Set it when SCHEMATIC_DIR lives elsewhere and is
+# served by a proxy or another mount.
+SCHEMATIC_URL_PREFIX = os.getenv("SCHEMATIC_URL_PREFIX", "/static/schematics")
+# Workers start from an empty environment (no secrets or API keys reach them)
+# as RENDER_USER, "nobody" by default when the server runs as root; the account
+# must be able to run the Python interpreter. They are started through
+# RENDER_SANDBOX_PREFIX, which must cut them off the network: `unshare --net --`
+# by default (`unshare --user --net --` without root), or a bwrap, nsjail or
+# container command. "none" disables either, with a warning at startup.
+RENDER_USER = os.getenv("RENDER_USER", "")
+RENDER_SANDBOX_PREFIX = os.getenv("RENDER_SANDBOX_PREFIX", "")
+# Home and matplotlib cache of the workers; a temporary directory by default.
+RENDER_WORK_DIR = os.getenv("RENDER_WORK_DIR", "")
+
+# --- Conversation Export ---
+# Exports read this many messages per database round trip and send the
+# response in chunks of about EXPORT_FLUSH_BYTES.
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", str(64 * 1024)))
+
+# --- Data Retention & Maintenance ---
+# Per message type retention in days as JSON, e.g. {"generated_code": 90,
+# "schematic_code": 90}. The pseudo-types "audio" and "schematic_image" expire
+# the generated files in static/audio and SCHEMATIC_DIR, and clear the message
+# fields linking to them. Empty keeps everything.
+RETENTION_POLICIES = os.getenv("RETENTION_POLICIES", "")
+# The maintenance task applies the policies and compacts the database every
+# interval (0 disables it), deleting in small batches with a pause in between
+# so live requests are never blocked for long.
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "3600"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+MAINTENANCE_BATCH_PAUSE = float(os.getenv("MAINTENANCE_BATCH_PAUSE", "0.05"))
+# Free pages returned to the file system per run (SQLite incremental vacuum).
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "2000"))
+# Most conversations a single bulk delete request may name.
+BULK_DELETE_MAX_IDS = int(os.getenv("BULK_DELETE_MAX_IDS", "500"))
+
+# --- WebSocket Streams ---
+# One authenticated WebSocket carries all generation streams of a client. Each
+# stream may have WS_STREAM_WINDOW unacknowledged events in flight before the
+# server pauses it until the client grants more credit.
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "8"))
+WS_STREAM_WINDOW = int(os.getenv("WS_STREAM_WINDOW", "64"))
+# Seconds a new connection has to authenticate.
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))
+
+# --- SSE Coalescing ---
+# The code-generation SSE endpoints can merge consecutive token events into one
+# frame: a client sends `?coalesce=on` (SSE_COALESCE_INTERVAL_MS), a flush
+# interval in ms such as `?coalesce=30`, or `?coalesce=off`. SSE_COALESCE_DEFAULT
+# applies when a request does not say. A frame is also sent as soon as
+# SSE_COALESCE_MAX_BYTES of text are waiting; other events are never delayed.
+SSE_COALESCE_DEFAULT = os.getenv("SSE_COALESCE_DEFAULT", "off")
+SSE_COALESCE_INTERVAL_MS = float(os.getenv("SSE_COALESCE_INTERVAL_MS", "40"))
+SSE_COALESCE_MAX_BYTES = int(os.getenv("SSE_COALESCE_MAX_BYTES", "2048"))
 
 # --- Application Settings ---
 PROJECT_NAME = "PCBTool Backend"
 API_V1_STR = "/api/v1"
 
+# JSON responses larger than this many bytes are compressed (gzip, or brotli if
+# the optional `brotli` package is installed) when the client accepts it.
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+
 # --- Database Configuration ---
 # Using SQLite for development, PostgreSQL for production
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./pcbtool.db")
 
+# --- Sharded Storage (SQLite) ---
+# Spreads conversations and messages over several SQLite files so concurrent
+# users do not queue on one write lock; DATABASE_URL then only holds the users.
+# SHARD_MODE "user" gives every user a file of their own, "hash" buckets users
+# into SHARD_COUNT files, empty keeps everything in DATABASE_URL. Existing data
+# is moved with scripts/migrate_shards.py after changing these settings.
+SHARD_MODE = os.getenv("SHARD_MODE", "")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "16"))
+SHARD_DIR = os.getenv("SHARD_DIR", "shards")
+# Shard databases kept open at once; the least recently used are closed.
+SHARD_CACHE_SIZE = int(os.getenv("SHARD_CACHE_SIZE", "64"))
+
+# --- Group Commit ---
+# Opt-in write-behind queue for messages saved by the generation streams. One
+# writer thread inserts the messages of concurrent requests in a single
+# transaction, at most GROUP_COMMIT_MAX_LATENCY_MS after the first one arrived
+# or as soon as GROUP_COMMIT_MAX_BATCH are waiting. A request continues only
+# once its message is committed.
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "").lower() in ("1", "true", "yes", "on")
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))
+GROUP_COMMIT_MAX_LATENCY_MS = float(os.getenv("GROUP_COMMIT_MAX_LATENCY_MS", "5"))
+
 # --- User Settings ---
 # A default user for the prototype to associate data with
 DEFAULT_USER = "WPP_JKW"
@@ -38,3 +187,13 @@ DEFAULT_USER = "WPP_JKW"
 SECRET_KEY = os.getenv("SECRET_KEY", "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# Comma-separated usernames allowed to use admin-only features such as request profiling.
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
+# --- Request Profiling ---
+# Admins can profile a single request by sending `X-Profile: 1` (or `?profile=1`),
+# optionally with `X-Profile-Hz` (or `?profile_hz=`) to set the sampling rate.
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_DEFAULT_HZ = float(os.getenv("PROFILE_DEFAULT_HZ", "200"))
+PROFILE_MAX_HZ = float(os.getenv("PROFILE_MAX_HZ", "1000"))
@@ -0,0 +1,359 @@
+"""
+On-demand, per-request sampling profiler.
+
+A profile follows one request across every asyncio task it spawns (the SSE
+body of a StreamingResponse runs in a child task). A background thread samples
+each tracked task at a fixed rate:
+
+- a task that is running on the event loop thread contributes its real Python
+  stack (on-CPU time: JSON handling, synchronous DB commits, ...);
+- a suspended task contributes its await chain, ending in an
+  "[await ...]" leaf (off-CPU time: upstream waits, sleeps, locks).
+
+Explicit spans (`span`/`traced`) around service and crud calls are recorded
+as evented profiles next to the samples. The result is written in speedscope
+format, and can be converted to folded stacks for flamegraph.pl.
+
+Requests that are not profiled only pay for a ContextVar lookup per traced call
+and per task creation.
+"""
+import asyncio
+import contextvars
+import functools
+import gc
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, List
+
+from app.core.config import PROFILE_DIR
+
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("current_profile", default=None)
+
+_ASYNC_GEN_WRAPPERS = ("async_generator_asend", "async_generator_athrow")
+_MAX_STACK_DEPTH = 200
+
+
+class RequestProfile:
+    def __init__(self, request_id: str, name: str, hz: float, loop_thread_id: int):
+        self.request_id = request_id
+        self.name = name
+        self.interval = 1.0 / hz
+        self.loop_thread_id = loop_thread_id
+        self.started = time.perf_counter()
+        self.ended: float | None = None
+        self.tasks: Dict[asyncio.Task, str] = {}
+        self.samples: Dict[str, List[tuple]] = {}   # task label -> [(stack, weight)]
+        self.spans: Dict[str, List[tuple]] = {}     # task label -> [("O"|"C", name, at)]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{request_id}", daemon=True)
+
+    # --- task tracking -----------------------------------------------------
+
+    def track(self, task: asyncio.Task | None) -> None:
+        if task is not None and task not in self.tasks:
+            self.tasks[task] = f"task {len(self.tasks)}: {task.get_name()}"
+
+    def _label(self) -> str:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:  # called from a worker thread
+            return "thread"
+        self.track(task)
+        return self.tasks.get(task, "thread")
+
+    # --- spans -------------------------------------------------------------
+
+    def open_span(self, name: str) -> str:
+        label = self._label()
+        self.spans.setdefault(label, []).append(("O", name, time.perf_counter() - self.started))
+        return label
+
+    def close_span(self, label: str, name: str) -> None:
+        self.spans.setdefault(label, []).append(("C", name, time.perf_counter() - self.started))
+
+    # --- sampling ----------------------------------------------------------
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self.ended is None:
+            self.ended = time.perf_counter()
+            self._stop.set()
+            self._thread.join(timeout=1.0)
+
+    def _run(self) -> None:
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            try:
+                self._sample(now - last)
+            except Exception:
+                # The event loop mutates task state concurrently; skip torn samples.
+                pass
+            last = now
+
+    def _sample(self, weight: float) -> None:
+        thread_frame = sys._current_frames().get(self.loop_thread_id)
+        for task, label in list(self.tasks.items()):
+            if task.done():
+                continue
+            coro = task.get_coro()
+            if coro is None:
+                continue
+            if getattr(coro, "cr_running", False):
+                stack = _running_stack(thread_frame, coro.cr_frame)
+            else:
+                stack = _await_stack(coro)
+            if stack:
+                self.samples.setdefault(label, []).append((stack, weight))
+
+    # --- export ------------------------------------------------------------
+
+    def to_speedscope(self) -> Dict[str, Any]:
+        frames: List[Dict[str, Any]] = []
+        index: Dict[tuple, int] = {}
+
+        def frame_id(frame: tuple) -> int:
+            if frame not in index:
+                index[frame] = len(frames)
+                name, filename, line = frame
+                frames.append({"name": name, "file": filename, "line": line} if filename else {"name": name})
+            return index[frame]
+
+        end = (self.ended or time.perf_counter()) - self.started
+        profiles = []
+        for label, samples in self.samples.items():
+            profiles.append({
+                "type": "sampled",
+                "name": f"{label} (samples)",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weight for _, weight in samples),
+                "samples": [[frame_id(f) for f in stack] for stack, _ in samples],
+                "weights": [weight for _, weight in samples],
+            })
+        for label, events in self.spans.items():
+            profiles.append({
+                "type": "evented",
+                "name": f"{label} (spans)",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": end,
+                "events": _balanced_events(events, end, frame_id),
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"{self.name} [{self.request_id}]",
+            "exporter": "pcbtool-profiler",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+def _describe(frame) -> tuple:
+    code = frame.f_code
+    return (getattr(code, "co_qualname", code.co_name), code.co_filename, frame.f_lineno)
+
+
+def _running_stack(leaf, root_frame) -> List[tuple]:
+    """
+    The thread's stack from the task's coroutine frame down to the leaf, root first.
+    Empty if the coroutine frame is not on the stack (another task is running).
+    """
+    stack = []
+    frame = leaf
+    while frame is not None and len(stack) < _MAX_STACK_DEPTH:
+        stack.append(_describe(frame))
+        if frame is root_frame:
+            stack.reverse()
+            return stack
+        frame = frame.f_back
+    return []
+
+
+def _await_stack(awaitable) -> List[tuple]:
+    """
+    Follows a suspended coroutine through everything it awaits, including
+    async generators driven by `async for`, root first.
+    """
+    stack = []
+    obj = awaitable
+    while obj is not None and len(stack) < _MAX_STACK_DEPTH:
+        if inspect.iscoroutine(obj):
+            frame, obj = obj.cr_frame, obj.cr_await
+        elif inspect.isasyncgen(obj):
+            frame, obj = obj.ag_frame, obj.ag_await
+        elif inspect.isgenerator(obj):
+            frame, obj = obj.gi_frame, obj.gi_yieldfrom
+        elif type(obj).__name__ in _ASYNC_GEN_WRAPPERS:
+            # `__anext__()` wrappers do not expose their generator; the GC does.
+            obj = next((r for r in gc.get_referents(obj) if inspect.isasyncgen(r)), None)
+            continue
+        else:
+            stack.append((f"[await {type(obj).__name__}]", "", 0))
+            break
+        if frame is None:
+            break
+        stack.append(_describe(frame))
+    return stack
+
+
+def _balanced_events(events: List[tuple], end: float, frame_id) -> List[Dict[str, Any]]:
+    """
+    Speedscope needs properly nested open/close events; spans left open when
+    the request finished are closed at its end.
+    """
+    result = []
+    open_spans = []
+    for kind, name, at in events:
+        frame = frame_id((f"span {name}", "", 0))
+        if kind == "O":
+            open_spans.append(frame)
+            result.append({"type": "O", "frame": frame, "at": at})
+        elif frame in open_spans:
+            while open_spans:
+                top = open_spans.pop()
+                result.append({"type": "C", "frame": top, "at": at})
+                if top == frame:
+                    break
+    for frame in reversed(open_spans):
+        result.append({"type": "C", "frame": frame, "at": end})
+    return result
+
+
+# --- spans -------------------------------------------------------------------
+
+@contextmanager
+def span(name: str):
+    """
+    Records `name` as a span of the current request's profile, if any.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    label = profile.open_span(name)
+    try:
+        yield
+    finally:
+        profile.close_span(label, name)
+
+
+def traced(name: str):
+    """
+    Decorator form of `span` for functions, coroutine functions and async generators.
+    """
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            async def agen_wrapper(*args, **kwargs):
+                agen = func(*args, **kwargs)
+                try:
+                    if _current_profile.get() is None:
+                        async for item in agen:
+                            yield item
+                        return
+                    with span(name):
+                        async for item in agen:
+                            yield item
+                finally:
+                    # Close the wrapped generator now, not whenever it is collected.
+                    await agen.aclose()
+            return agen_wrapper
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _current_profile.get() is None:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_profile.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- lifecycle ---------------------------------------------------------------
+
+def _install_task_factory(loop: asyncio.AbstractEventLoop) -> None:
+    """
+    Makes every task created while a profile is active part of that profile.
+    """
+    previous = loop.get_task_factory()
+    if getattr(previous, "_profiling_factory", False):
+        return
+
+    def factory(loop, coro, **kwargs):
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        profile = _current_profile.get()
+        if profile is not None and profile.ended is None:
+            profile.track(task)
+        return task
+
+    factory._profiling_factory = True
+    loop.set_task_factory(factory)
+
+
+def start_profile(request_id: str, name: str, hz: float) -> tuple[RequestProfile, contextvars.Token]:
+    """
+    Starts profiling the current task and everything it spawns.
+    Must be called from the event loop thread.
+    """
+    loop = asyncio.get_running_loop()
+    _install_task_factory(loop)
+    profile = RequestProfile(request_id, name, hz, threading.get_ident())
+    profile.track(asyncio.current_task())
+    token = _current_profile.set(profile)
+    profile.start()
+    return profile, token
+
+
+def finish_profile(profile: RequestProfile, token: contextvars.Token) -> str:
+    """
+    Stops sampling and writes the speedscope file. Returns its path.
+    """
+    _current_profile.reset(token)
+    profile.stop()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path(profile.request_id)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profile.to_speedscope(), f)
+    return path
+
+
+def profile_path(request_id: str) -> str:
+    return os.path.join(PROFILE_DIR, f"{request_id}.speedscope.json")
+
+
+def to_folded(speedscope: Dict[str, Any]) -> str:
+    """
+    Converts the sampled profiles of a speedscope file to folded stacks
+    ("a;b;c <microseconds>" per line), the input format of flamegraph.pl.
+    """
+    frames = speedscope["shared"]["frames"]
+    totals: Dict[str, float] = {}
+    for profile in speedscope["profiles"]:
+        if profile["type"] != "sampled":
+            continue
+        root = profile["name"].replace(";", ":")
+        for stack, weight in zip(profile["samples"], profile["weights"]):
+            key = ";".join([root] + [frames[i]["name"].replace(";", ":") for i in stack])
+            totals[key] = totals.get(key, 0.0) + weight
+    return "\n".join(f"{stack} {int(weight * 1_000_000)}" for stack, weight in sorted(totals.items())) + "\n"
@@ -1,11 +1,18 @@
+from sqlalchemy import JSON, cast, delete, select, type_coerce, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from datetime import datetime
+from typing import Iterator, Sequence
 import json
 
-from . import models as db_models
+from . import models as db_models, sharding
 from app.models import schemas
+from app.core import profiling
 
-from app.services import security_service
+from app.services import security_service, search_service
 
+@profiling.traced("crud.get_user_by_username")
 def get_user_by_username(db: Session, username: str) -> db_models.User | None:
     """
     Retrieve a user from the database by their username.
@@ -43,21 +50,78 @@ def get_or_create_user(db: Session, username: str) -> db_models.User:
         db_user = create_user(db, schemas.UserCreate(username=username))
     return db_user
 
+def _route(db: Session, user_id: int | None) -> Session:
+    """
+    The shard router: returns the session holding the user's conversations
+    and messages. That is `db` itself unless sharded storage is enabled.
+    """
+    if not sharding.is_enabled():
+        return db
+    if user_id is None:
+        raise ValueError("user_id is required to route to a shard")
+    return sharding.session_for(db, user_id)
+
+def bump_user_version(db: Session, user_id: int) -> None:
+    """
+    Increment the user's data version inside the caller's transaction.
+    A single upsert, so concurrent first writes for a user cannot both insert.
+    """
+    Version = db_models.UserDataVersion
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        db.execute(
+            insert(Version)
+            .values(user_id=user_id, version=1, updated_at=func.now())
+            .on_conflict_do_update(
+                index_elements=[Version.user_id],
+                set_={"version": Version.version + 1, "updated_at": func.now()},
+            )
+        )
+        return
+    updated = db.query(Version).filter(Version.user_id == user_id).update(
+        {Version.version: Version.version + 1, Version.updated_at: func.now()},
+        synchronize_session=False,
+    )
+    if not updated:
+        db.add(Version(user_id=user_id, version=1))
+
+@profiling.traced("crud.get_user_version")
+def get_user_version(db: Session, user_id: int) -> tuple[int, datetime | None]:
+    """
+    Return the user's data version and the time of the last write.
+    """
+    db = _route(db, user_id)
+    row = db.query(db_models.UserDataVersion.version, db_models.UserDataVersion.updated_at).filter(
+        db_models.UserDataVersion.user_id == user_id
+    ).first()
+    if not row:
+        return 0, None
+    return row.version, row.updated_at
+
+@profiling.traced("crud.create_conversation")
 def create_conversation(db: Session, user_id: int, title: str = "New Conversation") -> db_models.Conversation:
     """
     Create a new conversation for a user.
     """
+    db = _route(db, user_id)
     db_conversation = db_models.Conversation(user_id=user_id, title=title)
     db.add(db_conversation)
+    db.flush()
+    search_service.index_conversation(db, db_conversation)
+    bump_user_version(db, user_id)
     db.commit()
     db.refresh(db_conversation)
     return db_conversation
 
-def create_message(db: Session, conversation_id: int, role: str, content: dict) -> db_models.Message:
+@profiling.traced("crud.create_message")
+def create_message(db: Session, conversation_id: int, role: str, content: dict, user_id: int | None = None) -> db_models.Message:
     """
     Create a new message in a conversation.
     The 'content' dictionary is converted to a JSON string for storage.
+    `user_id`, the conversation's owner, is required with sharded storage.
     """
+    db = _route(db, user_id)
     content_str = json.dumps(content)
     db_message = db_models.Message(
         conversation_id=conversation_id,
@@ -65,39 +129,264 @@ def create_message(db: Session, conversation_id: int, role: str, content: dict)
         content=content_str
     )
     db.add(db_message)
+    db.flush()
+    user_id = db.query(db_models.Conversation.user_id).filter(db_models.Conversation.id == conversation_id).scalar()
+    search_service.index_message(db, db_message, user_id)
+    bump_user_version(db, user_id)
     db.commit()
     db.refresh(db_message)
     return db_message
 
-def get_conversation(db: Session, conversation_id: int) -> db_models.Conversation | None:
+@profiling.traced("crud.create_messages")
+def create_messages(db: Session, rows: Sequence[dict]) -> list[db_models.Message | Exception]:
+    """
+    Inserts several messages with one commit per database (a single commit
+    unless storage is sharded). Each row holds conversation_id, role, content
+    and user_id, the conversation's owner. Used by the group-commit queue.
+    Returns one entry per row: the message, or the exception that rolled
+    back its database's group. Each group is committed before the next is
+    written, so the failed entries are exactly the rows to retry.
+    """
+    groups: dict[int, tuple[Session, list[int]]] = {}
+    for index, row in enumerate(rows):
+        target = _route(db, row["user_id"])
+        groups.setdefault(id(target), (target, []))[1].append(index)
+
+    results: list[db_models.Message | Exception] = [None] * len(rows)
+    for target, indexes in groups.values():
+        messages = [
+            db_models.Message(conversation_id=rows[i]["conversation_id"], role=rows[i]["role"], content=json.dumps(rows[i]["content"]))
+            for i in indexes
+        ]
+        try:
+            target.add_all(messages)
+            target.flush()
+            for i, db_message in zip(indexes, messages):
+                search_service.index_message(target, db_message, rows[i]["user_id"])
+            for user_id in {rows[i]["user_id"] for i in indexes}:
+                bump_user_version(target, user_id)
+            target.commit()
+        except Exception as e:
+            target.rollback()
+            for i in indexes:
+                results[i] = e
+        else:
+            for i, db_message in zip(indexes, messages):
+                results[i] = db_message
+    return results
+
+@profiling.traced("crud.update_message_content")
+def update_message_content(db: Session, message_id: int, content: dict, user_id: int | None = None) -> db_models.Message | None:
+    """
+    Replaces the content of an existing message, e.g. to attach a rendered
+    schematic once it is ready.
+    """
+    db = _route(db, user_id)
+    db_message = db.query(db_models.Message).filter(db_models.Message.id == message_id).first()
+    if not db_message:
+        return None
+    db_message.content = json.dumps(content)
+    user_id = db.query(db_models.Conversation.user_id).filter(db_models.Conversation.id == db_message.conversation_id).scalar()
+    search_service.index_message(db, db_message, user_id)
+    bump_user_version(db, user_id)
+    db.commit()
+    db.refresh(db_message)
+    return db_message
+
+@profiling.traced("crud.get_conversation")
+def get_conversation(db: Session, conversation_id: int, user_id: int | None = None) -> db_models.Conversation | None:
     """
     Retrieve a conversation by its ID.
     """
+    db = _route(db, user_id)
     return db.query(db_models.Conversation).filter(db_models.Conversation.id == conversation_id).first()
 
-def get_message(db: Session, message_id: int) -> db_models.Message | None:
+@profiling.traced("crud.set_dify_conversation_id")
+def set_dify_conversation_id(db: Session, conversation_id: int, dify_conversation_id: str | None, user_id: int | None = None) -> None:
+    """
+    Records (or clears) the upstream Dify conversation of a conversation.
+    """
+    db = _route(db, user_id)
+    db.query(db_models.Conversation).filter(db_models.Conversation.id == conversation_id).update(
+        {db_models.Conversation.dify_conversation_id: dify_conversation_id}, synchronize_session=False
+    )
+    db.commit()
+
+@profiling.traced("crud.get_message")
+def get_message(db: Session, message_id: int, user_id: int | None = None) -> db_models.Message | None:
     """
     Retrieve a message by its ID.
     """
+    db = _route(db, user_id)
     return db.query(db_models.Message).filter(db_models.Message.id == message_id).first()
 
+@profiling.traced("crud.get_messages_by_conversation")
+def get_messages_by_conversation(db: Session, conversation_id: int, user_id: int | None = None) -> list[db_models.Message]:
+    """
+    Retrieve all messages of a conversation, oldest first.
+    """
+    db = _route(db, user_id)
+    return db.query(db_models.Message).filter(db_models.Message.conversation_id == conversation_id).order_by(db_models.Message.id).all()
+
+@profiling.traced("crud.get_conversations_by_user")
 def get_conversations_by_user(db: Session, user_id: int) -> list[db_models.Conversation]:
     """
     Retrieve all conversations for a specific user, ordered by creation date.
     """
+    db = _route(db, user_id)
     return db.query(db_models.Conversation).filter(db_models.Conversation.user_id == user_id).order_by(db_models.Conversation.created_at.desc()).all()
 
-def delete_conversation(db: Session, conversation_id: int, user_id: int) -> db_models.Conversation | None:
+@profiling.traced("crud.delete_conversation")
+def delete_conversation(db: Session, conversation_id: int, user_id: int) -> bool:
     """
     Deletes a conversation by its ID, ensuring it belongs to the user.
+    Returns whether it existed.
     """
-    db_conversation = db.query(db_models.Conversation).filter(
-        db_models.Conversation.id == conversation_id,
-        db_models.Conversation.user_id == user_id
-    ).first()
-    
-    if db_conversation:
-        db.delete(db_conversation)
-        db.commit()
-    
-    return db_conversation
+    return bool(delete_conversations(db, [conversation_id], user_id))
+
+@profiling.traced("crud.delete_conversations")
+def delete_conversations(db: Session, conversation_ids: Sequence[int], user_id: int) -> list[int]:
+    """
+    Deletes the user's conversations among `conversation_ids` with a single
+    DELETE; their messages go with them through ON DELETE CASCADE, without
+    being loaded. Returns the ids that were deleted.
+    """
+    db = _route(db, user_id)
+    Conversation = db_models.Conversation
+    owned = [row[0] for row in db.execute(
+        select(Conversation.id).where(Conversation.id.in_(list(conversation_ids)), Conversation.user_id == user_id)
+    )]
+    if not owned:
+        return []
+    search_service.remove_conversations(db, owned)
+    db.execute(
+        delete(Conversation).where(Conversation.id.in_(owned), Conversation.user_id == user_id),
+        execution_options={"synchronize_session": False},
+    )
+    bump_user_version(db, user_id)
+    db.commit()
+    return owned
+
+def _content_type(db: Session):
+    """
+    The "type" of a message's JSON content as an SQL expression.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        # content is a TEXT column; Postgres only has ->> on json/jsonb.
+        return cast(db_models.Message.content, postgresql.JSONB)["type"].astext
+    return type_coerce(db_models.Message.content, JSON)["type"].as_string()
+
+@profiling.traced("crud.delete_expired_messages")
+def delete_expired_messages(db: Session, message_type: str, cutoff: datetime, after_id: int = 0, limit: int = 500) -> tuple[int, int | None]:
+    """
+    Deletes up to `limit` messages of `message_type` created before `cutoff`,
+    scanning by id from `after_id`. Returns the number deleted and the id to
+    resume from (None once the scan is complete). Commits, so each batch
+    holds the write lock only briefly. Covers the database `db` is bound to;
+    with sharded storage, maintenance calls it once per shard.
+    """
+    Message, Conversation = db_models.Message, db_models.Conversation
+    rows = db.execute(
+        select(Message.id, Conversation.user_id)
+        .join(Conversation, Message.conversation_id == Conversation.id)
+        .where(
+            Message.id > after_id,
+            Message.created_at < cutoff,
+            _content_type(db) == message_type,
+        )
+        .order_by(Message.id)
+        .limit(limit)
+    ).all()
+    if not rows:
+        return 0, None
+
+    message_ids = [row[0] for row in rows]
+    search_service.remove_rowids(db, message_ids)
+    db.execute(delete(Message).where(Message.id.in_(message_ids)), execution_options={"synchronize_session": False})
+    for user_id in {row[1] for row in rows}:
+        bump_user_version(db, user_id)
+    db.commit()
+    return len(message_ids), (message_ids[-1] if len(rows) == limit else None)
+
+@profiling.traced("crud.clear_media_references")
+def clear_media_references(db: Session, message_type: str, field: str, file_names: set[str],
+                           after_id: int = 0, limit: int = 500) -> tuple[int, int | None]:
+    """
+    Sets `data[field]` to None in messages of `message_type` whose URL (or
+    dict of URLs) there points at one of `file_names`, scanning up to `limit`
+    messages by id from `after_id`. Returns the number changed and the id to
+    resume from (None once the scan is complete). Commits.
+    """
+    Message, Conversation = db_models.Message, db_models.Conversation
+    rows = db.execute(
+        select(Message.id, Message.content, Conversation.user_id)
+        .join(Conversation, Message.conversation_id == Conversation.id)
+        .where(Message.id > after_id, _content_type(db) == message_type)
+        .order_by(Message.id)
+        .limit(limit)
+    ).all()
+    if not rows:
+        return 0, None
+
+    changed, changed_users = 0, set()
+    for message_id, raw_content, user_id in rows:
+        content = json.loads(raw_content)
+        data = content.get("data") or {}
+        value = data.get(field)
+        urls = value.values() if isinstance(value, dict) else [value]
+        if any(isinstance(url, str) and url.rsplit("/", 1)[-1] in file_names for url in urls):
+            data[field] = None
+            db.execute(update(Message).where(Message.id == message_id).values(content=json.dumps(content)),
+                       execution_options={"synchronize_session": False})
+            changed += 1
+            changed_users.add(user_id)
+    for user_id in changed_users:
+        bump_user_version(db, user_id)
+    db.commit()
+    return changed, (rows[-1][0] if len(rows) == limit else None)
+
+@profiling.traced("crud.search_conversations")
+def search_conversations(db: Session, user_id: int, query: str, limit: int = 20, offset: int = 0) -> tuple[list[dict], bool]:
+    """
+    Full-text search over the user's conversation titles, requirement documents,
+    BOM part numbers and generated code.
+    """
+    db = _route(db, user_id)
+    return search_service.search(db, user_id=user_id, query=query, limit=limit, offset=offset)
+
+def iter_export_rows(db: Session, user_id: int, since: datetime | None = None, until: datetime | None = None,
+                     conversation_ids: Sequence[int] | None = None, chunk_size: int = 1000) -> Iterator[tuple]:
+    """
+    Streams (conversation id, title, created_at, message id, role, content,
+    message created_at) rows of a user's history, ordered by conversation and
+    message. Rows are fetched `chunk_size` at a time (a server-side cursor on
+    PostgreSQL), so memory does not grow with the size of the history.
+    Conversations without messages are included unless a date filter is set;
+    their message columns are None.
+    """
+    db = _route(db, user_id)
+    Conversation, Message = db_models.Conversation, db_models.Message
+    date_filtered = since is not None or until is not None
+    query = select(
+        Conversation.id, Conversation.title, Conversation.created_at,
+        Message.id, Message.role, Message.content, Message.created_at,
+    )
+    if date_filtered:
+        query = query.join(Message, Message.conversation_id == Conversation.id)
+    else:
+        query = query.outerjoin(Message, Message.conversation_id == Conversation.id)
+    query = query.where(Conversation.user_id == user_id)
+    if since is not None:
+        query = query.where(Message.created_at >= since)
+    if until is not None:
+        query = query.where(Message.created_at < until)
+    if conversation_ids:
+        query = query.where(Conversation.id.in_(list(conversation_ids)))
+    query = query.order_by(Conversation.id, Message.id).execution_options(yield_per=chunk_size)
+
+    result = db.execute(query)
+    try:
+        for row in result:
+            yield tuple(row)
+    finally:
+        result.close()
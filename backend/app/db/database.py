@@ -1,13 +1,39 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from app.core.config import DATABASE_URL
 
 engine = create_engine(
     DATABASE_URL, 
-    connect_args={"check_same_thread": False} # Needed for SQLite
+    # Needed for SQLite; other drivers reject the option.
+    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to.
+    cursor.execute("PRAGMA foreign_keys = ON")
+    # Lets maintenance return freed pages with `PRAGMA incremental_vacuum`.
+    # Takes effect on new databases, or on existing ones after a full VACUUM.
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.close()
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", configure_sqlite)
+
+class RoutingSession(Session):
+    """
+    A session on the main database. With sharded storage, `crud` opens
+    sessions on shard databases through it (see sharding.py); they are
+    closed together with this session.
+    """
+
+    def close(self) -> None:
+        for shard_session in self.info.pop("shard_sessions", {}).values():
+            shard_session.close()
+        super().close()
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, class_=RoutingSession)
 
 Base = declarative_base()
 
@@ -0,0 +1,76 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+
+from . import models as db_models
+
+
+def upgrade_schema(engine: Engine) -> None:
+    """
+    Brings databases created by older versions up to date. `create_all`
+    only creates missing tables, so indexes and constraints introduced since
+    are added here. Every step is a no-op once applied.
+    """
+    _add_conversation_columns(engine)
+    for table in db_models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    _add_message_cascade(engine)
+
+
+def _add_conversation_columns(engine: Engine) -> None:
+    """
+    Adds the nullable columns introduced since the conversations table was
+    first created.
+    """
+    existing = {column["name"] for column in inspect(engine).get_columns("conversations")}
+    if "dify_conversation_id" not in existing:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE conversations ADD COLUMN dify_conversation_id VARCHAR"))
+        print("✅ Added conversations.dify_conversation_id")
+
+
+def _add_message_cascade(engine: Engine) -> None:
+    """
+    Makes messages.conversation_id ON DELETE CASCADE, so deleting
+    conversations is a single statement.
+    """
+    foreign_keys = inspect(engine).get_foreign_keys("messages")
+    fk = next((fk for fk in foreign_keys if fk["referred_table"] == "conversations"), None)
+    if fk is None or (fk.get("options") or {}).get("ondelete", "").upper() == "CASCADE":
+        return
+
+    if engine.dialect.name == "sqlite":
+        _rebuild_sqlite_messages(engine)
+    else:
+        name = fk["name"]
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"ALTER TABLE messages DROP CONSTRAINT {name}, "
+                f"ADD CONSTRAINT {name} FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE"
+            ))
+    print("✅ Added ON DELETE CASCADE to messages.conversation_id")
+
+
+def _rebuild_sqlite_messages(engine: Engine) -> None:
+    """
+    SQLite cannot alter a constraint: rebuild the table with the current
+    definition and copy the rows over. Messages whose conversation no longer
+    exists (possible while foreign keys were not enforced) are dropped.
+    """
+    table = db_models.Message.__table__
+    columns = ", ".join(column.name for column in table.columns)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE messages RENAME TO messages_old"))
+        for index in table.indexes:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        table.create(bind=conn)
+        conn.execute(text(
+            f"INSERT INTO messages ({columns}) SELECT {columns} FROM messages_old "
+            "WHERE conversation_id IN (SELECT id FROM conversations)"
+        ))
+        orphans = conn.execute(text(
+            "SELECT COUNT(*) FROM messages_old WHERE conversation_id NOT IN (SELECT id FROM conversations)"
+        )).scalar()
+        conn.execute(text("DROP TABLE messages_old"))
+    if orphans:
+        print(f"⚠️ Dropped {orphans} orphaned messages while rebuilding the messages table")
@@ -14,6 +14,17 @@ class User(Base):
 
     conversations = relationship("Conversation", back_populates="user")
 
+class UserDataVersion(Base):
+    """
+    A per-user counter bumped on every conversation or message write.
+    Used to answer conditional history requests without reading messages.
+    """
+    __tablename__ = "user_data_versions"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
 class Conversation(Base):
     __tablename__ = "conversations"
 
@@ -21,15 +32,19 @@ class Conversation(Base):
     title = Column(String, index=True, default="New Conversation")
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # The Dify chat conversation holding the code agent's context, so code
+    # refinements can send only the new instruction.
+    dify_conversation_id = Column(String, nullable=True)
 
     user = relationship("User", back_populates="conversations")
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    # Messages are removed by the ON DELETE CASCADE foreign key, not loaded and deleted one by one.
+    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", passive_deletes=True)
 
 class Message(Base):
     __tablename__ = "messages"
 
     id = Column(Integer, primary_key=True, index=True)
-    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False, index=True)
     role = Column(String, nullable=False)  # "user" or "assistant"
     
     # Storing structured content as a JSON string (or Text).
@@ -42,6 +57,10 @@ class Message(Base):
 
     conversation = relationship("Conversation", back_populates="messages")
 
+    # created_at comes back with the INSERT (RETURNING), so batched inserts
+    # need no refresh per message.
+    __mapper_args__ = {"eager_defaults": True}
+
     def to_dict(self):
         """Helper to convert model to dict, parsing JSON content."""
         return {
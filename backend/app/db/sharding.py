@@ -0,0 +1,242 @@
+"""
+Sharded SQLite storage for conversations and messages.
+
+With SHARD_MODE set, every user's conversations, messages, data version and
+search entries live in a shard file under SHARD_DIR: one per user ("user") or
+one of SHARD_COUNT buckets ("hash"). The main database keeps the users table.
+Each shard also holds a copy of its users' rows (without the password hash)
+so foreign keys keep working inside the shard.
+
+Shard engines are opened on demand and kept in a bounded LRU; `crud` routes
+through `session_for`.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import create_engine, delete, event, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.core.config import SHARD_MODE, SHARD_COUNT, SHARD_DIR, SHARD_CACHE_SIZE
+from app.services import search_service
+from . import migrations, models as db_models
+from .database import configure_sqlite
+
+SHARD_MODES = {"user", "hash"}
+SHARD_SUFFIX = ".db"
+
+
+def is_enabled() -> bool:
+    return SHARD_MODE in SHARD_MODES
+
+
+def shard_key(user_id: int, mode: str = SHARD_MODE, count: int = SHARD_COUNT) -> str:
+    """
+    Names the shard holding `user_id`'s data under the given layout.
+    """
+    if mode == "user":
+        return f"user-{user_id}"
+    return f"hash-{zlib.crc32(str(user_id).encode()) % count:04d}"
+
+
+def shard_path(key: str) -> str:
+    return os.path.join(SHARD_DIR, key + SHARD_SUFFIX)
+
+
+def existing_shard_keys() -> List[str]:
+    if not os.path.isdir(SHARD_DIR):
+        return []
+    return sorted(name[:-len(SHARD_SUFFIX)] for name in os.listdir(SHARD_DIR) if name.endswith(SHARD_SUFFIX))
+
+
+class ShardCache:
+    """
+    A bounded LRU of shard engines. Evicted engines are disposed, which closes
+    their idle connection; sessions still using one keep working and close
+    their connection when they end.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self._engines: "OrderedDict[str, Engine]" = OrderedDict()
+        # Users whose row is known to be mirrored into an open shard.
+        self._mirrored: Dict[str, set] = {}
+        # Shards whose schema was checked by this process.
+        self._initialized: set = set()
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.evicted = 0
+
+    def get(self, key: str) -> Engine:
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None:
+                self._engines.move_to_end(key)
+                return engine
+            engine = self._open(key)
+            self._engines[key] = engine
+            self._mirrored[key] = set()
+            self.opened += 1
+            while len(self._engines) > self.capacity:
+                old_key, old_engine = self._engines.popitem(last=False)
+                self._mirrored.pop(old_key, None)
+                old_engine.dispose()
+                self.evicted += 1
+            return engine
+
+    def _open(self, key: str) -> Engine:
+        os.makedirs(SHARD_DIR, exist_ok=True)
+        # One pooled connection per shard; bursts open short-lived overflow connections.
+        engine = create_engine(f"sqlite:///{shard_path(key)}", connect_args={"check_same_thread": False}, pool_size=1)
+        event.listen(engine, "connect", configure_sqlite)
+        if key not in self._initialized:
+            db_models.Base.metadata.create_all(bind=engine)
+            migrations.upgrade_schema(engine)
+            search_service.init_search_index(engine)
+            self._initialized.add(key)
+        return engine
+
+    def mirror_user(self, key: str, user_id: int, db: Session) -> None:
+        """
+        Copies the user's row from the main database into the shard once.
+        """
+        mirrored = self._mirrored.get(key)
+        if mirrored is not None and user_id in mirrored:
+            return
+        username = db.query(db_models.User.username).filter(db_models.User.id == user_id).scalar()
+        if username is None:
+            return
+        with self.get(key).begin() as conn:
+            conn.execute(
+                sqlite_insert(db_models.User.__table__)
+                .values(id=user_id, username=username, hashed_password="")
+                .on_conflict_do_nothing()
+            )
+        self._mirrored.setdefault(key, set()).add(user_id)
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            engine = self._engines.pop(key, None)
+            self._mirrored.pop(key, None)
+            self._initialized.discard(key)
+        if engine is not None:
+            engine.dispose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": SHARD_MODE if is_enabled() else "single",
+            "open": len(self._engines),
+            "capacity": self.capacity,
+            "opened": self.opened,
+            "evicted": self.evicted,
+        }
+
+
+shards = ShardCache(SHARD_CACHE_SIZE)
+
+
+def session_for(db: Session, user_id: int) -> Session:
+    """
+    Returns the session on `user_id`'s shard, opened alongside `db` (a
+    session on the main database) and closed with it.
+    """
+    key = shard_key(user_id)
+    shards.mirror_user(key, user_id, db)
+    sessions = db.info.setdefault("shard_sessions", {})
+    session = sessions.get(key)
+    if session is None:
+        session = Session(bind=shards.get(key), autoflush=False, expire_on_commit=db.expire_on_commit)
+        sessions[key] = session
+    return session
+
+
+def move_user(user_id: int, username: str, source: Engine, target: Engine, mirror: bool = True) -> Tuple[int, int]:
+    """
+    Moves a user's conversations, messages and data version from `source` to
+    `target` and indexes them there. Ids are kept unless they collide with
+    rows already in `target`, in which case the moved rows are renumbered.
+    The target is committed before the source is cleared, so an interrupted
+    move leaves a copy behind rather than losing data. Returns the number of
+    conversations and messages moved.
+    """
+    Conversation, Message, Version = db_models.Conversation, db_models.Message, db_models.UserDataVersion
+    conversation_table, message_table = Conversation.__table__, Message.__table__
+    with Session(source) as src, Session(target) as dst:
+        conversations = [dict(row) for row in src.execute(
+            select(conversation_table).where(Conversation.user_id == user_id).order_by(Conversation.id)
+        ).mappings()]
+        if not conversations:
+            return 0, 0
+        conversation_ids = [row["id"] for row in conversations]
+        user_messages = select(message_table).join(Conversation, Message.conversation_id == Conversation.id).where(Conversation.user_id == user_id)
+        message_ids = [row[0] for row in src.execute(select(user_messages.subquery().c.id))]
+        keep_ids = not (_any_taken(dst, Conversation.id, conversation_ids) or _any_taken(dst, Message.id, message_ids))
+
+        if mirror:
+            dst.execute(
+                sqlite_insert(db_models.User.__table__)
+                .values(id=user_id, username=username, hashed_password="")
+                .on_conflict_do_nothing()
+            )
+        id_map = {}
+        if keep_ids:
+            dst.execute(insert(conversation_table), conversations)
+        else:
+            for row in conversations:
+                old_id = row.pop("id")
+                id_map[old_id] = dst.execute(insert(conversation_table).values(row)).inserted_primary_key[0]
+        result = src.execute(user_messages.order_by(Message.id).execution_options(yield_per=1000)).mappings()
+        for chunk in result.partitions():
+            rows = [dict(row) for row in chunk]
+            if not keep_ids:
+                for row in rows:
+                    del row["id"]
+                    row["conversation_id"] = id_map[row["conversation_id"]]
+            dst.execute(insert(message_table), rows)
+
+        # Past ETags from either location must not match the moved history.
+        versions = [db.query(Version.version).filter(Version.user_id == user_id).scalar() or 0 for db in (src, dst)]
+        dst.execute(delete(Version).where(Version.user_id == user_id))
+        dst.add(Version(user_id=user_id, version=max(versions) + 1))
+
+        moved_ids = list(id_map.values()) if id_map else conversation_ids
+        for conversation in dst.execute(select(Conversation.id, Conversation.user_id, Conversation.title).where(Conversation.id.in_(moved_ids))):
+            search_service.index_conversation(dst, conversation)
+        moved_messages = dst.execute(
+            select(Message.id, Message.conversation_id, Message.content)
+            .join(Conversation, Message.conversation_id == Conversation.id)
+            .where(Conversation.user_id == user_id)
+        )
+        for message in moved_messages:
+            search_service.index_message(dst, message, user_id)
+        dst.commit()
+
+        search_service.remove_conversations(src, conversation_ids)
+        src.execute(delete(Conversation).where(Conversation.user_id == user_id), execution_options={"synchronize_session": False})
+        src.execute(delete(Version).where(Version.user_id == user_id))
+        src.commit()
+    return len(conversations), len(message_ids)
+
+
+def _any_taken(db: Session, column, ids: List[int]) -> bool:
+    for start in range(0, len(ids), 500):
+        if db.execute(select(column).where(column.in_(ids[start:start + 500])).limit(1)).first():
+            return True
+    return False
+
+
+def conversation_owners(engine: Engine) -> List[int]:
+    """
+    Returns the ids of the users with conversations in a database.
+    """
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(select(db_models.Conversation.user_id).distinct())]
+
+
+def count_conversations(engine: Engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(db_models.Conversation)).scalar()
@@ -0,0 +1,157 @@
+"""
+Group commit for message inserts.
+
+Every `crud.create_message` is its own transaction, so each saved message
+costs a commit (an fsync). With GROUP_COMMIT enabled, the generation streams
+hand their messages to a single writer thread instead, which inserts whatever
+has arrived within GROUP_COMMIT_MAX_LATENCY_MS (or GROUP_COMMIT_MAX_BATCH
+rows) in one transaction. `save_message` returns only once the batch holding
+the message has committed, so a stream still sends `final_message` for
+durable data only.
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.core.config import GROUP_COMMIT, GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_LATENCY_MS
+from . import crud, models as db_models
+from .database import SessionLocal
+
+_STOP = object()
+
+
+class GroupCommitQueue:
+    """
+    Collects message rows from any thread and writes them in batches on a
+    dedicated thread. Each submitted row gets a Future that resolves to the
+    detached, committed Message.
+    """
+
+    def __init__(self, max_batch: int, max_latency: float):
+        self.max_batch = max(1, max_batch)
+        self.max_latency = max_latency
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self.batches = 0
+        self.rows = 0
+        self.largest_batch = 0
+        self.failed_batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Writes everything already queued, then stops the writer thread.
+        """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, row: Dict[str, Any]) -> Future:
+        future: Future = Future()
+        self._queue.put((row, future))
+        return future
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch: List[Tuple[Dict[str, Any], Future]]) -> None:
+        try:
+            results = self._insert([row for row, _ in batch])
+        except Exception as e:  # e.g. no connection; nothing was committed
+            results = [e] * len(batch)
+        failed = [index for index, result in enumerate(results) if isinstance(result, Exception)]
+        self.batches += 1
+        self.rows += len(batch) - len(failed)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        if failed and len(batch) > 1:
+            # One bad row (e.g. a conversation deleted meanwhile) must not fail
+            # the others: retry the rows of the groups that did not commit,
+            # one by one. Rows of committed groups are never written twice.
+            print(f"⚠️ Group commit of {len(failed)} of {len(batch)} messages failed, retrying individually: {results[failed[0]]}")
+            self.failed_batches += 1
+            for index in failed:
+                try:
+                    results[index] = self._insert([batch[index][0]])[0]
+                except Exception as row_error:
+                    results[index] = row_error
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def _insert(rows: List[Dict[str, Any]]) -> List[db_models.Message | Exception]:
+        # Committed objects stay loaded so callers can use them after the session closes.
+        db: Session = SessionLocal(expire_on_commit=False)
+        try:
+            return crud.create_messages(db, rows)
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.running,
+            "batches": self.batches,
+            "rows": self.rows,
+            "average_batch": round(self.rows / self.batches, 2) if self.batches else 0,
+            "largest_batch": self.largest_batch,
+            "failed_batches": self.failed_batches,
+            "queued": self._queue.qsize(),
+        }
+
+
+message_queue = GroupCommitQueue(GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_LATENCY_MS / 1000)
+
+
+def start() -> None:
+    if GROUP_COMMIT:
+        message_queue.start()
+
+
+def stop() -> None:
+    message_queue.stop()
+
+
+async def save_message(db: Session, conversation_id: int, role: str, content: dict, user_id: int) -> db_models.Message:
+    """
+    Saves a message and returns it once committed: through the group-commit
+    queue when it is running, otherwise directly with `crud.create_message`.
+    """
+    if not message_queue.running:
+        return crud.create_message(db, conversation_id=conversation_id, role=role, content=content, user_id=user_id)
+    row = {"conversation_id": conversation_id, "role": role, "content": content, "user_id": user_id}
+    return await asyncio.wrap_future(message_queue.submit(row))
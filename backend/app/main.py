@@ -3,12 +3,17 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 from app.core.config import PROJECT_NAME
-from app.db import models
+from app.db import models, migrations, write_queue
 from app.db.database import engine
 from app.api.endpoints import api_router
+from app.api.websocket import ws_router
+from app.api.profiling_middleware import ProfilingMiddleware
+from app.services import search_service, render_service, maintenance_service
 
 # Create all database tables
 models.Base.metadata.create_all(bind=engine)
+migrations.upgrade_schema(engine)
+search_service.init_search_index(engine)
 
 app = FastAPI(title=PROJECT_NAME)
 
@@ -32,9 +37,43 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id"],
 )
 
+# Admin opt-in request profiling; a pass-through for every other request.
+app.add_middleware(ProfilingMiddleware)
+
 app.include_router(api_router, prefix="/api/v1")
+# Multiplexed generation streams; the SSE endpoints above remain available.
+app.include_router(ws_router, prefix="/api/v1")
+
+@app.on_event("startup")
+async def start_schematic_renderer():
+    # Start the sandboxed render workers now rather than on the first schematic.
+    render_service.renderer.start()
+
+@app.on_event("startup")
+async def start_maintenance():
+    # Retention policies and incremental compaction, in small background batches.
+    maintenance_service.start()
+
+@app.on_event("startup")
+async def start_message_write_queue():
+    # Group commit for message inserts, when GROUP_COMMIT is enabled.
+    write_queue.start()
+
+@app.on_event("shutdown")
+async def stop_message_write_queue():
+    # Writes the messages still queued before the process exits.
+    write_queue.stop()
+
+@app.on_event("shutdown")
+async def stop_schematic_renderer():
+    render_service.renderer.shutdown()
+
+@app.on_event("shutdown")
+async def stop_maintenance():
+    await maintenance_service.stop()
 
 @app.get("/")
 async def root():
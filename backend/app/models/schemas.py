@@ -1,7 +1,9 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
+from app.core.config import BULK_DELETE_MAX_IDS
+
 # --- Message Schemas ---
 
 class MessageContent(BaseModel):
@@ -47,6 +49,29 @@ class Conversation(ConversationBase):
     class Config:
         from_attributes = True
 
+class ConversationBulkDelete(BaseModel):
+    conversation_ids: List[int] = Field(..., min_length=1, max_length=BULK_DELETE_MAX_IDS)
+
+class ConversationBulkDeleteResult(BaseModel):
+    deleted: List[int]
+    not_found: List[int]
+
+# --- Search Schemas ---
+
+class SearchHit(BaseModel):
+    conversation_id: int
+    conversation_title: Optional[str]
+    message_id: Optional[int]
+    kind: str
+    snippet: str
+
+class SearchResults(BaseModel):
+    query: str
+    limit: int
+    offset: int
+    has_more: bool
+    hits: List[SearchHit]
+
 # --- User Schemas ---
 
 class UserBase(BaseModel):
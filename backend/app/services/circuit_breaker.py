@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, Any, List, NamedTuple
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a call is rejected because the breaker is open.
+    """
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open; retry after {retry_after:.0f}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class Admission(NamedTuple):
+    """
+    What `before_call` admitted: the breaker epoch at that moment and whether
+    the call is a half-open probe. Pass it back to `record` / `release`.
+    """
+    epoch: int
+    probe: bool
+
+
+class CircuitBreaker:
+    """
+    A rolling-window circuit breaker.
+
+    Every call outcome is recorded with its latency. When the share of failed or
+    slow calls in the window exceeds the threshold (and enough calls were seen),
+    the breaker opens and rejects calls for `open_seconds`. It then lets a small
+    number of probe calls through (half-open): a successful probe closes it
+    again, a failed one re-opens it.
+
+    Every state change starts a new epoch. Outcomes are only counted for calls
+    admitted in the current epoch, so a slow call admitted while closed cannot
+    decide a half-open probe (or count towards a later closed window).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = 60.0,
+        min_requests: int = 5,
+        error_rate_threshold: float = 0.5,
+        slow_call_seconds: float = 20.0,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._calls: deque = deque()  # (timestamp, ok, latency)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._epoch = 0
+        self._times_opened = 0
+        self._rejected = 0
+
+    def _prune(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._epoch += 1
+        return self._state
+
+    def _open(self, now: float) -> None:
+        self._state = OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self._epoch += 1
+        self._times_opened += 1
+
+    def before_call(self) -> Admission:
+        """
+        Reserves a call slot, raising CircuitOpenError when the call must fail fast.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == CLOSED:
+                return Admission(self._epoch, probe=False)
+            if state == HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return Admission(self._epoch, probe=True)
+            self._rejected += 1
+            if state == OPEN:
+                retry_after = self.open_seconds - (now - self._opened_at)
+            else:
+                retry_after = self.open_seconds
+            raise CircuitOpenError(self.name, max(retry_after, 1.0))
+
+    def record(self, admission: Admission, ok: bool, latency: float) -> None:
+        """
+        Records the outcome of a call that was admitted by `before_call`.
+
+        Calls admitted before the last state change are ignored: their outcome
+        says nothing about the upstream since the breaker opened or closed.
+        """
+        now = time.monotonic()
+        slow = latency >= self.slow_call_seconds
+        with self._lock:
+            state = self._current_state(now)
+            if admission.epoch != self._epoch:
+                return
+            if state == HALF_OPEN:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+                if ok and not slow:
+                    self._state = CLOSED
+                    self._epoch += 1
+                    self._calls.clear()
+                else:
+                    self._open(now)
+                return
+
+            self._calls.append((now, ok, latency))
+            self._prune(now)
+            if state == CLOSED and len(self._calls) >= self.min_requests:
+                bad = sum(1 for _, call_ok, call_latency in self._calls
+                          if not call_ok or call_latency >= self.slow_call_seconds)
+                if bad / len(self._calls) >= self.error_rate_threshold:
+                    self._open(now)
+
+    def release(self, admission: Admission) -> None:
+        """
+        Gives back a call slot without recording an outcome (e.g. the caller went away).
+        """
+        with self._lock:
+            if admission.probe and admission.epoch == self._epoch and self._state == HALF_OPEN:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            self._prune(now)
+            total = len(self._calls)
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            slow = sum(1 for _, ok, latency in self._calls if ok and latency >= self.slow_call_seconds)
+            latencies = sorted(latency for _, _, latency in self._calls)
+            return {
+                "name": self.name,
+                "state": state,
+                "window_calls": total,
+                "window_failures": failures,
+                "window_slow_calls": slow,
+                "error_rate": round((failures + slow) / total, 3) if total else 0.0,
+                "p50_latency": round(latencies[total // 2], 3) if total else None,
+                "retry_after": round(max(self.open_seconds - (now - self._opened_at), 0.0), 1) if state == OPEN else 0.0,
+                "times_opened": self._times_opened,
+                "rejected_calls": self._rejected,
+            }
+
+
+_registry: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name: str, **settings) -> CircuitBreaker:
+    """
+    Returns the breaker registered under `name`, creating it on first use.
+    """
+    with _registry_lock:
+        breaker = _registry.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, **settings)
+            _registry[name] = breaker
+        return breaker
+
+
+def snapshot_all() -> List[Dict[str, Any]]:
+    with _registry_lock:
+        breakers = list(_registry.values())
+    return [breaker.snapshot() for breaker in breakers]
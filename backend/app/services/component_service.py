@@ -2,6 +2,8 @@ import pandas as pd
 import io
 from typing import Dict, Any, List, Tuple
 
+from app.core import profiling
+
 def extract_csv_from_text(text: str) -> str | None:
     """
     Extracts CSV content from a markdown-like text block.
@@ -24,6 +26,7 @@ def extract_csv_from_text(text: str) -> str | None:
     except Exception:
         return None
 
+@profiling.traced("component_service.analyze_bom_data")
 def analyze_bom_data(bom_text: str) -> Tuple[str, pd.DataFrame]:
     """
     Analyzes the BOM text, extracts CSV data, and returns a status message
@@ -62,6 +65,7 @@ def analyze_bom_data(bom_text: str) -> Tuple[str, pd.DataFrame]:
         empty_df = pd.DataFrame(columns=["器件名称", "单价", "数量", "总价"])
         return error_msg, empty_df
 
+@profiling.traced("component_service.search_components_in_store")
 def search_components_in_store(df: pd.DataFrame, store_name: str) -> pd.DataFrame:
     """
     Simulates searching for components in a specific store.
@@ -81,6 +85,7 @@ def search_components_in_store(df: pd.DataFrame, store_name: str) -> pd.DataFram
     
     return df_copy
 
+@profiling.traced("component_service.calculate_total_price")
 def calculate_total_price(df: pd.DataFrame) -> float:
     """
     Calculates the total price from the DataFrame.
@@ -1,6 +1,10 @@
 import requests
 import json
 import os
+import math
+import time
+import random
+import asyncio
 import mimetypes
 from typing import Callable, Dict, Any, AsyncGenerator
 import httpx
@@ -10,50 +14,172 @@ from app.core.config import (
     DIFY_API_KEY_WORKFLOW,
     DIFY_API_KEY_AGENT,
     DIFY_API_KEY_SCHEMATIC,
+    DIFY_CONNECT_TIMEOUT,
+    DIFY_FIRST_BYTE_TIMEOUT,
+    DIFY_STREAM_IDLE_TIMEOUT,
+    DIFY_UPLOAD_RETRIES,
+    DIFY_RETRY_BACKOFF,
+    DIFY_BREAKER_WINDOW_SECONDS,
+    DIFY_BREAKER_MIN_REQUESTS,
+    DIFY_BREAKER_ERROR_RATE,
+    DIFY_BREAKER_SLOW_CALL_SECONDS,
+    DIFY_BREAKER_OPEN_SECONDS,
+    DIFY_BREAKER_HALF_OPEN_PROBES,
 )
+from app.services import circuit_breaker, prompt_encoding
+from app.core import profiling
 
 UPLOAD_URL = f"{DIFY_BASE_URL}/files/upload"
 WORKFLOW_URL = f"{DIFY_BASE_URL}/workflows/run"
 CHAT_URL = f"{DIFY_BASE_URL}/chat-messages"
 
+CODE_GENERATION_QUERY = "Please generate the corresponding code based on the requirement document and BOM list."
 
+
+def _get_breaker(url: str, api_key: str) -> circuit_breaker.CircuitBreaker:
+    """
+    Returns the circuit breaker guarding one Dify endpoint for one API key.
+    """
+    return circuit_breaker.get_breaker(
+        f"dify {url} (key …{api_key[-4:]})",
+        window_seconds=DIFY_BREAKER_WINDOW_SECONDS,
+        min_requests=DIFY_BREAKER_MIN_REQUESTS,
+        error_rate_threshold=DIFY_BREAKER_ERROR_RATE,
+        slow_call_seconds=DIFY_BREAKER_SLOW_CALL_SECONDS,
+        open_seconds=DIFY_BREAKER_OPEN_SECONDS,
+        half_open_probes=DIFY_BREAKER_HALF_OPEN_PROBES,
+    )
+
+
+def _error_event(message: str, retry_after: float | None = None, status: int | None = None) -> str:
+    event = {"event": "error", "message": message}
+    if retry_after is not None:
+        event["retry_after"] = int(math.ceil(retry_after))
+    if status is not None:
+        event["status"] = status
+    return json.dumps(event)
+
+
+def is_conversation_missing(event: Dict[str, Any]) -> bool:
+    """
+    Tells whether an event is Dify's answer to a chat message sent to a
+    conversation it no longer has (deleted or expired).
+    """
+    return event.get("event") == "error" and event.get("status") == 404
+
+
+@profiling.traced("dify_service.upload_file_to_dify")
 def upload_file_to_dify(file_path: str, user: str) -> str | None:
     """
     Uploads a file to Dify and returns the file ID.
+    Uploads are idempotent, so connection errors and 5xx/429 responses are
+    retried with exponential backoff. Blocking: call it from async code via
+    `asyncio.to_thread`.
     """
-    try:
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            mime_type = "application/octet-stream"
-
-        with open(file_path, "rb") as f:
-            files = {"file": (os.path.basename(file_path), f, mime_type)}
-            data = {"user": user}
-            headers = {"Authorization": f"Bearer {DIFY_API_KEY_WORKFLOW}"}
-            
-            response = requests.post(UPLOAD_URL, headers=headers, files=files, data=data)
+    mime_type, _ = mimetypes.guess_type(file_path)
+    if not mime_type:
+        mime_type = "application/octet-stream"
+    headers = {"Authorization": f"Bearer {DIFY_API_KEY_WORKFLOW}"}
+    breaker = _get_breaker(UPLOAD_URL, DIFY_API_KEY_WORKFLOW)
+
+    for attempt in range(DIFY_UPLOAD_RETRIES + 1):
+        retryable = False
+        try:
+            admission = breaker.before_call()
+        except circuit_breaker.CircuitOpenError as e:
+            print(f"❌ File upload skipped: {e}")
+            return None
+
+        started = time.monotonic()
+        recorded = False
+        try:
+            with open(file_path, "rb") as f:
+                files = {"file": (os.path.basename(file_path), f, mime_type)}
+                data = {"user": user}
+                response = requests.post(
+                    UPLOAD_URL, headers=headers, files=files, data=data,
+                    timeout=(DIFY_CONNECT_TIMEOUT, DIFY_STREAM_IDLE_TIMEOUT),
+                )
+            retryable = response.status_code == 429 or response.status_code >= 500
+            breaker.record(admission, ok=response.status_code < 500, latency=time.monotonic() - started)
+            recorded = True
             response.raise_for_status()
             return response.json().get("id")
-    except Exception as e:
-        print(f"❌ File upload failed: {str(e)}")
-        return None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            breaker.record(admission, ok=False, latency=time.monotonic() - started)
+            retryable = True
+            print(f"❌ File upload failed (attempt {attempt + 1}): {str(e)}")
+        except Exception as e:
+            # E.g. the file could not be read: no outcome to record, but a
+            # half-open probe slot must not stay taken.
+            if not recorded:
+                breaker.release(admission)
+            print(f"❌ File upload failed (attempt {attempt + 1}): {str(e)}")
 
+        if not retryable or attempt == DIFY_UPLOAD_RETRIES:
+            return None
+        time.sleep(DIFY_RETRY_BACKOFF * (2 ** attempt) * (1 + random.random()))
+    return None
 
+
+@profiling.traced("dify_service._stream_dify_request")
 async def _stream_dify_request(url: str, payload: Dict[str, Any], api_key: str) -> AsyncGenerator[str, None]:
     """
     A generic async generator to stream responses from a Dify endpoint (Workflow or Chat).
+
+    Requests are guarded by a circuit breaker: while the upstream is failing,
+    callers get an immediate error event carrying `retry_after` instead of
+    waiting for a timeout. Streaming requests are never retried.
     """
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Accept": "text/event-stream",
         "Content-Type": "application/json"
     }
-    
-    async with httpx.AsyncClient() as client:
+    breaker = _get_breaker(url, api_key)
+    try:
+        admission = breaker.before_call()
+    except circuit_breaker.CircuitOpenError as e:
+        print(f"❌ Dify request rejected: {e}")
+        yield _error_event("The Dify service is currently unavailable. Please try again later.", e.retry_after)
+        return
+
+    timeout = httpx.Timeout(
+        connect=DIFY_CONNECT_TIMEOUT,
+        read=DIFY_STREAM_IDLE_TIMEOUT,
+        write=DIFY_CONNECT_TIMEOUT,
+        pool=DIFY_CONNECT_TIMEOUT,
+    )
+    started = time.monotonic()
+    first_byte_latency = None
+    recorded = False
+
+    def record(ok: bool) -> None:
+        nonlocal recorded
+        if not recorded:
+            recorded = True
+            breaker.record(admission, ok=ok, latency=first_byte_latency if first_byte_latency is not None else time.monotonic() - started)
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
         try:
-            async with client.stream("POST", url, headers=headers, json=payload, timeout=180) as response:
+            request = client.build_request("POST", url, headers=headers, json=payload)
+            response = await asyncio.wait_for(client.send(request, stream=True), DIFY_FIRST_BYTE_TIMEOUT)
+            try:
+                if response.status_code >= 400:
+                    await response.aread()
                 response.raise_for_status()
-                async for raw_line in response.aiter_lines():
+                lines = response.aiter_lines()
+                while True:
+                    try:
+                        if first_byte_latency is None:
+                            remaining = DIFY_FIRST_BYTE_TIMEOUT - (time.monotonic() - started)
+                            raw_line = await asyncio.wait_for(lines.__anext__(), max(remaining, 0.001))
+                            first_byte_latency = time.monotonic() - started
+                        else:
+                            raw_line = await lines.__anext__()
+                    except StopAsyncIteration:
+                        break
+
                     if not raw_line or raw_line.startswith(': ping'):
                         continue
                     
@@ -61,12 +187,33 @@ async def _stream_dify_request(url: str, payload: Dict[str, Any], api_key: str)
                         json_str = raw_line[5:].strip()
                         if json_str:
                             yield json_str
+            finally:
+                await response.aclose()
+            record(ok=True)
         except httpx.HTTPStatusError as e:
-            print(f"❌ Dify stream request failed: {e.response.text}")
-            yield json.dumps({"event": "error", "message": "Dify request failed."})
+            # Client errors (bad key, bad payload) say nothing about upstream health.
+            record(ok=e.response.status_code < 500)
+            print(f"❌ Dify stream request failed: {e.response.status_code} {e.response.text}")
+            yield _error_event(f"Dify request failed with status {e.response.status_code}.", status=e.response.status_code)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            record(ok=False)
+            stage = "first response byte" if first_byte_latency is None else "next stream event"
+            print(f"❌ Dify stream timed out waiting for the {stage}.")
+            yield _error_event(f"The Dify service timed out waiting for the {stage}.")
+        except httpx.TransportError as e:
+            record(ok=False)
+            print(f"❌ Dify connection error: {str(e)}")
+            yield _error_event("Could not connect to the Dify service.")
+        except (GeneratorExit, asyncio.CancelledError):
+            # The client went away; this is not an upstream failure.
+            if not recorded:
+                recorded = True
+                breaker.release(admission)
+            raise
         except Exception as e:
+            record(ok=False)
             print(f"❌ An unexpected error occurred during streaming: {str(e)}")
-            yield json.dumps({"event": "error", "message": "An unexpected error occurred."})
+            yield _error_event("An unexpected error occurred.")
 
 
 async def run_initial_analysis_workflow_stream(user: str, image_id: str | None = None, text_input: str | None = None) -> AsyncGenerator[str, None]:
@@ -84,13 +231,31 @@ async def run_initial_analysis_workflow_stream(user: str, image_id: str | None =
         yield chunk
 
 
-async def run_code_generation_stream(user: str, req_doc: str, bom_csv: str) -> AsyncGenerator[str, None]:
+async def run_code_generation_stream(user: str, req_doc: str, bom_csv: str, query: str = CODE_GENERATION_QUERY) -> AsyncGenerator[str, None]:
     """
-    Streams the Dify chat agent for code generation.
+    Streams the Dify chat agent for code generation in a new conversation.
     """
+    req_doc, bom_csv = prompt_encoding.encode("code", req_doc, bom_csv)
     payload = {
         "inputs": {"requirement_document": req_doc, "bom_list": bom_csv},
-        "query": "Please generate the corresponding code based on the requirement document and BOM list.",
+        "query": query,
+        "response_mode": "streaming",
+        "user": user,
+    }
+    async for chunk in _stream_dify_request(CHAT_URL, payload, DIFY_API_KEY_AGENT):
+        yield chunk
+
+
+async def run_code_refinement_stream(user: str, dify_conversation_id: str, instruction: str) -> AsyncGenerator[str, None]:
+    """
+    Streams the Dify chat agent's answer to a follow-up instruction in an
+    existing conversation, which already holds the requirement document, BOM
+    and generated code.
+    """
+    payload = {
+        "inputs": {},
+        "query": instruction,
+        "conversation_id": dify_conversation_id,
         "response_mode": "streaming",
         "user": user,
     }
@@ -102,6 +267,7 @@ async def run_schematic_generation_stream(user: str, req_doc: str, bom_text: str
     """
     Streams the Dify workflow for schematic generation.
     """
+    req_doc, bom_text = prompt_encoding.encode("schematic", req_doc, bom_text)
     payload = {
         "inputs": {"requirement": req_doc, "bom": bom_text},
         "response_mode": "streaming",
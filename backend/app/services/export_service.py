@@ -0,0 +1,148 @@
+import json
+import zipfile
+from datetime import datetime, timezone
+from typing import Dict, Any, Iterator, Sequence
+
+from sqlalchemy.orm import Session
+
+from app.core.config import EXPORT_CHUNK_SIZE, EXPORT_FLUSH_BYTES
+from app.db import crud
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "zip": ("application/zip", "zip"),
+}
+
+
+def _isoformat(value) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def to_utc_naive(value: datetime | None) -> datetime | None:
+    """
+    Timestamps are stored as naive UTC; converts an aware filter value to match.
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def iter_records(db: Session, user_id: int, since: datetime | None = None, until: datetime | None = None,
+                 conversation_ids: Sequence[int] | None = None, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Yields a "conversation" record followed by its "message" records, for
+    every conversation of the user that matches the filters.
+    """
+    current = None
+    rows = crud.iter_export_rows(db, user_id, to_utc_naive(since), to_utc_naive(until), conversation_ids, chunk_size)
+    for conv_id, title, conv_created_at, msg_id, role, content, msg_created_at in rows:
+        if conv_id != current:
+            current = conv_id
+            yield {"type": "conversation", "id": conv_id, "title": title, "created_at": _isoformat(conv_created_at)}
+        if msg_id is None:
+            continue
+        try:
+            content = json.loads(content)
+        except (TypeError, json.JSONDecodeError):
+            pass  # export malformed content verbatim
+        yield {
+            "type": "message",
+            "conversation_id": conv_id,
+            "id": msg_id,
+            "role": role,
+            "content": content,
+            "created_at": _isoformat(msg_created_at),
+        }
+
+
+def _encode(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def iter_ndjson(records: Iterator[Dict[str, Any]], flush_bytes: int = EXPORT_FLUSH_BYTES) -> Iterator[bytes]:
+    buffer = bytearray()
+    for record in records:
+        buffer += _encode(record)
+        if len(buffer) >= flush_bytes:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+class _StreamSink:
+    """
+    A write-only file object for `zipfile`. Without `tell`/`seek`, ZipFile
+    writes data descriptors after each entry instead of seeking back, so the
+    archive can be sent while it is being written.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def iter_zip(records: Iterator[Dict[str, Any]], filters: Dict[str, Any] | None = None,
+             flush_bytes: int = EXPORT_FLUSH_BYTES) -> Iterator[bytes]:
+    """
+    Streams a zip archive with one `conversations/<id>.ndjson` entry per
+    conversation (its record, then its messages) and a `manifest.json` with
+    the filters and counts. Only the central directory, one small entry per
+    conversation, is kept in memory until the end.
+    """
+    sink = _StreamSink()
+    counts = {"conversations": 0, "messages": 0}
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        entry = None
+        for record in records:
+            if record["type"] == "conversation":
+                if entry is not None:
+                    entry.close()
+                # Sizes are unknown up front, so allow entries to grow past 4 GB.
+                entry = archive.open(f"conversations/{record['id']:08d}.ndjson", "w", force_zip64=True)
+                counts["conversations"] += 1
+            else:
+                counts["messages"] += 1
+            entry.write(_encode(record))
+            if sink.size >= flush_bytes:
+                yield sink.drain()
+        if entry is not None:
+            entry.close()
+        manifest = {
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "filters": filters or {},
+            **counts,
+        }
+        archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    yield sink.drain()
+
+
+def export(db: Session, user_id: int, fmt: str = "ndjson", since: datetime | None = None, until: datetime | None = None,
+           conversation_ids: Sequence[int] | None = None) -> Iterator[bytes]:
+    """
+    Streams a user's history as NDJSON or a zip archive, in chunks of about
+    EXPORT_FLUSH_BYTES. Memory stays flat regardless of the history size.
+    """
+    records = iter_records(db, user_id, since, until, conversation_ids)
+    if fmt == "zip":
+        filters = {
+            "since": _isoformat(since),
+            "until": _isoformat(until),
+            "conversation_ids": list(conversation_ids) if conversation_ids else None,
+        }
+        return iter_zip(records, filters)
+    return iter_ndjson(records)
@@ -0,0 +1,173 @@
+import csv
+import hashlib
+import io
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, List, Tuple
+
+from app.core.config import GUIDE_CACHE_TTL_SECONDS, GUIDE_CACHE_MAX_ENTRIES, GUIDE_CACHE_PATH
+from app.services import component_service
+
+# Bump when the guide prompt changes so old guides are not served for new prompts.
+GUIDE_PROMPT_VERSION = 2
+
+_MARKDOWN_CHROME_RE = re.compile(r"[#*_`>|~]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(value: str) -> str:
+    """
+    Normalizes free text so that cosmetic edits (width/case variants, markdown
+    emphasis, whitespace and line breaks) map to the same string.
+    """
+    value = unicodedata.normalize("NFKC", value or "").casefold()
+    value = _MARKDOWN_CHROME_RE.sub(" ", value)
+    return _WHITESPACE_RE.sub(" ", value).strip()
+
+
+def canonical_bom(bom_text: str) -> List[Tuple[str, str]] | str:
+    """
+    Returns the BOM as a sorted list of (part number, total quantity), so row
+    order, column order and duplicated rows do not matter. Falls back to the
+    normalized text when the BOM has no parsable CSV.
+    """
+    csv_content = component_service.extract_csv_from_text(bom_text or "")
+    if not csv_content:
+        return normalize_text(bom_text)
+    try:
+        reader = csv.DictReader(io.StringIO(csv_content))
+        rows = [{(k or "").strip(): (v or "").strip() for k, v in row.items()} for row in reader]
+    except csv.Error:
+        return normalize_text(bom_text)
+
+    if not rows or "元器件型号" not in rows[0]:
+        # Unknown layout: keep every column, but still ignore row and column order.
+        return sorted(json.dumps(sorted(row.items()), ensure_ascii=False) for row in rows)
+
+    quantities: Dict[str, float] = {}
+    for row in rows:
+        part = unicodedata.normalize("NFKC", row.get("元器件型号", "")).upper().replace(" ", "")
+        if not part:
+            continue
+        try:
+            quantity = float(row.get("数量") or 0)
+        except ValueError:
+            quantity = 0.0
+        quantities[part] = quantities.get(part, 0.0) + quantity
+    return sorted((part, f"{quantity:g}") for part, quantity in quantities.items())
+
+
+def make_key(requirement_doc: str, bom_text: str) -> str:
+    canonical = {
+        "version": GUIDE_PROMPT_VERSION,
+        "requirement": normalize_text(requirement_doc),
+        "bom": canonical_bom(bom_text),
+    }
+    return hashlib.sha256(json.dumps(canonical, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class GuideCache:
+    """
+    A TTL/LRU cache of generated guides with an optional SQLite tier.
+    Each entry remembers how long it took to generate, so hits can report the
+    latency they saved.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int, path: str = ""):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()  # key -> (text, generation_seconds, stored_at)
+        self._hits = 0
+        self._misses = 0
+        self._saved_seconds = 0.0
+        self._db: sqlite3.Connection | None = None
+        if path and max_entries > 0:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS guide_cache ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, generation_seconds REAL NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_guide_cache_stored_at ON guide_cache (stored_at)")
+            self._db.commit()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def get(self, key: str) -> str | None:
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, generation_seconds, stored_at FROM guide_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+            if entry is None or self._expired(entry[2], now):
+                if entry is not None:
+                    self._forget(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            self._saved_seconds += entry[1]
+            return entry[0]
+
+    def put(self, key: str, text: str, generation_seconds: float) -> None:
+        if not self.enabled:
+            return
+        entry = (text, generation_seconds, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO guide_cache VALUES (?, ?, ?, ?)", (key, *entry))
+                self._db.execute(
+                    "DELETE FROM guide_cache WHERE key NOT IN "
+                    "(SELECT key FROM guide_cache ORDER BY stored_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                if self.ttl_seconds > 0:
+                    self._db.execute("DELETE FROM guide_cache WHERE stored_at < ?", (entry[2] - self.ttl_seconds,))
+                self._db.commit()
+
+    def _remember(self, key: str, entry: tuple) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM guide_cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "persistent": self._db is not None,
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 3) if lookups else 0.0,
+                "saved_seconds": round(self._saved_seconds, 1),
+            }
+
+
+cache = GuideCache(GUIDE_CACHE_TTL_SECONDS, GUIDE_CACHE_MAX_ENTRIES, GUIDE_CACHE_PATH)
@@ -1,24 +1,42 @@
-from openai import OpenAI
 from gtts import gTTS
 import os
 import time
 from typing import Dict, Any
 
-from app.core.config import OPENAI_API_BASE, OPENAI_API_KEY, OPENAI_MODEL_NAME
+from app.services import llm_router, guide_cache, prompt_encoding
+from app.core import profiling
 
 # Ensure a directory exists for saving audio files
 AUDIO_DIR = "static/audio"
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
-def generate_guide_text(requirement_doc: str, bom_data: str) -> str:
+GUIDE_FAILURE_TEXT = "Failed to generate deployment guide."
+
+@profiling.traced("guide_service.generate_guide_text")
+async def generate_guide_text(requirement_doc: str, bom_data: str, regenerate: bool = False) -> str:
     """
-    Generates a deployment guide using an OpenAI-compatible API.
+    Returns a deployment guide, served from the guide cache when an equivalent
+    BOM and requirement document were seen before. `regenerate` skips the
+    cache lookup and replaces the cached guide.
     """
-    client = OpenAI(
-        base_url=OPENAI_API_BASE,
-        api_key=OPENAI_API_KEY
-    )
-    
+    key = guide_cache.make_key(requirement_doc, bom_data)
+    if not regenerate:
+        cached = guide_cache.cache.get(key)
+        if cached is not None:
+            return cached
+
+    started = time.monotonic()
+    guide_text = await _request_guide_text(requirement_doc, bom_data)
+    if guide_text is None:
+        return GUIDE_FAILURE_TEXT
+    guide_cache.cache.put(key, guide_text, time.monotonic() - started)
+    return guide_text
+
+async def _request_guide_text(requirement_doc: str, bom_data: str) -> str | None:
+    """
+    Generates a deployment guide using the pool of OpenAI-compatible backends.
+    """
+    requirement_doc, bom_data = prompt_encoding.encode("guide", requirement_doc, bom_data)
     prompt = f"""【Deployment Guide Generation】
 Based on the following requirement document:
 {requirement_doc}
@@ -30,19 +48,18 @@ Please generate a detailed deployment guide of about 500 words, explaining the d
 """
     
     try:
-        completion = client.chat.completions.create(
-            model=OPENAI_MODEL_NAME,
+        guide_text = await llm_router.get_router().complete(
             messages=[{"role": "user", "content": prompt}],
+            expected_chars=1500,  # ~500 words
             temperature=0.3,
             top_p=0.7,
-            stream=False # Using non-streaming for simplicity here
         )
-        guide_text = completion.choices[0].message.content
         return guide_text.strip()
     except Exception as e:
         print(f"Error generating deployment guide: {e}")
-        return "Failed to generate deployment guide."
+        return None
 
+@profiling.traced("guide_service.convert_text_to_speech")
 def convert_text_to_speech(text: str) -> str | None:
     """
     Converts text to speech and saves it as an MP3 file.
@@ -0,0 +1,273 @@
+import asyncio
+import json
+import time
+from typing import Dict, Any, List
+
+from openai import AsyncOpenAI
+
+from app.core.config import (
+    OPENAI_API_BASE,
+    OPENAI_API_KEY,
+    OPENAI_MODEL_NAME,
+    LLM_BACKENDS,
+    LLM_EWMA_ALPHA,
+    LLM_HEDGE_AFTER_SECONDS,
+    LLM_REQUEST_TIMEOUT,
+)
+from app.services import circuit_breaker
+
+
+class LLMUnavailableError(Exception):
+    """
+    Raised when no backend could complete a request.
+    """
+
+
+class LLMBackend:
+    """
+    One OpenAI-compatible endpoint and model, with its observed performance.
+    """
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: str, max_concurrency: int = 4):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrency = max(int(max_concurrency), 1)
+
+        self.in_flight = 0
+        self.ttft_ewma: float | None = None        # seconds to first streamed token
+        self.throughput_ewma: float | None = None  # output characters per second after the first token
+        self.completed = 0
+        self.failed = 0
+        self.breaker = circuit_breaker.get_breaker(f"llm {name}")
+        self._semaphore: asyncio.Semaphore | None = None
+        self._client: AsyncOpenAI | None = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        if self._client is None:
+            # Retries are handled by the router (failover), not by the SDK.
+            self._client = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key,
+                                       timeout=LLM_REQUEST_TIMEOUT, max_retries=0)
+        return self._client
+
+    def expected_latency(self, expected_chars: int, default_throughput: float | None = None) -> float:
+        """
+        Estimated seconds to complete a response, inflated by current load.
+        Backends without observations score 0 so they get explored first.
+        """
+        if self.ttft_ewma is None:
+            return 0.0
+        latency = self.ttft_ewma
+        throughput = self.throughput_ewma or default_throughput
+        if throughput:
+            latency += expected_chars / throughput
+        return latency * (1 + self.in_flight / self.max_concurrency)
+
+    def observe(self, ttft: float, chars: int, total: float, alpha: float) -> None:
+        self.ttft_ewma = ttft if self.ttft_ewma is None else alpha * ttft + (1 - alpha) * self.ttft_ewma
+        generation_time = total - ttft
+        if chars and generation_time > 0:
+            throughput = chars / generation_time
+            self.throughput_ewma = (throughput if self.throughput_ewma is None
+                                    else alpha * throughput + (1 - alpha) * self.throughput_ewma)
+
+    def observe_censored(self, waited: float, alpha: float) -> None:
+        """
+        Records that no token arrived within `waited` seconds (the request was
+        abandoned), so the estimate can only move up.
+        """
+        if self.ttft_ewma is None or waited > self.ttft_ewma:
+            self.observe(waited, 0, waited, alpha)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "ttft_ewma": round(self.ttft_ewma, 3) if self.ttft_ewma is not None else None,
+            "throughput_ewma": round(self.throughput_ewma, 1) if self.throughput_ewma is not None else None,
+            "completed": self.completed,
+            "failed": self.failed,
+            "breaker_state": self.breaker.snapshot()["state"],
+        }
+
+
+class LLMRouter:
+    """
+    Routes chat completions across a pool of backends.
+
+    Candidates are ordered by expected latency (EWMA of time-to-first-token plus
+    expected output over EWMA throughput). A backend at its concurrency cap is
+    only used when every other one is too. Failed requests fail over to the next
+    candidate, and with hedging enabled a backup request is started when the
+    current one has produced nothing after `hedge_after` seconds; whichever
+    streams first wins and the other is cancelled.
+    """
+
+    def __init__(self, backends: List[LLMBackend], alpha: float = 0.3, hedge_after: float = 0.0):
+        if not backends:
+            raise ValueError("At least one LLM backend is required.")
+        self.backends = backends
+        self.alpha = alpha
+        self.hedge_after = hedge_after
+
+    def rank(self, expected_chars: int) -> List[LLMBackend]:
+        # A backend whose throughput was never measured is assumed to be as slow
+        # as the slowest measured one rather than infinitely fast.
+        known = [b.throughput_ewma for b in self.backends if b.throughput_ewma]
+        default_throughput = min(known) if known else None
+        return sorted(
+            self.backends,
+            key=lambda b: (b.in_flight >= b.max_concurrency,
+                           b.expected_latency(expected_chars, default_throughput),
+                           b.in_flight),
+        )
+
+    async def _attempt(self, backend: LLMBackend, messages: List[Dict[str, str]], params: Dict[str, Any],
+                       first_token: asyncio.Event) -> str:
+        admission = backend.breaker.before_call()
+        started = time.monotonic()
+        ttft = None
+        parts = []
+        try:
+            async with backend.semaphore:
+                backend.in_flight += 1
+                try:
+                    stream = await backend.client.chat.completions.create(
+                        model=backend.model, messages=messages, stream=True, **params
+                    )
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        content = delta.content or ""
+                        # Reasoning models stream their thoughts first; that still counts as progress.
+                        if ttft is None and (content or getattr(delta, "reasoning_content", None)):
+                            ttft = time.monotonic() - started
+                            first_token.set()
+                        parts.append(content)
+                finally:
+                    backend.in_flight -= 1
+        except asyncio.CancelledError:
+            backend.breaker.release(admission)
+            if ttft is None:
+                backend.observe_censored(time.monotonic() - started, self.alpha)
+            raise
+        except Exception:
+            backend.failed += 1
+            backend.breaker.record(admission, ok=False, latency=time.monotonic() - started)
+            raise
+
+        total = time.monotonic() - started
+        text = "".join(parts)
+        if ttft is None:
+            ttft = total
+        backend.observe(ttft, len(text), total, self.alpha)
+        backend.completed += 1
+        backend.breaker.record(admission, ok=True, latency=ttft)
+        return text
+
+    async def complete(self, messages: List[Dict[str, str]], expected_chars: int = 2000, **params) -> str:
+        """
+        Returns the text of a chat completion from the best available backend.
+        """
+        candidates = self.rank(expected_chars)
+        running: Dict[asyncio.Task, asyncio.Event] = {}
+        errors = []
+
+        def launch() -> bool:
+            while candidates:
+                backend = candidates.pop(0)
+                if backend.breaker.snapshot()["state"] == circuit_breaker.OPEN:
+                    errors.append(f"{backend.name}: circuit open")
+                    continue
+                event = asyncio.Event()
+                running[asyncio.ensure_future(self._attempt(backend, messages, params, event))] = event
+                return True
+            return False
+
+        try:
+            launch()
+            while running:
+                waiters = set(running)
+                hedge = self.hedge_after > 0 and candidates and not any(e.is_set() for e in running.values())
+                if hedge:
+                    waiters |= {asyncio.ensure_future(e.wait()) for e in running.values()}
+                done, _ = await asyncio.wait(
+                    waiters,
+                    timeout=self.hedge_after if hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for waiter in waiters - set(running):
+                    waiter.cancel()
+
+                if not done and hedge:
+                    launch()
+                    continue
+
+                streaming = [task for task, event in running.items() if event.is_set()]
+                if streaming:
+                    # A request is producing output: drop any slower hedge.
+                    for task in list(running):
+                        if task not in streaming and not task.done():
+                            task.cancel()
+                            running.pop(task)
+
+                for task in [t for t in done if t in running]:
+                    running.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        errors.append(str(e))
+                if not running:
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+
+        raise LLMUnavailableError("; ".join(errors) or "No LLM backend available.")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [backend.snapshot() for backend in self.backends]
+
+
+def load_backends(raw: str = LLM_BACKENDS) -> List[LLMBackend]:
+    """
+    Builds the backend pool from the LLM_BACKENDS JSON setting, falling back to
+    the single OPENAI_* backend.
+    """
+    if raw:
+        try:
+            return [
+                LLMBackend(
+                    name=entry.get("name") or entry["base_url"],
+                    base_url=entry["base_url"],
+                    api_key=entry.get("api_key", OPENAI_API_KEY),
+                    model=entry.get("model", OPENAI_MODEL_NAME),
+                    max_concurrency=entry.get("max_concurrency", 4),
+                )
+                for entry in json.loads(raw)
+            ]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            print(f"⚠️ Invalid LLM_BACKENDS setting, using OPENAI_API_BASE: {e}")
+    return [LLMBackend(name="default", base_url=OPENAI_API_BASE, api_key=OPENAI_API_KEY, model=OPENAI_MODEL_NAME)]
+
+
+_router: LLMRouter | None = None
+
+
+def get_router() -> LLMRouter:
+    global _router
+    if _router is None:
+        _router = LLMRouter(load_backends(), alpha=LLM_EWMA_ALPHA, hedge_after=LLM_HEDGE_AFTER_SECONDS)
+    return _router
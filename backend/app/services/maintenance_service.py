@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterator, List
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.core.config import (
+    RETENTION_POLICIES, MAINTENANCE_INTERVAL_SECONDS, MAINTENANCE_BATCH_SIZE, MAINTENANCE_BATCH_PAUSE,
+    MAINTENANCE_VACUUM_PAGES, SCHEMATIC_DIR,
+)
+from app.db import crud, sharding
+from app.db.database import engine
+from app.services import guide_service, search_service
+
+# Retention pseudo-types that expire generated files instead of messages.
+MEDIA_DIRS = {
+    "audio": guide_service.AUDIO_DIR,
+    "schematic_image": SCHEMATIC_DIR,
+}
+# The message type and data field linking to those files; the links are
+# cleared when their files expire so no message points at a missing file.
+MEDIA_REFERENCES = {
+    "audio": ("deployment_guide", "audio_url"),
+    "schematic_image": ("schematic_code", "image"),
+}
+
+_task: asyncio.Task | None = None
+
+
+def load_policies(raw: str = RETENTION_POLICIES) -> Dict[str, float]:
+    """
+    Parses RETENTION_POLICIES into {message type: days}. Non-positive values
+    mean "keep forever" and are dropped.
+    """
+    if not raw:
+        return {}
+    try:
+        policies = {str(kind): float(days) for kind, days in json.loads(raw).items()}
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        print(f"⚠️ Ignoring invalid RETENTION_POLICIES: {e}")
+        return {}
+    return {kind: days for kind, days in policies.items() if days > 0}
+
+
+def databases() -> Iterator[Engine]:
+    """
+    Yields the engines holding conversations: the main database and, with
+    sharded storage, every shard file.
+    """
+    yield engine
+    if sharding.is_enabled():
+        for key in sharding.existing_shard_keys():
+            yield sharding.shards.get(key)
+
+
+def expire_messages(message_type: str, days: float, batch_size: int = MAINTENANCE_BATCH_SIZE,
+                    pause: float = MAINTENANCE_BATCH_PAUSE) -> int:
+    """
+    Deletes messages of `message_type` older than `days`, one committed batch
+    at a time with a pause in between.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    total = 0
+    for db_engine in databases():
+        after_id = 0
+        with Session(db_engine) as db:
+            while after_id is not None:
+                deleted, after_id = crud.delete_expired_messages(db, message_type, cutoff, after_id, batch_size)
+                total += deleted
+                if after_id is not None and pause > 0:
+                    time.sleep(pause)
+    return total
+
+
+def expire_files(directory: str, days: float) -> List[str]:
+    """
+    Removes files in `directory` last modified more than `days` ago and
+    returns their names.
+    """
+    if not os.path.isdir(directory):
+        return []
+    cutoff = time.time() - days * 86400
+    removed = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+                removed.append(entry.name)
+            except OSError as e:
+                print(f"⚠️ Could not remove {entry.path}: {e}")
+    return removed
+
+
+def clear_media_references(kind: str, file_names: set, batch_size: int = MAINTENANCE_BATCH_SIZE,
+                           pause: float = MAINTENANCE_BATCH_PAUSE) -> int:
+    """
+    Clears the links of `kind` (see MEDIA_REFERENCES) to the removed
+    `file_names` in stored messages, one committed batch at a time.
+    """
+    message_type, field = MEDIA_REFERENCES[kind]
+    total = 0
+    for db_engine in databases():
+        after_id = 0
+        with Session(db_engine) as db:
+            while after_id is not None:
+                changed, after_id = crud.clear_media_references(db, message_type, field, file_names, after_id, batch_size)
+                total += changed
+                if after_id is not None and pause > 0:
+                    time.sleep(pause)
+    return total
+
+
+def compact(vacuum_pages: int = MAINTENANCE_VACUUM_PAGES) -> None:
+    """
+    Returns free pages to the file system a few at a time, refreshes planner
+    statistics and merges full-text index segments left behind by deletes.
+    """
+    for db_engine in databases():
+        _compact(db_engine, vacuum_pages)
+
+
+def _compact(db_engine: Engine, vacuum_pages: int) -> None:
+    if db_engine.dialect.name == "sqlite":
+        raw = db_engine.raw_connection()
+        try:
+            # incremental_vacuum frees one page per step and the sqlite3 module
+            # steps a statement only once; executescript runs it to completion.
+            # `PRAGMA optimize` runs ANALYZE on tables whose statistics are stale.
+            raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)}); PRAGMA optimize;")
+        finally:
+            raw.close()
+    else:
+        # Space is reclaimed by autovacuum; only refresh the statistics.
+        with db_engine.begin() as conn:
+            conn.execute(text("ANALYZE messages"))
+            conn.execute(text("ANALYZE conversations"))
+
+    with Session(db_engine) as db:
+        search_service.merge_segments(db)
+        db.commit()
+
+
+def run_once(policies: Dict[str, float] | None = None) -> Dict[str, Any]:
+    """
+    Applies the retention policies, then compacts the database.
+    """
+    policies = load_policies() if policies is None else policies
+    started = time.monotonic()
+    summary: Dict[str, Any] = {"messages": {}, "files": {}, "cleared_links": {}}
+    for kind, days in policies.items():
+        if kind in MEDIA_DIRS:
+            removed = expire_files(MEDIA_DIRS[kind], days)
+            summary["files"][kind] = len(removed)
+            if removed:
+                summary["cleared_links"][kind] = clear_media_references(kind, set(removed))
+        else:
+            summary["messages"][kind] = expire_messages(kind, days)
+    compact()
+    summary["seconds"] = round(time.monotonic() - started, 2)
+    return summary
+
+
+async def _run_periodically(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # The database work is synchronous; keep it off the event loop.
+            summary = await asyncio.to_thread(run_once)
+            print(f"🧹 Maintenance finished: {summary}")
+        except Exception as e:
+            print(f"❌ Maintenance failed: {e}")
+
+
+def start(interval: float = MAINTENANCE_INTERVAL_SECONDS) -> None:
+    global _task
+    if interval > 0 and _task is None:
+        _task = asyncio.get_running_loop().create_task(_run_periodically(interval), name="maintenance")
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
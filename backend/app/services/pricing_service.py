@@ -0,0 +1,287 @@
+import json
+import os
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.core.config import PRICE_TABLE_DIR, PRICING_EXACT_MAX_STORES
+from app.core import profiling
+
+# Price table columns, one CSV per store (<store name>.csv). A part has one row
+# per price-break tier: `break_qty` is the minimum quantity for `unit_price`.
+# `moq` and `stock` are optional; missing stock means unlimited.
+PRICE_COLUMNS = ["part", "break_qty", "unit_price", "moq", "stock"]
+
+
+# Upper bound on (subsets × lines) for the exact solver, which keeps its memory
+# use around 160 MB at most.
+_EXACT_MAX_CELLS = 20_000_000
+
+
+def normalize_part(part: str) -> str:
+    return str(part).strip().upper()
+
+
+class PriceBook:
+    """
+    Price tables of several stores packed into dense arrays:
+    `breaks`/`prices` are (parts × stores × tiers), `moq`/`stock` are
+    (parts × stores). Missing tiers have an infinite price.
+    """
+
+    def __init__(self, stores: List[str], parts: List[str], breaks: np.ndarray, prices: np.ndarray,
+                 moq: np.ndarray, stock: np.ndarray, shipping: np.ndarray):
+        self.stores = stores
+        self.parts = parts
+        self.part_index = {part: i for i, part in enumerate(parts)}
+        self.breaks = breaks
+        self.prices = prices
+        self.moq = moq
+        self.stock = stock
+        self.shipping = shipping
+
+    @classmethod
+    def from_frames(cls, tables: Dict[str, pd.DataFrame], shipping: Dict[str, float] | None = None) -> "PriceBook":
+        shipping = shipping or {}
+        stores = sorted(tables)
+        frames = []
+        for store_idx, store in enumerate(stores):
+            df = tables[store].copy()
+            missing = {"part", "unit_price"} - set(df.columns)
+            if missing:
+                raise ValueError(f"Price table for '{store}' is missing columns: {', '.join(sorted(missing))}")
+            for column, default in (("break_qty", 1), ("moq", 1), ("stock", np.inf)):
+                if column not in df.columns:
+                    df[column] = default
+            df = df[PRICE_COLUMNS]
+            df["part"] = df["part"].map(normalize_part)
+            df["store_idx"] = store_idx
+            frames.append(df)
+
+        rows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PRICE_COLUMNS + ["store_idx"])
+        rows["break_qty"] = pd.to_numeric(rows["break_qty"], errors="coerce").fillna(1).clip(lower=1)
+        rows["unit_price"] = pd.to_numeric(rows["unit_price"], errors="coerce")
+        rows["moq"] = pd.to_numeric(rows["moq"], errors="coerce").fillna(1).clip(lower=1)
+        rows["stock"] = pd.to_numeric(rows["stock"], errors="coerce").fillna(np.inf)
+        rows = rows.dropna(subset=["unit_price"]).sort_values(["part", "store_idx", "break_qty"])
+
+        parts = sorted(rows["part"].unique().tolist())
+        part_idx = rows["part"].map({part: i for i, part in enumerate(parts)}).to_numpy()
+        store_idx = rows["store_idx"].to_numpy(dtype=np.int64)
+        tier_idx = rows.groupby(["part", "store_idx"]).cumcount().to_numpy()
+        n_tiers = int(tier_idx.max()) + 1 if len(rows) else 1
+
+        shape = (len(parts), len(stores))
+        breaks = np.full(shape + (n_tiers,), np.inf)
+        prices = np.full(shape + (n_tiers,), np.inf)
+        moq = np.ones(shape)
+        stock = np.zeros(shape)  # a part a store does not list has no stock there
+        breaks[part_idx, store_idx, tier_idx] = rows["break_qty"].to_numpy(dtype=float)
+        prices[part_idx, store_idx, tier_idx] = rows["unit_price"].to_numpy(dtype=float)
+        # MOQ and stock are per part and store; take them from the first tier row.
+        first = tier_idx == 0
+        moq[part_idx[first], store_idx[first]] = rows["moq"].to_numpy(dtype=float)[first]
+        stock[part_idx[first], store_idx[first]] = rows["stock"].to_numpy(dtype=float)[first]
+
+        shipping_arr = np.array([float(shipping.get(store, 0.0)) for store in stores])
+        return cls(stores, parts, breaks, prices, moq, stock, shipping_arr)
+
+    @classmethod
+    def from_directory(cls, directory: str) -> "PriceBook":
+        """
+        Loads every `<store>.csv` in `directory`, plus shipping charges from an
+        optional `stores.json` ({"store": {"shipping": 12.0}}).
+        """
+        tables = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".csv"):
+                tables[filename[:-4]] = pd.read_csv(os.path.join(directory, filename))
+        shipping = {}
+        stores_file = os.path.join(directory, "stores.json")
+        if os.path.exists(stores_file):
+            with open(stores_file, encoding="utf-8") as f:
+                shipping = {store: cfg.get("shipping", 0.0) for store, cfg in json.load(f).items()}
+        return cls.from_frames(tables, shipping)
+
+    def line_costs(self, parts: List[str], quantities: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluates every (line × store × tier) combination at once.
+
+        For each tier the purchase quantity is raised to the MOQ and to the tier
+        break, so buying a few extra units to reach a cheaper tier is considered.
+        Returns, per (line, store), the cheapest feasible cost (inf if the store
+        cannot supply the line), the chosen tier and the quantity to buy.
+        """
+        idx = np.array([self.part_index.get(normalize_part(p), -1) for p in parts], dtype=np.int64)
+        known = idx >= 0
+        safe_idx = np.where(known, idx, 0)
+        quantities = np.asarray(quantities, dtype=float)
+
+        breaks = self.breaks[safe_idx]                                  # (L, S, T)
+        prices = self.prices[safe_idx]
+        base_qty = np.maximum(quantities[:, None], self.moq[safe_idx])  # (L, S)
+        buy_qty = np.maximum(base_qty[:, :, None], breaks)              # (L, S, T)
+        buy_qty = np.where(np.isfinite(buy_qty), buy_qty, 0.0)
+        feasible = np.isfinite(prices) & (buy_qty <= self.stock[safe_idx][:, :, None]) & known[:, None, None]
+        with np.errstate(invalid="ignore"):
+            cost = np.where(feasible, buy_qty * prices, np.inf)
+
+        tier = cost.argmin(axis=2)                                      # (L, S)
+        best = np.take_along_axis(cost, tier[:, :, None], axis=2)[:, :, 0]
+        qty = np.take_along_axis(buy_qty, tier[:, :, None], axis=2)[:, :, 0]
+        return best, tier, qty
+
+
+def _assignment_cost(costs: np.ndarray, shipping: np.ndarray, mask: np.ndarray) -> float:
+    if not mask.any():
+        return np.inf
+    return float(costs[:, mask].min(axis=1).sum() + shipping[mask].sum())
+
+
+def _solve_exact(costs: np.ndarray, shipping: np.ndarray) -> np.ndarray:
+    """
+    Tries every subset of stores. Per-line minima are built incrementally: the
+    minimum over a subset is the minimum over the subset without its lowest
+    store, combined with that store's column.
+    """
+    n_stores = costs.shape[1]
+    n_masks = 1 << n_stores
+    minima = np.empty((n_masks, costs.shape[0]))
+    minima[0] = np.inf
+    totals = np.full(n_masks, np.inf)
+    shipping_total = np.zeros(n_masks)
+    for mask in range(1, n_masks):
+        low = (mask & -mask).bit_length() - 1
+        rest = mask & (mask - 1)
+        np.minimum(minima[rest], costs[:, low], out=minima[mask])
+        shipping_total[mask] = shipping_total[rest] + shipping[low]
+        totals[mask] = minima[mask].sum() + shipping_total[mask]
+    best = int(totals.argmin())
+    return np.array([(best >> s) & 1 == 1 for s in range(n_stores)])
+
+
+def _solve_heuristic(costs: np.ndarray, shipping: np.ndarray) -> np.ndarray:
+    """
+    Local search over open stores: start from every store open, then apply the
+    best single close/open/swap move until none improves the total.
+    """
+    n_stores = costs.shape[1]
+    mask = np.ones(n_stores, dtype=bool)
+    current = _assignment_cost(costs, shipping, mask)
+    while True:
+        best_move, best_cost = None, current
+        for s in range(n_stores):
+            candidate = mask.copy()
+            candidate[s] = not candidate[s]
+            cost = _assignment_cost(costs, shipping, candidate)
+            if cost < best_cost - 1e-9:
+                best_move, best_cost = candidate, cost
+        if best_move is None:
+            for closed in np.flatnonzero(mask):
+                for opened in np.flatnonzero(~mask):
+                    candidate = mask.copy()
+                    candidate[closed], candidate[opened] = False, True
+                    cost = _assignment_cost(costs, shipping, candidate)
+                    if cost < best_cost - 1e-9:
+                        best_move, best_cost = candidate, cost
+        if best_move is None:
+            return mask
+        mask, current = best_move, best_cost
+
+
+def _merge_lines(parts: List[str], quantities: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    """
+    Merges BOM lines that name the same part, keeping the first spelling and
+    order. Stock, MOQs and price breaks apply to the total bought from a store,
+    so two lines that each fit a store's stock may not fit it together.
+    """
+    keys = pd.Index([normalize_part(part) for part in parts])
+    codes, uniques = pd.factorize(keys)
+    if len(uniques) == len(parts):
+        return parts, quantities
+    first = np.unique(codes, return_index=True)[1]
+    return [parts[i] for i in first], np.bincount(codes, weights=quantities, minlength=len(uniques))
+
+
+@profiling.traced("pricing_service.optimize_purchase")
+def optimize_purchase(book: PriceBook, bom: pd.DataFrame, exact_max_stores: int = PRICING_EXACT_MAX_STORES) -> Dict[str, Any]:
+    """
+    Finds the cheapest way to buy a BOM (columns 元器件型号 and 数量) across the
+    stores of `book`, including price breaks, MOQs, stock limits and one
+    shipping charge per store used. Lines for the same part are merged into one.
+    """
+    parts = bom["元器件型号"].astype(str).tolist()
+    quantities = pd.to_numeric(bom["数量"], errors="coerce").fillna(0).clip(lower=0).to_numpy(dtype=float)
+    parts, quantities = _merge_lines(parts, quantities)
+    costs, tiers, buy_qty = book.line_costs(parts, quantities)
+
+    available = np.isfinite(costs).any(axis=1) & (quantities > 0)
+    solvable = costs[available]
+    n_stores = len(book.stores)
+    if not solvable.size:
+        mask = np.zeros(n_stores, dtype=bool)
+        method = "none"
+    elif n_stores <= exact_max_stores and (1 << n_stores) * len(solvable) <= _EXACT_MAX_CELLS:
+        mask = _solve_exact(solvable, book.shipping)
+        method = "exact"
+    else:
+        mask = _solve_heuristic(solvable, book.shipping)
+        method = "heuristic"
+
+    masked = np.where(mask[None, :], costs, np.inf)
+    choice = masked.argmin(axis=1)
+    rows = np.arange(len(parts))
+    chosen_cost = masked[rows, choice]
+
+    lines = []
+    for i in range(len(parts)):
+        if not available[i] or not np.isfinite(chosen_cost[i]):
+            lines.append({"元器件型号": parts[i], "数量": float(quantities[i]), "store": None, "available": False})
+            continue
+        s = choice[i]
+        qty = float(buy_qty[i, s])
+        lines.append({
+            "元器件型号": parts[i],
+            "数量": float(quantities[i]),
+            "store": book.stores[s],
+            "available": True,
+            "buy_qty": qty,
+            "price_break": float(book.breaks[book.part_index[normalize_part(parts[i])], s, tiers[i, s]]),
+            "unit_price": float(chosen_cost[i] / qty) if qty else 0.0,
+            "line_total": float(chosen_cost[i]),
+        })
+
+    used = np.zeros(n_stores, dtype=bool)
+    used[np.unique(choice[available & np.isfinite(chosen_cost)])] = True
+    subtotals = {
+        book.stores[s]: float(chosen_cost[(choice == s) & available & np.isfinite(chosen_cost)].sum())
+        for s in np.flatnonzero(used)
+    }
+    shipping = {book.stores[s]: float(book.shipping[s]) for s in np.flatnonzero(used)}
+    parts_total = float(sum(subtotals.values()))
+    shipping_total = float(sum(shipping.values()))
+    return {
+        "method": method,
+        "lines": lines,
+        "store_subtotals": subtotals,
+        "shipping": shipping,
+        "parts_total": parts_total,
+        "shipping_total": shipping_total,
+        "total": parts_total + shipping_total,
+        "unavailable": [line["元器件型号"] for line in lines if not line["available"]],
+    }
+
+
+_price_book: PriceBook | None = None
+
+
+def get_price_book() -> PriceBook | None:
+    """
+    Returns the price book loaded from PRICE_TABLE_DIR, or None if no price
+    tables are configured.
+    """
+    global _price_book
+    if _price_book is None and PRICE_TABLE_DIR and os.path.isdir(PRICE_TABLE_DIR):
+        _price_book = PriceBook.from_directory(PRICE_TABLE_DIR)
+    return _price_book
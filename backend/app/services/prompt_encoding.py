@@ -0,0 +1,247 @@
+"""
+Compact encoding of the requirement document and BOM sent upstream.
+
+The code agent, the schematic workflow and the guide LLM all receive the
+requirement document and BOM of an analysis. Before they are sent, the
+requirement document is stripped of markdown chrome and redundant
+whitespace, and the BOM is re-serialized as a minimal CSV: part number,
+quantity and a few descriptive columns, one row per part, without the price
+columns. Each target has a token budget (PROMPT_TOKEN_BUDGETS); over it, the
+descriptive BOM columns go first, then the end of the requirement document.
+"""
+import csv
+import io
+import json
+import re
+import unicodedata
+from typing import Dict, List, Tuple
+
+from app.core.config import PROMPT_ENCODING, PROMPT_TOKEN_BUDGETS
+from app.services import component_service
+
+PART_COLUMN = "元器件型号"
+QUANTITY_COLUMN = "数量"
+# Descriptive columns worth keeping, in output order. Anything else (prices,
+# links, suppliers, duplicated columns) is dropped.
+DETAIL_COLUMNS = ("器件名称", "名称", "类别", "描述", "规格", "参数", "封装", "功能", "用途", "备注")
+PRICE_COLUMNS = {"price", "单价", "总价", "价格", "金额", "小计", "unit_price", "total_price"}
+
+# Targets that received the BOM as a markdown ```csv block keep getting one.
+TARGETS = {"code": False, "schematic": True, "guide": True}
+TRUNCATION_MARK = "…"
+
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿가-힯]")
+_HEADING_RE = re.compile(r"^#{1,6}\s*")
+_RULE_RE = re.compile(r"^([-*_=]\s*){3,}$")
+_TABLE_SEPARATOR_RE = re.compile(r"^\|?(\s*:?-{2,}:?\s*\|)+\s*:?-*:?\s*\|?$")
+_BULLET_RE = re.compile(r"^[*+•·]\s+")
+# Paired emphasis around text. `__` only counts outside words, so identifiers
+# like __init__ survive; inline code spans are skipped altogether.
+_EMPHASIS_RE = re.compile(r"(\*\*|~~)(?=\S)(.+?)(?<=\S)\1|(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)")
+_INLINE_CODE_RE = re.compile(r"(`+).+?(?<!`)\1(?!`)")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_SPACES_RE = re.compile(r"[ \t　]+")
+
+_stats: Dict[str, Dict[str, int]] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough token count: one token per CJK character and one per four other
+    characters, which is close to common BPE tokenizers for mixed text.
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _strip_emphasis(line: str) -> str:
+    parts, pos = [], 0
+    for match in _INLINE_CODE_RE.finditer(line):
+        parts.append(_EMPHASIS_RE.sub(lambda m: m.group(2) or m.group(3), line[pos:match.start()]))
+        parts.append(match.group(0))
+        pos = match.end()
+    parts.append(_EMPHASIS_RE.sub(lambda m: m.group(2) or m.group(3), line[pos:]))
+    return "".join(parts)
+
+
+def normalize_requirement(text: str) -> str:
+    """
+    Removes markdown chrome (headings, emphasis, rules, table borders), unifies
+    bullets and width variants, and drops blank and repeated lines. Wording
+    and line structure are kept; inline code and fenced blocks are left as is.
+    """
+    lines = []
+    fence = None
+    for line in (text or "").splitlines():
+        opening = _FENCE_RE.match(line)
+        if fence or opening:
+            if fence is None:
+                fence = opening.group(1)
+            elif line.strip().startswith(fence):
+                fence = None
+            lines.append(line.rstrip())
+            continue
+        line = unicodedata.normalize("NFKC", line).strip()
+        if not line or _RULE_RE.match(line) or _TABLE_SEPARATOR_RE.match(line):
+            continue
+        line = _HEADING_RE.sub("", line)
+        line = _BULLET_RE.sub("- ", line)
+        if line.startswith("|") and line.endswith("|"):
+            line = " | ".join(cell.strip() for cell in line.strip("|").split("|"))
+        line = _SPACES_RE.sub(" ", _strip_emphasis(line)).strip()
+        if line and (not lines or lines[-1] != line):
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def _read_bom_rows(bom_text: str) -> List[Dict[str, str]] | None:
+    csv_content = component_service.extract_csv_from_text(bom_text or "")
+    if csv_content is None and PART_COLUMN in (bom_text or "").lstrip().split("\n", 1)[0]:
+        # Already bare CSV, e.g. what the code agent is given.
+        csv_content = bom_text.strip()
+    if not csv_content:
+        return None
+    try:
+        reader = csv.DictReader(io.StringIO(csv_content))
+        return [{(k or "").strip(): (v or "").strip() for k, v in row.items() if k is not None} for row in reader]
+    except csv.Error:
+        return None
+
+
+def _write_csv(header: List[str], rows: List[List[str]]) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(header)
+    writer.writerows(rows)
+    return out.getvalue().rstrip("\n")
+
+
+def encode_bom(bom_text: str, include_details: bool = True) -> str:
+    """
+    Returns the BOM as compact CSV with one row per part number (numeric
+    quantities summed, others such as "2个" kept as written), keeping only the part, quantity and descriptive columns. BOMs
+    without a parsable CSV are normalized like free text.
+    """
+    rows = _read_bom_rows(bom_text)
+    if not rows:
+        return normalize_requirement(bom_text)
+
+    header = list(rows[0].keys())
+    if PART_COLUMN not in header:
+        # Unknown layout: drop prices and repeated rows, keep everything else.
+        columns = [c for c in header if c.lower() not in PRICE_COLUMNS]
+        unique = list(dict.fromkeys(tuple(row.get(c, "") for c in columns) for row in rows))
+        return _write_csv(columns, [list(row) for row in unique])
+
+    details = []
+    if include_details:
+        for column in DETAIL_COLUMNS:
+            values = [row.get(column, "") for row in rows]
+            # Skip absent, empty and columns that only repeat the part number.
+            if column in header and any(values) and values != [row[PART_COLUMN] for row in rows]:
+                details.append(column)
+
+    parts: Dict[str, Dict[str, object]] = {}
+    for row in rows:
+        part = unicodedata.normalize("NFKC", row.get(PART_COLUMN, "")).strip()
+        if not part:
+            continue
+        key = part.upper().replace(" ", "")
+        entry = parts.setdefault(key, {"part": part, "quantity": None, "quantity_texts": [], "details": {}})
+        quantity = unicodedata.normalize("NFKC", row.get(QUANTITY_COLUMN, "")).strip()
+        if quantity:
+            try:
+                entry["quantity"] = (entry["quantity"] or 0.0) + float(quantity)
+            except ValueError:
+                entry["quantity_texts"].append(quantity)
+        for column in details:
+            if row.get(column) and column not in entry["details"]:
+                entry["details"][column] = unicodedata.normalize("NFKC", row[column])
+
+    return _write_csv(
+        [PART_COLUMN, QUANTITY_COLUMN] + details,
+        [[e["part"], _format_quantity(e)] + [e["details"].get(c, "") for c in details] for e in parts.values()],
+    )
+
+
+def _format_quantity(entry: Dict[str, object]) -> str:
+    values = [f"{entry['quantity']:g}"] if entry["quantity"] is not None else []
+    return "+".join(values + entry["quantity_texts"])
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """
+    Keeps whole lines from the start of `text` while they fit in `budget`
+    estimated tokens, and marks the cut.
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    kept: List[str] = []
+    used = estimate_tokens(TRUNCATION_MARK)
+    for line in text.split("\n"):
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            if not kept:
+                # A single oversized line: keep its longest prefix that fits.
+                low, high = 0, len(line)
+                while low < high:
+                    middle = (low + high + 1) // 2
+                    if used + estimate_tokens(line[:middle]) <= budget:
+                        low = middle
+                    else:
+                        high = middle - 1
+                kept.append(line[:low])
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept) + TRUNCATION_MARK
+
+
+def load_budgets(raw: str = PROMPT_TOKEN_BUDGETS) -> Dict[str, int]:
+    if not raw:
+        return {}
+    try:
+        return {str(target): int(tokens) for target, tokens in json.loads(raw).items() if int(tokens) > 0}
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        print(f"⚠️ Ignoring invalid PROMPT_TOKEN_BUDGETS: {e}")
+        return {}
+
+
+_budgets = load_budgets()
+
+
+def encode(target: str, requirement_doc: str, bom_text: str) -> Tuple[str, str]:
+    """
+    Returns the (requirement document, BOM) to send to `target` ("code",
+    "schematic" or "guide"), within its token budget. Logs the sizes before
+    and after.
+    """
+    if not PROMPT_ENCODING:
+        return requirement_doc, bom_text
+
+    requirement = normalize_requirement(requirement_doc)
+    bom = encode_bom(bom_text)
+    budget = _budgets.get(target)
+    if budget and estimate_tokens(requirement) + estimate_tokens(bom) > budget:
+        bom = encode_bom(bom_text, include_details=False)
+        # Never cut the requirement document below a quarter of the budget.
+        requirement = truncate_to_tokens(requirement, max(budget - estimate_tokens(bom), budget // 4))
+    if TARGETS.get(target) and bom and "\n" in bom:
+        bom = f"```csv\n{bom}\n```"
+
+    original_tokens = estimate_tokens(requirement_doc or "") + estimate_tokens(bom_text or "")
+    encoded_tokens = estimate_tokens(requirement) + estimate_tokens(bom)
+    stats = _stats.setdefault(target, {"requests": 0, "original_tokens": 0, "encoded_tokens": 0, "over_budget": 0})
+    stats["requests"] += 1
+    stats["original_tokens"] += original_tokens
+    stats["encoded_tokens"] += encoded_tokens
+    if budget and encoded_tokens > budget:
+        stats["over_budget"] += 1
+        print(f"⚠️ Prompt for {target} is still ~{encoded_tokens} tokens, over its budget of {budget}")
+    print(f"📦 Prompt for {target}: {len(requirement_doc or '') + len(bom_text or '')} → "
+          f"{len(requirement) + len(bom)} chars, ~{original_tokens} → ~{encoded_tokens} tokens")
+    return requirement, bom
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return {target: dict(values) for target, values in _stats.items()}
@@ -0,0 +1,414 @@
+"""
+Renders generated schematic code (Python using schemdraw or matplotlib) to
+SVG/PNG in sandboxed worker processes.
+
+Each render runs in a fresh process started from `render_worker.py` with
+`python -I -c`: an empty environment (no secrets or API keys), an empty
+working directory, a separate user (RENDER_USER) and no network (started
+through RENDER_SANDBOX_PREFIX, `unshare --net` by default). Inside, the worker
+sets RLIMIT_NPROC=0, RLIMIT_FSIZE=0, a bounded address space (RLIMIT_AS) and a
+CPU-time budget (RLIMIT_CPU), and an audit hook that only allows the events
+drawing code needs; a wall-clock timeout kills it. Up to RENDER_WORKERS
+processes are started ahead of time (their imports paid for) and each serves
+one render, so generated code cannot affect later renders.
+
+Images are stored in SCHEMATIC_DIR under the hash of the code, which doubles
+as the render cache.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import os
+import pwd
+import queue
+import re
+import select
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, Any, List
+
+from app.core.config import (
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_CPU_SECONDS, RENDER_MEMORY_MB, RENDER_TIMEOUT, SCHEMATIC_DIR,
+    SCHEMATIC_URL_PREFIX, RENDER_USER, RENDER_SANDBOX_PREFIX, RENDER_WORK_DIR,
+)
+from app.core import profiling
+
+os.makedirs(SCHEMATIC_DIR, exist_ok=True)
+
+_WORKER_SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_worker.py")
+# Seconds a new worker has to import the drawing libraries and report ready.
+_WORKER_START_TIMEOUT = 60
+# Largest response (base64 images) accepted from a worker.
+_MAX_RESPONSE_BYTES = 64 * 1024 * 1024
+
+_CODE_BLOCK_RE = re.compile(r"```(?:python|py)?\s*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderQueueFullError(RenderError):
+    pass
+
+
+def extract_code(text: str) -> str:
+    """
+    Returns the Python code of an LLM answer: the largest fenced code block,
+    or the whole text when it has none.
+    """
+    blocks = _CODE_BLOCK_RE.findall(text or "")
+    code = max(blocks, key=len) if blocks else (text or "")
+    return code.strip() + "\n"
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+# --- parent side -------------------------------------------------------------
+
+def _render_account() -> pwd.struct_passwd | None:
+    """
+    The account workers run as, or None when RENDER_USER is "none".
+    """
+    user = _describe_isolation()["user"]
+    if user == "none":
+        return None
+    try:
+        return pwd.getpwuid(int(user)) if user.isdigit() else pwd.getpwnam(user)
+    except KeyError:
+        raise RenderError(f"RENDER_USER {user!r} does not exist")
+
+
+def _sandbox_command(memory_mb: int, cpu_seconds: int) -> List[str]:
+    """
+    Builds the command starting a worker: the sandbox prefix, a switch to
+    the render user and the isolated interpreter. "none" disables a layer.
+    Raises RenderError for an unknown user or an unusable prefix.
+    """
+    prefix = _describe_isolation()["sandbox_prefix"]
+    try:
+        command = [] if prefix == "none" else shlex.split(prefix)
+    except ValueError as e:
+        raise RenderError(f"Invalid RENDER_SANDBOX_PREFIX: {e}")
+    if command and shutil.which(command[0]) is None:
+        raise RenderError(f"RENDER_SANDBOX_PREFIX command {command[0]!r} not found")
+    account = _render_account()
+    if account is not None:
+        command += ["setpriv", f"--reuid={account.pw_uid}", f"--regid={account.pw_gid}", "--clear-groups", "--no-new-privs", "--"]
+    with open(_WORKER_SOURCE_PATH, encoding="utf-8") as f:
+        source = f.read()
+    return command + [sys.executable, "-I", "-c", source, str(memory_mb), str(cpu_seconds)]
+
+
+def _describe_isolation() -> Dict[str, Any]:
+    is_root = os.geteuid() == 0
+    return {
+        "user": RENDER_USER or ("nobody" if is_root else "none"),
+        "sandbox_prefix": RENDER_SANDBOX_PREFIX or ("unshare --net --" if is_root else "unshare --user --net --"),
+    }
+
+
+class _Worker:
+    """
+    One sandboxed worker process, spoken to with one JSON line per message.
+    """
+
+    def __init__(self, command: List[str], work_dir: str):
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=work_dir, start_new_session=True,
+            env={
+                "PATH": "/usr/bin:/bin", "HOME": work_dir, "LANG": "C.UTF-8",
+                "MPLBACKEND": "Agg", "MPLCONFIGDIR": os.path.join(work_dir, "matplotlib"),
+                # Numeric libraries must not start threads once RLIMIT_NPROC is set.
+                "OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1",
+            },
+        )
+        self._buffer = bytearray()
+
+    def receive(self, timeout: float) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError()
+            if not select.select([fd], [], [], remaining)[0]:
+                continue
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                raise EOFError()
+            self._buffer += chunk
+            if len(self._buffer) > _MAX_RESPONSE_BYTES:
+                raise RenderError("The render worker returned too much data")
+        line, _, rest = bytes(self._buffer).partition(b"\n")
+        self._buffer = bytearray(rest)
+        try:
+            message = json.loads(line)
+        except ValueError:
+            raise RenderError("The render worker returned an invalid response")
+        if not isinstance(message, dict):
+            raise RenderError("The render worker returned an invalid response")
+        return message
+
+    def run(self, code: str, timeout: float) -> Dict[str, Any]:
+        self.process.stdin.write(json.dumps({"code": code}).encode() + b"\n")
+        self.process.stdin.flush()
+        return self.receive(timeout)
+
+    def kill(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class SchematicRenderer:
+    def __init__(self, workers: int, queue_size: int, cpu_seconds: int, memory_mb: int,
+                 timeout: float, media_dir: str, url_prefix: str):
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.timeout = timeout
+        self.media_dir = media_dir
+        self.url_prefix = url_prefix.rstrip("/")
+        self.work_dir = RENDER_WORK_DIR or os.path.join(tempfile.gettempdir(), "pcbtool-render")
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._lock = threading.Lock()
+        self._spawning = 0
+        self._closed = False
+        self._last_start_error: str | None = None
+        self._pending = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._stats = {"renders": 0, "cache_hits": 0, "failures": 0, "timeouts": 0, "rejected": 0}
+
+    # --- worker lifecycle --------------------------------------------------
+
+    def start(self) -> None:
+        """
+        Starts RENDER_WORKERS workers in the background, so the first render
+        does not wait for the drawing libraries to be imported.
+        """
+        isolation = _describe_isolation()
+        if "none" in isolation.values():
+            print(f"⚠️ Schematic render workers run without full isolation: {isolation}")
+        try:
+            # Checks RENDER_USER and RENDER_SANDBOX_PREFIX once, up front.
+            _sandbox_command(self.memory_mb, self.cpu_seconds)
+            self._prepare_work_dir()
+        except (RenderError, OSError) as e:
+            self._last_start_error = str(e)
+            print(f"❌ Schematic render workers cannot be started: {e}")
+            return
+        with self._lock:
+            self._closed = False
+        self._replenish()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+    def _prepare_work_dir(self) -> None:
+        """
+        The workers' home: matplotlib keeps its font cache here, written
+        before the limits are armed. Owned by the render user.
+        """
+        os.makedirs(os.path.join(self.work_dir, "matplotlib"), exist_ok=True)
+        account = _render_account()
+        if account is not None and os.geteuid() == 0:
+            for path in (self.work_dir, os.path.join(self.work_dir, "matplotlib")):
+                os.chown(path, account.pw_uid, account.pw_gid)
+        os.chmod(self.work_dir, 0o700)
+
+    def _spawn(self) -> _Worker:
+        """
+        Starts a worker and waits until it is ready. Every failure is raised
+        as RenderError and kept in `last_start_error`.
+        """
+        worker = None
+        try:
+            worker = _Worker(_sandbox_command(self.memory_mb, self.cpu_seconds), self.work_dir)
+            if not worker.receive(_WORKER_START_TIMEOUT).get("ready"):
+                raise RenderError("unexpected greeting")
+        except Exception as e:
+            if worker is not None:
+                worker.kill()
+            self._last_start_error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            raise RenderError(f"The schematic render sandbox could not be started ({self._last_start_error})")
+        self._last_start_error = None
+        return worker
+
+    def _replenish(self) -> None:
+        """
+        Starts workers in the background until RENDER_WORKERS are ready or starting.
+        """
+        with self._lock:
+            missing = 0 if self._closed else self.workers - self._idle.qsize() - self._spawning
+            self._spawning += max(missing, 0)
+        for _ in range(missing):
+            threading.Thread(target=self._spawn_idle, name="render-worker-start", daemon=True).start()
+
+    def _spawn_idle(self) -> None:
+        try:
+            worker = self._spawn()
+        except RenderError as e:
+            print(f"❌ {e}")
+            return
+        finally:
+            with self._lock:
+                self._spawning -= 1
+        with self._lock:
+            closed = self._closed
+        if closed:
+            worker.kill()
+        else:
+            self._idle.put(worker)
+
+    def _run(self, code: str) -> Dict[str, Any]:
+        """
+        Runs one render in a ready (or newly started) worker, which is then
+        discarded. Blocking; called in a thread.
+        """
+        with self._slots:
+            worker = None
+            while worker is None:
+                try:
+                    worker = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if worker.process.poll() is not None:
+                    worker.kill()
+                    worker = None
+            if worker is None:
+                worker = self._spawn()
+            try:
+                return worker.run(code, self.timeout)
+            except TimeoutError:
+                self._stats["timeouts"] += 1
+                raise RenderError(f"Rendering took longer than {self.timeout:g}s")
+            except (EOFError, BrokenPipeError):
+                self._stats["failures"] += 1
+                raise RenderError("The render worker crashed (memory limit exceeded?)")
+            except RenderError:
+                self._stats["failures"] += 1
+                raise
+            except Exception as e:
+                self._stats["failures"] += 1
+                raise RenderError(f"The render worker failed ({type(e).__name__}: {e})")
+            finally:
+                worker.kill()
+                self._replenish()
+
+    # --- media store -------------------------------------------------------
+
+    def _paths(self, key: str) -> Dict[str, str]:
+        return {fmt: os.path.join(self.media_dir, f"{key}.{fmt}") for fmt in ("svg", "png")}
+
+    def _urls(self, key: str) -> Dict[str, str | None]:
+        return {
+            f"{fmt}_url": f"{self.url_prefix}/{os.path.basename(path)}" if os.path.exists(path) else None
+            for fmt, path in self._paths(key).items()
+        }
+
+    def _store(self, key: str, images: Dict[str, bytes]) -> None:
+        for fmt, path in self._paths(key).items():
+            if fmt in images:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(images[fmt])
+                os.replace(tmp_path, path)
+
+    # --- rendering ---------------------------------------------------------
+
+    @profiling.traced("render_service.render")
+    async def render(self, text: str) -> Dict[str, Any]:
+        """
+        Renders schematic code and returns the URLs of the stored images.
+        Identical code is rendered once: later calls are served from the media
+        store, and concurrent calls share one render.
+        """
+        code = extract_code(text)
+        key = code_hash(code)
+        if os.path.exists(self._paths(key)["svg"]):
+            self._stats["cache_hits"] += 1
+            return {"hash": key, **self._urls(key), "cached": True, "render_seconds": 0.0}
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._stats["cache_hits"] += 1
+            return {**(await asyncio.shield(inflight)), "cached": True}
+
+        if self._pending >= self.workers + self.queue_size:
+            self._stats["rejected"] += 1
+            raise RenderQueueFullError("The schematic renderer is busy, please retry shortly")
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self._pending += 1
+        try:
+            result = await self._render_uncached(key, code)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            error = e if isinstance(e, RenderError) else RenderError(f"Rendering failed ({type(e).__name__}: {e})")
+            future.set_exception(error)
+            future.exception()  # mark retrieved when nobody else is waiting
+            if isinstance(e, Exception) and error is not e:
+                # E.g. the media store could not be written; callers only handle RenderError.
+                raise error from e
+            raise
+        finally:
+            self._pending -= 1
+            self._inflight.pop(key, None)
+
+    async def _render_uncached(self, key: str, code: str) -> Dict[str, Any]:
+        started = time.monotonic()
+        outcome = await asyncio.to_thread(self._run, code)
+        if "error" in outcome:
+            self._stats["failures"] += 1
+            raise RenderError(str(outcome["error"]))
+        try:
+            images = {fmt: base64.b64decode(outcome["images"][fmt], validate=True)
+                      for fmt in ("svg", "png") if fmt in outcome.get("images", {})}
+        except (AttributeError, TypeError, binascii.Error):
+            images = {}
+        if "svg" not in images:
+            self._stats["failures"] += 1
+            raise RenderError("The render worker returned an invalid response")
+        self._store(key, images)
+        self._stats["renders"] += 1
+        return {"hash": key, **self._urls(key), "cached": False, "render_seconds": round(time.monotonic() - started, 3)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers, "queue_size": self.queue_size, "pending": self._pending,
+            "ready_workers": self._idle.qsize(), "isolation": _describe_isolation(),
+            "last_start_error": self._last_start_error, **self._stats,
+        }
+
+
+renderer = SchematicRenderer(
+    RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_CPU_SECONDS, RENDER_MEMORY_MB, RENDER_TIMEOUT, SCHEMATIC_DIR,
+    SCHEMATIC_URL_PREFIX,
+)
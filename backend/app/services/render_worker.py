@@ -0,0 +1,185 @@
+"""
+The schematic render worker. `render_service` runs this file's source with
+`python -I -c` in a separate process, so nothing of the application (its
+modules, configuration or environment) is importable or inherited here.
+
+Usage: render_worker.py <memory_mb> <cpu_seconds>. Protocol: one JSON object
+per line. The worker prints {"ready": true} once it has imported the drawing
+libraries and armed its limits, then answers a single job {"code": ...} with
+{"images": {fmt: base64}} or {"error": message} and exits. The original stdout is kept for the protocol; file
+descriptor 1 is pointed at /dev/null so output of generated code cannot
+interleave with it.
+"""
+import base64
+import builtins
+import json
+import os
+import signal
+import sys
+
+# Audit events generated schematic code and the drawing libraries need.
+# Anything else (sockets, subprocesses, file changes, ctypes, ...) is refused.
+_ALLOWED_EVENTS = {
+    "builtins.id", "compile", "exec", "import", "marshal.loads", "object.__getattr__", "object.__setattr__",
+    "object.__delattr__", "open", "os.listdir", "os.scandir", "sys._getframe", "time.sleep",
+}
+_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+
+# Drawings and figures the generated code tried to save or show.
+_captured = []
+
+
+class RenderError(Exception):
+    pass
+
+
+class _CPULimitExceeded(BaseException):
+    """Raised from the SIGXCPU handler; a BaseException so `except Exception` in generated code does not swallow it."""
+
+
+def _audit(event, args):
+    if event not in _ALLOWED_EVENTS:
+        raise PermissionError(f"{event} is not allowed while rendering schematics")
+    if event == "open":
+        _, mode, flags = args
+        writing = isinstance(mode, str) and any(c in mode for c in "wax+")
+        if writing or (isinstance(flags, int) and flags > 0 and flags & _WRITE_FLAGS):
+            raise PermissionError("Writing files is not allowed while rendering schematics")
+
+
+def _on_cpu_limit(signum, frame):
+    raise _CPULimitExceeded()
+
+
+def _capture_saves():
+    """
+    Turns "save to file" and "show" calls of the drawing libraries into
+    captures, so code written for a desktop still renders.
+    """
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+
+        original_savefig = Figure.savefig
+
+        def savefig(self, fname, *args, **kwargs):
+            if isinstance(fname, (str, os.PathLike)):
+                _captured.append(self)
+                return None
+            return original_savefig(self, fname, *args, **kwargs)
+
+        Figure.savefig = savefig
+        plt.show = lambda *args, **kwargs: None
+    except ImportError:
+        pass
+    try:
+        import schemdraw
+
+        schemdraw.Drawing.save = lambda self, *args, **kwargs: _captured.append(self)
+    except ImportError:
+        pass
+
+
+def _init_worker(memory_mb, cpu_seconds):
+    import resource
+
+    # Pay for the imports (and matplotlib's font cache) before the sandbox is armed.
+    _capture_saves()
+
+    signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    # Writes to regular files fail with EFBIG instead of killing the worker.
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    # No new processes (or threads) for this user; only enforced for non-root users.
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    if memory_mb > 0:
+        try:
+            with open("/proc/self/statm") as f:
+                current = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            current = 0
+        limit = current + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # CPU time only runs while rendering: the budget starts from what the imports used.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+    resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, used + cpu_seconds + 1))
+    sys.addaudithook(_audit)
+
+
+def _figure_images(figure):
+    import io
+    images = {}
+    for fmt in ("svg", "png"):
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format=fmt, bbox_inches="tight")
+        images[fmt] = buffer.getvalue()
+    return images
+
+
+def _collect_images(namespace):
+    candidates = list(_captured)
+    try:
+        import schemdraw
+        candidates += [value for value in namespace.values() if isinstance(value, schemdraw.Drawing)]
+    except ImportError:
+        pass
+    try:
+        import matplotlib.pyplot as plt
+        candidates += [plt.figure(num) for num in plt.get_fignums()]
+    except ImportError:
+        pass
+    if not candidates:
+        raise RenderError("The code did not produce a drawing or figure")
+
+    target = candidates[0] if _captured else candidates[-1]
+    if hasattr(target, "get_imagedata"):
+        images = {"svg": target.get_imagedata("svg")}
+        try:
+            images["png"] = target.get_imagedata("png")
+        except ValueError:  # the pure SVG backend of schemdraw has no PNG output
+            pass
+        return images
+    return _figure_images(target)
+
+
+def _render_job(code, cpu_seconds):
+    """
+    Returns the images, or an error message.
+    """
+    try:
+        namespace = {"__name__": "__main__", "__builtins__": builtins}
+        exec(compile(code, "<schematic>", "exec"), namespace)
+        images = _collect_images(namespace)
+        return {"images": {fmt: base64.b64encode(data).decode("ascii") for fmt, data in images.items()}}
+    except _CPULimitExceeded:
+        return {"error": f"CPU time limit of {cpu_seconds}s exceeded"}
+    except MemoryError:
+        return {"error": "Memory limit exceeded"}
+    except BaseException as e:  # includes SystemExit from generated code
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def main():
+    protocol = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    sys.stdout = open(1, "w", closefd=False)
+
+    def send(message):
+        protocol.write(json.dumps(message) + "\n")
+        protocol.flush()
+
+    cpu_seconds = int(sys.argv[2])
+    _init_worker(int(sys.argv[1]), cpu_seconds)
+    send({"ready": True})
+    line = sys.stdin.readline()
+    if line:
+        send(_render_job(json.loads(line)["code"], cpu_seconds))
+
+
+if __name__ == "__main__":
+    main()
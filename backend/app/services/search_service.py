@@ -0,0 +1,372 @@
+import csv
+import html
+import io
+import json
+import re
+from typing import Dict, Any, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import Session
+
+from app.db import models as db_models
+from app.services import component_service
+
+# The index lives in a single SQLite FTS5 table, or on PostgreSQL in a plain
+# table with a generated tsvector column under a GIN index. Rows are addressed
+# by rowid so that incremental updates never scan the index:
+#   - message rows use the message id as rowid
+#   - conversation title rows use the negated conversation id as rowid
+# On SQLite the "owner" column holds a "u<user_id>" token, which lets every
+# query be scoped to one user through the full-text index itself; on
+# PostgreSQL it is the user id, filtered through its own index.
+SEARCH_TABLE = "search_index"
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+# snippet() marks matches with these private-use characters; the snippet is
+# HTML-escaped before they become HIGHLIGHT_START/END, so indexed text can
+# never inject markup.
+_SENTINEL_START = "\ue000"
+_SENTINEL_END = "\ue001"
+SNIPPET_ELLIPSIS = "…"
+SNIPPET_TOKENS = 24
+
+# unicode61 treats a run of CJK characters as one token, so "电机驱动板" could
+# only be found by its full spelling. Every CJK character is wrapped in
+# zero-width spaces (a separator for unicode61) before indexing, which turns
+# each character into its own token and lets phrase queries match any word
+# inside a sentence. The markers are stripped again from the snippets.
+# PostgreSQL's parser keeps zero-width spaces inside words, so there the
+# marker is the (equally invisible) unit separator. It also drops anything
+# looking like an HTML tag (`#include <stdio.h>`), so "<" is indexed as the
+# record separator and restored in snippets.
+_ZWSP = "\u200b"
+_UNIT_SEPARATOR = "\x1f"
+_RECORD_SEPARATOR = "\x1e"
+_CJK_RE = re.compile(r"([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af])")
+
+_enabled = False
+
+
+def _is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _segment(value: str, marker: str = _ZWSP) -> str:
+    for character in (_ZWSP, _UNIT_SEPARATOR, _RECORD_SEPARATOR, _SENTINEL_START, _SENTINEL_END):
+        value = value.replace(character, "")
+    if marker == _UNIT_SEPARATOR:
+        value = value.replace("<", _RECORD_SEPARATOR)
+    return _CJK_RE.sub(marker + r"\1" + marker, value)
+
+
+def _unsegment(value: str) -> str:
+    return value.replace(_ZWSP, "").replace(_UNIT_SEPARATOR, "").replace(_RECORD_SEPARATOR, "<")
+
+
+def _highlight(snippet: str) -> str:
+    # Adjacent highlights (ts_headline marks each CJK character) become one.
+    escaped = html.escape(_unsegment(snippet), quote=False).replace(_SENTINEL_END + _SENTINEL_START, "")
+    return escaped.replace(_SENTINEL_START, HIGHLIGHT_START).replace(_SENTINEL_END, HIGHLIGHT_END)
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def init_search_index(engine: Engine) -> None:
+    """
+    Creates the index table if needed and backfills it from existing data.
+    Search stays disabled on databases other than SQLite (with FTS5) and
+    PostgreSQL.
+    """
+    global _enabled
+    if engine.dialect.name not in ("sqlite", "postgresql"):
+        print(f"⚠️ Full-text search is not available on {engine.dialect.name}; search is disabled.")
+        return
+
+    try:
+        with engine.begin() as conn:
+            if engine.dialect.name == "postgresql":
+                exists = conn.execute(text("SELECT to_regclass(:name)"), {"name": SEARCH_TABLE}).scalar()
+                if not exists:
+                    conn.execute(text(
+                        f"CREATE TABLE {SEARCH_TABLE} ("
+                        "rowid BIGINT PRIMARY KEY, owner INTEGER NOT NULL, body TEXT NOT NULL, "
+                        "conversation_id INTEGER NOT NULL, message_id INTEGER, kind TEXT NOT NULL, "
+                        "tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', body)) STORED)"
+                    ))
+                    conn.execute(text(f"CREATE INDEX ix_{SEARCH_TABLE}_tsv ON {SEARCH_TABLE} USING GIN (tsv)"))
+                    conn.execute(text(f"CREATE INDEX ix_{SEARCH_TABLE}_owner ON {SEARCH_TABLE} (owner)"))
+            else:
+                exists = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                    {"name": SEARCH_TABLE},
+                ).first()
+                if not exists:
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+                        "owner, body, conversation_id UNINDEXED, message_id UNINDEXED, kind UNINDEXED, "
+                        "tokenize = 'unicode61 remove_diacritics 2')"
+                    ))
+                    # Rank only on the body; the owner column is a pure filter.
+                    conn.execute(text(
+                        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) VALUES('rank', 'bm25(0.0, 1.0)')"
+                    ))
+    except (OperationalError, ProgrammingError) as e:
+        print(f"⚠️ Could not create full-text search index: {e}")
+        return
+
+    _enabled = True
+    if not exists:
+        with Session(engine) as db:
+            rebuild_index(db)
+            db.commit()
+
+
+def extract_message_text(content: Dict[str, Any]) -> str:
+    """
+    Extracts the searchable text of a message: requirement documents, BOM part
+    numbers and generated code.
+    """
+    data = content.get("data") or {}
+    if not isinstance(data, dict):
+        return ""
+
+    parts = []
+    req_doc = data.get("需求文档")
+    if req_doc:
+        parts.append(str(req_doc))
+
+    components = data.get("components")
+    if components:
+        parts.extend(str(c.get("器件名称")) for c in components if c.get("器件名称"))
+    elif data.get("BOM文件"):
+        parts.extend(_extract_part_numbers(str(data["BOM文件"])))
+
+    if content.get("type") in ("generated_code", "schematic_code") and data.get("code"):
+        parts.append(str(data["code"]))
+
+    return "\n".join(parts)
+
+
+def _extract_part_numbers(bom_text: str) -> List[str]:
+    csv_content = component_service.extract_csv_from_text(bom_text)
+    if not csv_content:
+        return []
+    try:
+        reader = csv.DictReader(io.StringIO(csv_content))
+        return [row["元器件型号"] for row in reader if row.get("元器件型号")]
+    except (csv.Error, KeyError):
+        return []
+
+
+def _upsert(db: Session, rowid: int, user_id: int, body: str, conversation_id: int, message_id: int | None, kind: str) -> None:
+    db.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :rowid"), {"rowid": rowid})
+    if not body:
+        return
+    postgres = _is_postgres(db)
+    db.execute(
+        text(
+            f"INSERT INTO {SEARCH_TABLE}(rowid, owner, body, conversation_id, message_id, kind) "
+            "VALUES (:rowid, :owner, :body, :conversation_id, :message_id, :kind)"
+        ),
+        {
+            "rowid": rowid,
+            "owner": user_id if postgres else f"u{user_id}",
+            "body": _segment(body, _UNIT_SEPARATOR if postgres else _ZWSP),
+            "conversation_id": conversation_id,
+            "message_id": message_id,
+            "kind": kind,
+        },
+    )
+
+
+def index_conversation(db: Session, conversation) -> None:
+    """
+    Adds or refreshes the title entry of a conversation. Runs inside the
+    caller's transaction.
+    """
+    if not _enabled:
+        return
+    _upsert(db, -conversation.id, conversation.user_id, conversation.title or "", conversation.id, None, "title")
+
+
+def index_message(db: Session, message, user_id: int) -> None:
+    """
+    Adds or refreshes the entry of a message. Runs inside the caller's transaction.
+    """
+    if not _enabled:
+        return
+    try:
+        content = json.loads(message.content)
+    except (TypeError, json.JSONDecodeError):
+        return
+    _upsert(db, message.id, user_id, extract_message_text(content), message.conversation_id, message.id, content.get("type", "message"))
+
+
+def remove_conversations(db: Session, conversation_ids: List[int]) -> None:
+    """
+    Removes the title entries and all message entries of the given
+    conversations. Must run before their messages are deleted.
+    """
+    if not _enabled or not conversation_ids:
+        return
+    for start in range(0, len(conversation_ids), 500):
+        batch = list(conversation_ids[start:start + 500])
+        placeholders = ", ".join(f":c{i}" for i in range(len(batch)))
+        params = {f"c{i}": conversation_id for i, conversation_id in enumerate(batch)}
+        db.execute(
+            text(
+                f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN "
+                f"(SELECT id FROM messages WHERE conversation_id IN ({placeholders}))"
+            ),
+            params,
+        )
+        remove_rowids(db, [-conversation_id for conversation_id in batch])
+
+
+def remove_rowids(db: Session, rowids: List[int]) -> None:
+    """
+    Removes index entries by rowid: message ids, or negated conversation ids
+    for titles.
+    """
+    if not _enabled:
+        return
+    for start in range(0, len(rowids), 500):
+        batch = rowids[start:start + 500]
+        placeholders = ", ".join(f":r{i}" for i in range(len(batch)))
+        db.execute(
+            text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({placeholders})"),
+            {f"r{i}": rowid for i, rowid in enumerate(batch)},
+        )
+
+
+def merge_segments(db: Session, pages: int = 500) -> None:
+    """
+    Incrementally merges index segments left behind by deletes, doing about
+    `pages` pages of work. PostgreSQL's autovacuum does this for its GIN index.
+    """
+    if not _enabled or _is_postgres(db):
+        return
+    db.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) VALUES('merge', :pages)"), {"pages": pages})
+
+
+def rebuild_index(db: Session) -> int:
+    """
+    Re-indexes every conversation and message. Returns the number of indexed rows.
+    """
+    if not _enabled:
+        return 0
+    db.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    count = 0
+    for conversation in db.query(db_models.Conversation).yield_per(500):
+        index_conversation(db, conversation)
+        count += 1
+    rows = (
+        db.query(db_models.Message, db_models.Conversation.user_id)
+        .join(db_models.Conversation, db_models.Message.conversation_id == db_models.Conversation.id)
+        .yield_per(500)
+    )
+    for message, user_id in rows:
+        index_message(db, message, user_id)
+        count += 1
+    return count
+
+
+def build_match_query(query: str, user_id: int) -> str | None:
+    """
+    Turns free text into an FTS5 expression: every whitespace-separated term
+    must appear as a phrase in the body, restricted to the user's rows.
+    """
+    terms = [term.replace('"', '""') for term in query.split()]
+    terms = [_segment(term) for term in terms if term.strip('"')]
+    if not terms:
+        return None
+    phrases = " AND ".join(f'"{term}"' for term in terms)
+    return f'owner : u{user_id} AND body : ({phrases})'
+
+
+def _search_postgres(db: Session, user_id: int, query: str, limit: int, offset: int) -> list:
+    """
+    The PostgreSQL form of `search`: every term must appear as a phrase
+    (phraseto_tsquery), ranked by ts_rank and highlighted by ts_headline.
+    """
+    terms = [_segment(term, _UNIT_SEPARATOR) for term in query.split()]
+    if not terms:
+        return []
+    tsquery = " && ".join(f"phraseto_tsquery('simple', :t{i})" for i in range(len(terms)))
+    # ts_headline counts words, so SNIPPET_TOKENS matches the SQLite snippet length.
+    options = (f'StartSel="{_SENTINEL_START}", StopSel="{_SENTINEL_END}", MaxFragments=1, '
+               f"MaxWords={SNIPPET_TOKENS}, MinWords={SNIPPET_TOKENS // 3}, ShortWord=0")
+    return db.execute(
+        text(
+            "SELECT s.conversation_id, s.message_id, s.kind, "
+            "ts_headline('simple', s.body, s.query, :options) AS snippet, c.title "
+            "FROM ("
+            "  SELECT conversation_id, message_id, kind, body, query, ts_rank(tsv, query) AS rank "
+            f"  FROM {SEARCH_TABLE}, (SELECT {tsquery} AS query) q "
+            "  WHERE owner = :owner AND tsv @@ query "
+            "  ORDER BY rank DESC, rowid LIMIT :limit OFFSET :offset"
+            ") s JOIN conversations c ON c.id = s.conversation_id "
+            "ORDER BY s.rank DESC"
+        ),
+        {
+            **{f"t{i}": term for i, term in enumerate(terms)},
+            "options": options,
+            "owner": user_id,
+            "limit": limit + 1,
+            "offset": offset,
+        },
+    ).all()
+
+
+def search(db: Session, user_id: int, query: str, limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Searches the user's conversations, best matches first.
+    Returns one page of hits with HTML-escaped, highlighted snippets, and whether more hits exist.
+    """
+    if _is_postgres(db):
+        return _hits(_search_postgres(db, user_id, query, limit, offset), limit)
+
+    match = build_match_query(query, user_id)
+    if match is None:
+        return [], False
+
+    rows = db.execute(
+        text(
+            "SELECT s.conversation_id, s.message_id, s.kind, s.snippet, c.title "
+            "FROM ("
+            f"  SELECT conversation_id, message_id, kind, rank, "
+            f"  snippet({SEARCH_TABLE}, 1, :hl_start, :hl_end, :ellipsis, :tokens) AS snippet "
+            f"  FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match "
+            "  ORDER BY rank LIMIT :limit OFFSET :offset"
+            ") s JOIN conversations c ON c.id = s.conversation_id "
+            "ORDER BY s.rank"
+        ),
+        {
+            "match": match,
+            "hl_start": _SENTINEL_START,
+            "hl_end": _SENTINEL_END,
+            "ellipsis": SNIPPET_ELLIPSIS,
+            "tokens": SNIPPET_TOKENS,
+            "limit": limit + 1,
+            "offset": offset,
+        },
+    ).all()
+    return _hits(rows, limit)
+
+
+def _hits(rows: list, limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+    hits = [
+        {
+            "conversation_id": row.conversation_id,
+            "conversation_title": row.title,
+            "message_id": row.message_id,
+            "kind": row.kind,
+            "snippet": _highlight(row.snippet),
+        }
+        for row in rows[:limit]
+    ]
+    return hits, len(rows) > limit
@@ -0,0 +1,107 @@
+"""
+Benchmarks the multi-store BOM purchase optimizer on synthetic price tables.
+
+    cd backend && python scripts/bench_bom_optimizer.py --lines 1000 --stores 10 --tiers 4
+
+Also checks the vectorized solver against a brute-force reference on a small
+instance, and reports how close the heuristic gets to the exact optimum.
+"""
+import argparse
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from app.services.pricing_service import PriceBook, optimize_purchase
+
+
+def synthetic_tables(n_parts: int, n_stores: int, n_tiers: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    parts = [f"PART-{i:05d}" for i in range(n_parts)]
+    base_price = rng.lognormal(mean=0.0, sigma=1.0, size=n_parts)
+    tables = {}
+    for s in range(n_stores):
+        # Each store lists ~85% of the parts, with its own markup and price breaks.
+        listed = rng.random(n_parts) < 0.85
+        markup = rng.uniform(0.85, 1.25, size=n_parts)
+        rows = []
+        for p in np.flatnonzero(listed):
+            moq = int(rng.choice([1, 1, 5, 10]))
+            stock = int(rng.choice([50, 500, 5000, 100000]))
+            for t in range(n_tiers):
+                rows.append((parts[p], 10 ** t, round(base_price[p] * markup[p] * (0.9 ** t), 4), moq, stock))
+        tables[f"store{s:02d}"] = pd.DataFrame(rows, columns=["part", "break_qty", "unit_price", "moq", "stock"])
+    shipping = {f"store{s:02d}": float(rng.uniform(5, 40)) for s in range(n_stores)}
+    return parts, tables, shipping
+
+
+def synthetic_bom(parts, n_lines: int, seed: int = 1) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(len(parts), size=n_lines, replace=n_lines > len(parts))
+    return pd.DataFrame({
+        "元器件型号": [parts[i] for i in chosen],
+        "数量": rng.choice([1, 2, 4, 8, 20, 50, 120], size=n_lines),
+    })
+
+
+def brute_force_total(book: PriceBook, bom: pd.DataFrame) -> float:
+    costs, _, _ = book.line_costs(bom["元器件型号"].tolist(), bom["数量"].to_numpy(dtype=float))
+    costs = costs[np.isfinite(costs).any(axis=1)]
+    best = np.inf
+    for r in range(1, len(book.stores) + 1):
+        for subset in itertools.combinations(range(len(book.stores)), r):
+            total = costs[:, list(subset)].min(axis=1).sum() + book.shipping[list(subset)].sum()
+            best = min(best, total)
+    return float(best)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1000)
+    parser.add_argument("--stores", type=int, default=10)
+    parser.add_argument("--tiers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # Correctness on a small instance.
+    parts, tables, shipping = synthetic_tables(60, 5, 3, seed=42)
+    book = PriceBook.from_frames(tables, shipping)
+    bom = synthetic_bom(parts, 40, seed=7)
+    exact = optimize_purchase(book, bom)
+    reference = brute_force_total(book, bom)
+    print(f"check: optimizer {exact['total']:.4f} vs brute force {reference:.4f} "
+          f"({'OK' if abs(exact['total'] - reference) < 1e-6 else 'MISMATCH'})")
+
+    parts, tables, shipping = synthetic_tables(max(args.lines, 2000), args.stores, args.tiers)
+    started = time.perf_counter()
+    book = PriceBook.from_frames(tables, shipping)
+    load_seconds = time.perf_counter() - started
+    bom = synthetic_bom(parts, args.lines)
+
+    timings = {"exact": [], "heuristic": []}
+    results = {}
+    for _ in range(args.repeat):
+        for method, limit in (("exact", args.stores), ("heuristic", 0)):
+            started = time.perf_counter()
+            results[method] = optimize_purchase(book, bom, exact_max_stores=limit)
+            timings[method].append(time.perf_counter() - started)
+
+    combos = args.lines * args.stores * book.prices.shape[2]
+    print(f"price book: {len(book.parts)} parts x {len(book.stores)} stores x {book.prices.shape[2]} tiers, "
+          f"loaded in {load_seconds * 1000:.1f} ms")
+    print(f"BOM: {args.lines} lines -> {combos:,} (line x store x tier) combinations")
+    for method, values in timings.items():
+        result = results[method]
+        print(f"{method:<9} median {np.median(values) * 1000:8.1f} ms   total {result['total']:12.2f}   "
+              f"stores used {len(result['store_subtotals'])}   unavailable {len(result['unavailable'])}")
+    gap = results["heuristic"]["total"] / results["exact"]["total"] - 1
+    print(f"heuristic gap vs exact: {gap * 100:.3f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmarks the streaming conversation export on a synthetic SQLite database.
+
+    cd backend && python scripts/bench_export.py --messages 1000000 --per-conversation 50
+
+Builds a temporary database with one user, exports it as NDJSON and as zip to
+a byte counter, and reports throughput together with the resident set size
+before and during each export. With --naive, also loads the history through
+the ORM (what serializing `schemas.Conversation` would do) for comparison.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--messages", type=int, default=1_000_000)
+parser.add_argument("--per-conversation", type=int, default=50)
+parser.add_argument("--naive", action="store_true", help="also measure loading the history through the ORM")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="pcbtool-export-bench-")
+db_path = os.path.join(workdir, "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlite3
+
+from app.db import models, crud
+from app.db.database import engine, SessionLocal
+from app.services import export_service
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 2**20
+
+
+class RssSampler:
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self.peak = rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+
+def synthetic_content(i: int) -> str:
+    kind = i % 4
+    if kind == 0:
+        return json.dumps({"type": "analysis_result", "data": {
+            "需求文档": f"需求 {i}: 基于 STM32 的温湿度采集节点，带 LoRa 上报。" * 3,
+            "BOM文件": "```csv\n元器件型号,数量\nSTM32F103C8T6,1\nSX1278,1\nSHT30,2\n```",
+        }}, ensure_ascii=False)
+    if kind == 1:
+        return json.dumps({"type": "generated_code", "data": {"language": "python", "code": f"# {i}\nprint('hello')\n" * 8}})
+    if kind == 2:
+        return json.dumps({"type": "schematic_code", "data": {"language": "python", "code": "import schemdraw\n" * 6}})
+    return json.dumps({"type": "deployment_guide", "data": {"text": "部署步骤……" * 40, "audio_url": None}}, ensure_ascii=False)
+
+
+def populate(n_messages: int, per_conversation: int) -> int:
+    models.Base.metadata.create_all(bind=engine)
+    conn = sqlite3.connect(db_path)
+    conn.execute("INSERT INTO users (id, username, hashed_password) VALUES (1, 'bench', 'x')")
+    n_conversations = (n_messages + per_conversation - 1) // per_conversation
+    conn.executemany(
+        "INSERT INTO conversations (id, title, user_id, created_at) VALUES (?, ?, 1, CURRENT_TIMESTAMP)",
+        ((c + 1, f"Conversation {c + 1}") for c in range(n_conversations)),
+    )
+    conn.executemany(
+        "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+        ((i // per_conversation + 1, "assistant" if i % 2 else "user", synthetic_content(i)) for i in range(n_messages)),
+    )
+    conn.commit()
+    conn.close()
+    return n_conversations
+
+
+def run_export(fmt: str) -> None:
+    db = SessionLocal()
+    try:
+        baseline = rss_mb()
+        written = 0
+        started = time.perf_counter()
+        with RssSampler() as sampler:
+            for chunk in export_service.export(db, 1, fmt):
+                written += len(chunk)
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+    print(f"{fmt:<7} {elapsed:7.1f} s  {args.messages / elapsed:9,.0f} msg/s  {written / 2**20:9.1f} MiB written  "
+          f"RSS {baseline:6.1f} -> peak {sampler.peak:6.1f} MiB (+{sampler.peak - baseline:.1f})")
+
+
+def run_naive() -> None:
+    db = SessionLocal()
+    try:
+        baseline = rss_mb()
+        started = time.perf_counter()
+        with RssSampler() as sampler:
+            history = [
+                {"id": c.id, "messages": [m.to_dict() for m in c.messages]}
+                for c in crud.get_conversations_by_user(db, user_id=1)
+            ]
+        elapsed = time.perf_counter() - started
+        del history
+    finally:
+        db.close()
+    print(f"{'naive':<7} {elapsed:7.1f} s  {args.messages / elapsed:9,.0f} msg/s  {'':>20}  "
+          f"RSS {baseline:6.1f} -> peak {sampler.peak:6.1f} MiB (+{sampler.peak - baseline:.1f})")
+
+
+def main() -> None:
+    started = time.perf_counter()
+    n_conversations = populate(args.messages, args.per_conversation)
+    size = os.path.getsize(db_path) / 2**20
+    print(f"database: {args.messages:,} messages in {n_conversations:,} conversations, {size:.0f} MiB, "
+          f"built in {time.perf_counter() - started:.1f} s")
+    try:
+        for fmt in ("ndjson", "zip"):
+            run_export(fmt)
+        if args.naive:
+            run_naive()
+    finally:
+        engine.dispose()
+        os.remove(db_path)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Measures message inserts per second with the group-commit queue off and on.
+
+    cd backend && python scripts/bench_group_commit.py --streams 32 --messages 50
+
+Runs --streams concurrent asyncio tasks on a temporary SQLite database, each
+saving --messages messages through `write_queue.save_message` the way the
+generation streams do. Without the queue every message is its own
+transaction on the event loop; with it, the writer thread batches them
+(--max-batch rows or --latency ms). Reports throughput and the time each
+caller waited for its message to be durable.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--streams", type=int, default=32)
+parser.add_argument("--messages", type=int, default=50)
+parser.add_argument("--max-batch", type=int, default=64)
+parser.add_argument("--latency", type=float, default=5.0, help="GROUP_COMMIT_MAX_LATENCY_MS")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="pcbtool-group-commit-bench-")
+db_path = os.path.join(workdir, "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+os.environ["GROUP_COMMIT_MAX_BATCH"] = str(args.max_batch)
+os.environ["GROUP_COMMIT_MAX_LATENCY_MS"] = str(args.latency)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import crud, models, write_queue
+from app.db.database import engine, SessionLocal
+from app.services import search_service
+
+CONTENT = {"type": "generated_code", "data": {"language": "python", "code": "print('hello')\n" * 20}}
+
+
+def prepare() -> list:
+    models.Base.metadata.create_all(bind=engine)
+    search_service.init_search_index(engine)
+    db = SessionLocal()
+    try:
+        owners = []
+        for n in range(args.streams):
+            user = models.User(username=f"bench{n}", hashed_password="x")
+            db.add(user)
+            db.commit()
+            owners.append((user.id, crud.create_conversation(db, user_id=user.id, title=f"bench {n}").id))
+        return owners
+    finally:
+        db.close()
+
+
+async def stream(user_id: int, conversation_id: int, waits: list) -> None:
+    for _ in range(args.messages):
+        started = time.perf_counter()
+        # A session per message, like a request; more streams than the
+        # connection pool holds would otherwise block on checkout.
+        with SessionLocal() as db:
+            await write_queue.save_message(db, conversation_id, "assistant", CONTENT, user_id)
+        waits.append(time.perf_counter() - started)
+        # Give the other streams a turn, as token events would.
+        await asyncio.sleep(0)
+
+
+async def run(owners: list) -> tuple:
+    waits: list = []
+    started = time.perf_counter()
+    await asyncio.gather(*(stream(user_id, conversation_id, waits) for user_id, conversation_id in owners))
+    return time.perf_counter() - started, sorted(waits)
+
+
+def report(name: str, elapsed: float, waits: list) -> None:
+    total = len(waits)
+    print(f"{name:<13} {total / elapsed:8,.0f} msg/s  wait p50 {waits[total // 2] * 1000:6.1f} ms  "
+          f"p99 {waits[int(total * 0.99)] * 1000:7.1f} ms")
+
+
+def main() -> None:
+    owners = prepare()
+    print(f"{args.streams} streams x {args.messages} messages; batches of up to {args.max_batch} rows / {args.latency} ms")
+    try:
+        report("group commit off", *asyncio.run(run(owners)))
+        write_queue.message_queue.start()
+        try:
+            report("group commit on", *asyncio.run(run(owners)))
+        finally:
+            write_queue.message_queue.stop()
+        stats = write_queue.message_queue.stats()
+        print(f"{stats['batches']} batches, {stats['average_batch']} rows on average, largest {stats['largest_batch']}")
+    finally:
+        engine.dispose()
+        os.remove(db_path)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
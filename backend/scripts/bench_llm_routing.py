@@ -0,0 +1,81 @@
+"""
+Exercises the LLM router against local stand-in servers with injected latency
+and failures, and reports how traffic was distributed.
+
+    cd backend && python scripts/bench_llm_routing.py --requests 40 --concurrency 4 --hedge-after 1.0
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+
+from app.services.llm_router import LLMBackend, LLMRouter
+from scripts.llm_standin_server import create_app
+
+STANDINS = [
+    # name, port, ttft, tokens/s, failure rate
+    ("slow", 9101, 1.5, 40.0, 0.0),
+    ("fast", 9102, 0.2, 150.0, 0.0),
+    ("flaky", 9103, 0.1, 200.0, 0.5),
+]
+
+
+def start_standins(tokens: int) -> None:
+    for _, port, ttft, tps, failure_rate in STANDINS:
+        config = uvicorn.Config(create_app(ttft, tps, tokens, failure_rate), host="127.0.0.1", port=port, log_level="error")
+        threading.Thread(target=uvicorn.Server(config).run, daemon=True).start()
+    time.sleep(1.0)
+
+
+async def run(requests: int, concurrency: int, hedge_after: float) -> None:
+    backends = [
+        LLMBackend(name=f"{name}-{hedge_after}", base_url=f"http://127.0.0.1:{port}/v1", api_key="x", model="stand-in",
+                   max_concurrency=concurrency)
+        for name, port, *_ in STANDINS
+    ]
+    router = LLMRouter(backends, alpha=0.3, hedge_after=hedge_after)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one() -> None:
+        nonlocal failures
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                await router.complete([{"role": "user", "content": "hello"}], expected_chars=1000)
+                latencies.append(time.monotonic() - started)
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+
+    label = f"hedge after {hedge_after}s" if hedge_after else "no hedging"
+    print(f"\n== {label}: {requests} requests, concurrency {concurrency}")
+    if latencies:
+        latencies.sort()
+        print(f"latency mean {statistics.mean(latencies):.2f}s  p50 {latencies[len(latencies) // 2]:.2f}s  "
+              f"p95 {latencies[int(len(latencies) * 0.95) - 1]:.2f}s  failures {failures}")
+    for snapshot in router.snapshot():
+        print(f"  {snapshot['name']:<16} completed {snapshot['completed']:>3}  failed {snapshot['failed']:>3}  "
+              f"ttft {snapshot['ttft_ewma']}  chars/s {snapshot['throughput_ewma']}  breaker {snapshot['breaker_state']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--hedge-after", type=float, default=1.0)
+    args = parser.parse_args()
+
+    start_standins(args.tokens)
+    asyncio.run(run(args.requests, args.concurrency, 0.0))
+    asyncio.run(run(args.requests, args.concurrency, args.hedge_after))
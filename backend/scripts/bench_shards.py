@@ -0,0 +1,110 @@
+"""
+Measures concurrent message inserts with a single SQLite file and with
+sharded storage.
+
+    cd backend && python scripts/bench_shards.py --users 8 --messages 300
+
+Each of --users threads writes --messages messages for its own user through
+`crud.create_message`, one commit per message like a generation stream. The
+layouts are run in separate processes (storage settings are read at import)
+on temporary databases, reporting throughput, the slowest commit and how
+many commits failed with "database is locked".
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+LAYOUTS = {"single": "", "user": "user", "hash": "hash"}
+
+
+def run_layout(args) -> None:
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from sqlalchemy.exc import OperationalError
+
+    from app.db import crud, models
+    from app.db.database import engine, SessionLocal
+    from app.services import search_service
+
+    models.Base.metadata.create_all(bind=engine)
+    search_service.init_search_index(engine)
+    db = SessionLocal()
+    conversations = []
+    for n in range(args.users):
+        user = models.User(username=f"bench{n}", hashed_password="x")
+        db.add(user)
+        db.commit()
+        conversations.append((user.id, crud.create_conversation(db, user_id=user.id, title=f"bench {n}").id))
+    db.close()
+
+    content = {"type": "generated_code", "data": {"language": "python", "code": "print('hello')\n" * 20}}
+    latencies, locked = [], [0]
+    lock = threading.Lock()
+
+    def writer(user_id: int, conversation_id: int) -> None:
+        db = SessionLocal()
+        try:
+            for _ in range(args.messages):
+                started = time.perf_counter()
+                try:
+                    crud.create_message(db, conversation_id, "assistant", content, user_id=user_id)
+                except OperationalError:
+                    db.rollback()
+                    with lock:
+                        locked[0] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=writer, args=pair) for pair in conversations]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(json.dumps({
+        "msgs_per_sec": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+        "max_ms": latencies[-1] * 1000 if latencies else None,
+        "locked": locked[0],
+    }))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--shard-count", type=int, default=4, help="buckets for the hash layout")
+    parser.add_argument("--layout", choices=sorted(LAYOUTS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.layout:
+        run_layout(args)
+        return
+
+    print(f"{args.users} writers x {args.messages} messages")
+    for layout, mode in LAYOUTS.items():
+        with tempfile.TemporaryDirectory(prefix="pcbtool-shard-bench-") as workdir:
+            env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'main.db')}", SHARD_MODE=mode,
+                       SHARD_DIR=os.path.join(workdir, "shards"), SHARD_COUNT=str(args.shard_count))
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--layout", layout,
+                 "--users", str(args.users), "--messages", str(args.messages)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            name = layout if layout != "hash" else f"hash/{args.shard_count}"
+            print(f"{name:<7} {result['msgs_per_sec']:8,.0f} msg/s  p50 {result['p50_ms']:6.1f} ms  "
+                  f"max {result['max_ms']:8.1f} ms  {result['locked']} locked")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Compares code-generation SSE streams with and without token-event coalescing.
+
+    cd backend && python scripts/bench_sse_coalescing.py --streams 10 --events 400 --interval 10
+
+Starts the app with uvicorn on a temporary SQLite database and replaces the
+Dify code-generation stream with a synthetic one emitting --events token
+events, --interval ms apart. Then runs --streams concurrent generations with
+`?coalesce=off` and with `?coalesce=<--flush ms>`, and reports per stream the
+SSE frames and body bytes received, the CPU time of the server thread (read
+from /proc, so Linux only) and that of the client parsing the events.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--streams", type=int, default=10)
+parser.add_argument("--events", type=int, default=400)
+parser.add_argument("--interval", type=float, default=10.0, help="ms between upstream events")
+parser.add_argument("--flush", type=float, default=40.0, help="coalescing interval in ms")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="pcbtool-sse-bench-")
+db_path = os.path.join(workdir, "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+os.environ["MAINTENANCE_INTERVAL_SECONDS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+
+from app.db import crud, models
+from app.db.database import SessionLocal, engine
+from app.services import dify_service, security_service
+
+
+async def synthetic_code_stream(user, req_doc, bom_csv):
+    for i in range(args.events):
+        await asyncio.sleep(args.interval / 1000)
+        yield json.dumps({"event": "message", "answer": f"tok{i} ", "conversation_id": "c0ffee", "message_id": "m0"})
+    yield json.dumps({"event": "message_end", "conversation_id": "c0ffee", "message_id": "m0"})
+
+
+def thread_cpu_seconds(thread: threading.Thread) -> float:
+    with open(f"/proc/self/task/{thread.native_id}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15 of the full line.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def prepare() -> tuple:
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user = models.User(username="bench", hashed_password="x")
+        db.add(user)
+        db.commit()
+        conversation = crud.create_conversation(db, user_id=user.id, title="bench")
+        message = crud.create_message(db, conversation.id, "assistant", {"type": "initial_analysis", "data": {
+            "需求文档": "bench", "BOM文件": "```csv\n元器件型号,数量\nSTM32F103C8T6,1\n```"}})
+        return conversation.id, message.id
+    finally:
+        db.close()
+
+
+async def run(base: str, coalesce: str, conversation_id: int, message_id: int, streams: int = args.streams) -> tuple:
+    token = security_service.create_access_token({"sub": "bench"})
+    limits = httpx.Limits(max_connections=streams)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=None,
+                                 headers={"Authorization": f"Bearer {token}"}) as client:
+        async def one() -> tuple:
+            frames = size = 0
+            text = ""
+            async with client.stream("POST", f"/api/v1/conversations/{conversation_id}/generate-code/stream",
+                                     params={"coalesce": coalesce}, json={"analysis_message_id": message_id}) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith("data: "):
+                        frames += 1
+                        size += len(line.encode()) + 2
+                        event = json.loads(line[6:])
+                        if event.get("event") == "message":
+                            text += event["answer"]
+            assert text == "".join(f"tok{i} " for i in range(args.events)), "token text was altered"
+            return frames, size
+        results = await asyncio.gather(*(one() for _ in range(streams)))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def report(name: str, frames: int, size: int, server_cpu: float, client_cpu: float, elapsed: float) -> None:
+    print(f"{name:<14} {frames / args.streams:7.1f} frames  {size / args.streams / 1024:7.1f} KiB  "
+          f"server {server_cpu * 1000 / args.streams:6.1f} ms  client {client_cpu * 1000 / args.streams:6.1f} ms CPU "
+          f"per stream  ({elapsed:5.2f} s wall)")
+
+
+def main() -> None:
+    from app.main import app
+
+    dify_service.run_code_generation_stream = synthetic_code_stream
+    conversation_id, message_id = prepare()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    print(f"{args.streams} streams x {args.events} token events, {args.interval} ms apart")
+    try:
+        # Warm up (first requests, connection pools) outside the measurements.
+        asyncio.run(run(f"http://127.0.0.1:{port}", "off", conversation_id, message_id, streams=1))
+        for name, mode in (("coalesce off", "off"), (f"coalesce {args.flush:g} ms", f"{args.flush:g}")):
+            server_cpu, total_cpu = thread_cpu_seconds(thread), time.process_time()
+            started = time.perf_counter()
+            frames, size = asyncio.run(run(f"http://127.0.0.1:{port}", mode, conversation_id, message_id))
+            server_cpu = thread_cpu_seconds(thread) - server_cpu
+            report(name, frames, size, server_cpu, time.process_time() - total_cpu - server_cpu, time.perf_counter() - started)
+    finally:
+        server.should_exit = True
+        thread.join()
+        engine.dispose()
+        os.remove(db_path)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
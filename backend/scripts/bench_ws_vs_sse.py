@@ -0,0 +1,202 @@
+"""
+Compares concurrent code-generation streams over SSE and over the multiplexed
+WebSocket.
+
+    cd backend && python scripts/bench_ws_vs_sse.py --streams 12 --events 500 --interval 5
+
+Starts the app with uvicorn on a temporary SQLite database and replaces the
+Dify code-generation stream with a synthetic one emitting --events token
+events, --interval ms apart. Then runs --streams concurrent generations, once
+as SSE POSTs through a client limited to --sse-connections connections per
+origin (browsers allow 6 over HTTP/1.1) and once as streams on a single
+WebSocket. All traffic goes through a TCP proxy that counts connections and
+bytes on the wire; the per-event overhead is wire bytes minus event payload.
+Compression is off unless --ws-compression is given, so the overhead is framing.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--streams", type=int, default=12)
+parser.add_argument("--events", type=int, default=500)
+parser.add_argument("--interval", type=float, default=5.0, help="ms between upstream events")
+parser.add_argument("--sse-connections", type=int, default=6)
+parser.add_argument("--ws-compression", action="store_true", help="negotiate permessage-deflate on the WebSocket")
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix="pcbtool-ws-bench-")
+db_path = os.path.join(workdir, "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+os.environ["MAINTENANCE_INTERVAL_SECONDS"] = "0"
+os.environ["WS_MAX_STREAMS"] = str(max(args.streams, 8))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+import websockets
+
+from app.db import crud, models
+from app.db.database import SessionLocal, engine
+from app.services import dify_service, security_service
+
+PAYLOAD = {"bytes": 0}
+
+
+async def synthetic_code_stream(user, req_doc, bom_csv):
+    for i in range(args.events):
+        await asyncio.sleep(args.interval / 1000)
+        chunk = json.dumps({"event": "message", "answer": f"tok{i} ", "conversation_id": "c0ffee", "message_id": "m0"})
+        PAYLOAD["bytes"] += len(chunk)
+        yield chunk
+
+
+class CountingProxy:
+    """
+    Forwards TCP connections to the app, counting connections and bytes.
+    """
+
+    def __init__(self, target_port: int):
+        self.target_port = target_port
+        self.connections = 0
+        self.down_bytes = 0
+        self.up_bytes = 0
+
+    def reset(self) -> None:
+        self.connections = self.down_bytes = self.up_bytes = 0
+
+    async def _pipe(self, reader, writer, counter: str) -> None:
+        try:
+            while data := await reader.read(65536):
+                setattr(self, counter, getattr(self, counter) + len(data))
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, client_reader, client_writer) -> None:
+        self.connections += 1
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        await asyncio.gather(
+            self._pipe(client_reader, server_writer, "up_bytes"),
+            self._pipe(server_reader, client_writer, "down_bytes"),
+        )
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def prepare() -> tuple:
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        user = models.User(username="bench", hashed_password="x")
+        db.add(user)
+        db.commit()
+        conversation = crud.create_conversation(db, user_id=user.id, title="bench")
+        message = crud.create_message(db, conversation.id, "assistant", {"type": "initial_analysis", "data": {
+            "需求文档": "bench", "BOM文件": "```csv\n元器件型号,数量\nSTM32F103C8T6,1\n```"}})
+        return conversation.id, message.id
+    finally:
+        db.close()
+
+
+async def run_sse(base: str, token: str, conversation_id: int, message_id: int) -> int:
+    limits = httpx.Limits(max_connections=args.sse_connections)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=None,
+                                 headers={"Authorization": f"Bearer {token}"}) as client:
+        async def one() -> int:
+            events = 0
+            async with client.stream("POST", f"/api/v1/conversations/{conversation_id}/generate-code/stream",
+                                     json={"analysis_message_id": message_id}) as response:
+                async for line in response.aiter_lines():
+                    events += line.startswith("data: ")
+            return events
+        return sum(await asyncio.gather(*(one() for _ in range(args.streams))))
+
+
+async def run_ws(base: str, token: str, conversation_id: int, message_id: int) -> int:
+    events = 0
+    async with websockets.connect(base.replace("http", "ws") + f"/api/v1/ws?token={token}", max_size=None,
+                                  compression="deflate" if args.ws_compression else None) as ws:
+        window = json.loads(await ws.recv())["window"]
+        for i in range(args.streams):
+            await ws.send(json.dumps({"type": "start", "stream_id": f"s{i}", "kind": "generate_code",
+                                      "conversation_id": conversation_id, "analysis_message_id": message_id}))
+        running = args.streams
+        received = {}
+        while running:
+            frame = json.loads(await ws.recv())
+            if frame["type"] == "event":
+                events += 1
+                sid = frame["stream_id"]
+                received[sid] = received.get(sid, 0) + 1
+                if received[sid] % (window // 2) == 0:
+                    await ws.send(json.dumps({"type": "credit", "stream_id": sid, "n": window // 2}))
+            elif frame["type"] == "end":
+                running -= 1
+    return events
+
+
+async def measure(name: str, runner, proxy: CountingProxy, base: str, *ids) -> None:
+    proxy.reset()
+    PAYLOAD["bytes"] = 0
+    token = security_service.create_access_token({"sub": "bench"})
+    cpu = time.process_time()
+    started = time.perf_counter()
+    events = await runner(base, token, *ids)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    overhead = (proxy.down_bytes - PAYLOAD["bytes"]) / events
+    print(f"{name:<4} {proxy.connections:4d} conn  {elapsed:6.2f} s  {events:7,d} events  "
+          f"{proxy.down_bytes / 2**20:7.2f} MiB down  {overhead:6.1f} B/event overhead  "
+          f"{proxy.up_bytes / 1024:7.1f} KiB up  {cpu * 1e6 / events:6.1f} µs CPU/event")
+
+
+async def main_async(conversation_id: int, message_id: int, port: int) -> None:
+    proxy = CountingProxy(port)
+    base = f"http://127.0.0.1:{await proxy.start()}"
+    print(f"{args.streams} streams x {args.events} events, {args.interval} ms apart; "
+          f"SSE limited to {args.sse_connections} connections")
+    await measure("sse", run_sse, proxy, base, conversation_id, message_id)
+    await measure("ws", run_ws, proxy, base, conversation_id, message_id)
+
+
+def main() -> None:
+    from app.main import app
+
+    dify_service.run_code_generation_stream = synthetic_code_stream
+    conversation_id, message_id = prepare()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        asyncio.run(main_async(conversation_id, message_id, port))
+    finally:
+        server.should_exit = True
+        thread.join()
+        engine.dispose()
+        os.remove(db_path)
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Exports a user's conversation history as NDJSON or a zip archive.
+
+    cd backend && python scripts/export_conversations.py --user alice --format zip --output alice.zip
+    cd backend && python scripts/export_conversations.py --user alice --since 2025-01-01 > alice.ndjson
+
+Uses DATABASE_URL like the application, and streams the same output as
+`GET /api/v1/conversations/export`.
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import crud
+from app.db.database import SessionLocal
+from app.services import export_service
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user", required=True, help="username whose history is exported")
+    parser.add_argument("--format", choices=sorted(export_service.EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--output", help="output file (default: stdout)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only messages created at or after this time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only messages created before this time")
+    parser.add_argument("--conversation", type=int, action="append", dest="conversation_ids",
+                        help="only this conversation id (repeatable)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        user = crud.get_user_by_username(db, args.user)
+        if user is None:
+            sys.exit(f"Unknown user: {args.user}")
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            written = 0
+            for chunk in export_service.export(db, user.id, args.format, args.since, args.until, args.conversation_ids):
+                out.write(chunk)
+                written += len(chunk)
+        finally:
+            if args.output:
+                out.close()
+        print(f"Exported {written:,} bytes", file=sys.stderr)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+A local stand-in for an OpenAI-compatible chat completion server, with
+injectable latency and failures. Used to exercise the LLM router without
+calling real providers.
+
+    python scripts/llm_standin_server.py --port 9001 --ttft 2.0 --tps 40
+    python scripts/llm_standin_server.py --port 9002 --ttft 0.3 --tps 120 --failure-rate 0.1
+
+Then point the backend at them:
+
+    LLM_BACKENDS='[{"name": "slow", "base_url": "http://127.0.0.1:9001/v1", "api_key": "x", "model": "m"},
+                   {"name": "fast", "base_url": "http://127.0.0.1:9002/v1", "api_key": "x", "model": "m"}]'
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(ttft: float = 0.5, tokens_per_second: float = 50.0, output_tokens: int = 200,
+               failure_rate: float = 0.0) -> FastAPI:
+    app = FastAPI(title="LLM stand-in")
+    app.state.settings = {
+        "ttft": ttft,
+        "tokens_per_second": tokens_per_second,
+        "output_tokens": output_tokens,
+        "failure_rate": failure_rate,
+    }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        settings = app.state.settings
+        if random.random() < settings["failure_rate"]:
+            return JSONResponse(status_code=503, content={"error": {"message": "injected failure"}})
+
+        model = body.get("model", "stand-in")
+        created = int(time.time())
+
+        def chunk(content: str | None, finish_reason: str | None = None) -> str:
+            payload = {
+                "id": "chatcmpl-standin",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content} if content is not None else {},
+                             "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(settings["ttft"])
+            delay = 1 / settings["tokens_per_second"] if settings["tokens_per_second"] > 0 else 0
+            for i in range(settings["output_tokens"]):
+                yield chunk(f"tok{i} ")
+                if delay:
+                    await asyncio.sleep(delay)
+            yield chunk(None, "stop")
+            yield "data: [DONE]\n\n"
+
+        if body.get("stream"):
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        await asyncio.sleep(settings["ttft"] + settings["output_tokens"] / max(settings["tokens_per_second"], 1e-9))
+        return {
+            "id": "chatcmpl-standin",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                "role": "assistant", "content": " ".join(f"tok{i}" for i in range(settings["output_tokens"]))}}],
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token.")
+    parser.add_argument("--tps", type=float, default=50.0, help="Tokens per second after the first one.")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens per response.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with 503.")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.ttft, args.tps, args.tokens, args.failure_rate), host="127.0.0.1", port=args.port)
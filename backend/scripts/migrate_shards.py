@@ -0,0 +1,79 @@
+"""
+Moves conversations and messages to where the current storage settings
+expect them.
+
+    cd backend && SHARD_MODE=user python scripts/migrate_shards.py            # single file -> per-user shards
+    cd backend && SHARD_MODE=hash SHARD_COUNT=32 python scripts/migrate_shards.py   # rebalance into 32 buckets
+    cd backend && SHARD_MODE= python scripts/migrate_shards.py --remove-empty  # shards -> DATABASE_URL
+    cd backend && python scripts/migrate_shards.py --dry-run
+
+Every user found in DATABASE_URL or in a shard under SHARD_DIR whose data is
+not in the place SHARD_MODE/SHARD_COUNT route to is moved there, together with
+their search entries. Ids are kept unless they collide with rows at the
+destination. Run it with the application stopped.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.db import models, sharding
+from app.db.database import engine, SessionLocal
+from app.services import search_service
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="only report which users would move")
+    parser.add_argument("--remove-empty", action="store_true", help="delete shard files left without conversations")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    search_service.init_search_index(engine)
+    layout = f"{sharding.SHARD_MODE} shards in {sharding.SHARD_DIR}" if sharding.is_enabled() else "a single database"
+    print(f"Target layout: {layout}")
+
+    db = SessionLocal()
+    try:
+        usernames = dict(db.query(models.User.id, models.User.username).all())
+    finally:
+        db.close()
+
+    started = time.monotonic()
+    moved_users = moved_conversations = moved_messages = 0
+    for source_key in [None] + sharding.existing_shard_keys():
+        source = engine if source_key is None else sharding.shards.get(source_key)
+        for user_id in sharding.conversation_owners(source):
+            target_key = sharding.shard_key(user_id) if sharding.is_enabled() else None
+            if target_key == source_key:
+                continue
+            if user_id not in usernames:
+                print(f"⚠️ Skipping conversations of unknown user {user_id} in {source_key or 'main database'}")
+                continue
+            if args.dry_run:
+                print(f"would move user {user_id}: {source_key or 'main'} -> {target_key or 'main'}")
+                moved_users += 1
+                continue
+            target = engine if target_key is None else sharding.shards.get(target_key)
+            conversations, messages = sharding.move_user(user_id, usernames[user_id], source, target, mirror=target_key is not None)
+            moved_users += 1
+            moved_conversations += conversations
+            moved_messages += messages
+            print(f"moved user {user_id}: {source_key or 'main'} -> {target_key or 'main'} "
+                  f"({conversations} conversations, {messages} messages)")
+
+    if args.remove_empty and not args.dry_run:
+        for key in sharding.existing_shard_keys():
+            if sharding.count_conversations(sharding.shards.get(key)) == 0:
+                sharding.shards.discard(key)
+                os.remove(sharding.shard_path(key))
+                print(f"removed empty shard {key}")
+
+    print(f"{moved_users} users, {moved_conversations} conversations, {moved_messages} messages "
+          f"in {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Runs the retention policies and database compaction once, outside the server.
+
+    cd backend && python scripts/run_maintenance.py
+    cd backend && python scripts/run_maintenance.py --policies '{"generated_code": 90, "audio": 30}'
+    cd backend && python scripts/run_maintenance.py --vacuum-full
+
+--vacuum-full rebuilds an SQLite database with a blocking VACUUM. Run it once
+(with the server stopped) on databases created before incremental
+auto-vacuum was enabled; afterwards the periodic maintenance frees space
+incrementally.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from app.db.database import engine
+from app.services import maintenance_service
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--policies", help="retention policies as JSON (default: RETENTION_POLICIES)")
+    parser.add_argument("--vacuum-full", action="store_true", help="run a full, blocking VACUUM (SQLite)")
+    args = parser.parse_args()
+
+    if args.vacuum_full:
+        if engine.dialect.name != "sqlite":
+            sys.exit("--vacuum-full is only needed for SQLite")
+        with engine.connect() as conn:
+            conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+            conn.commit()
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+            mode = conn.execute(text("PRAGMA auto_vacuum")).scalar()
+        print(f"VACUUM done, auto_vacuum mode is now {mode} (2 = incremental)")
+
+    policies = maintenance_service.load_policies(args.policies) if args.policies else None
+    print(maintenance_service.run_once(policies))
+
+
+if __name__ == "__main__":
+    main()